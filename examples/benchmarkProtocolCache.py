@@ -0,0 +1,43 @@
+"""
+Compares how long it takes to build the protocol tables (and a drone object) when the XML has to be
+parsed (cold) versus when the precompiled on-disk cache is used (warm).  No drone is needed.
+
+Author: Amy McGovern
+"""
+import os
+import tempfile
+import time
+from pyparrot.commandsandsensors import DroneProtocol as drone_protocol
+from pyparrot.commandsandsensors.DroneProtocol import DroneProtocol
+from pyparrot.Bebop import Bebop
+
+num_runs = 10
+
+# use a private cache directory so the cold numbers are really cold
+os.environ["PYPARROT_CACHE_DIR"] = tempfile.mkdtemp()
+
+def time_it(function):
+    start_time = time.perf_counter()
+    for i in range(num_runs):
+        function()
+    return (time.perf_counter() - start_time) / num_runs * 1000.0
+
+cold = time_it(lambda: DroneProtocol(use_cache=False))
+
+# build the cache once and then time loading it
+DroneProtocol()
+warm = time_it(lambda: DroneProtocol())
+
+print("protocol tables: cold %.2f ms, warm %.2f ms (%.1fx faster)" % (cold, warm, cold / warm))
+
+def make_bebop_cold():
+    drone_protocol._drone_protocol = DroneProtocol(use_cache=False)
+    Bebop()
+
+def make_bebop_warm():
+    drone_protocol._drone_protocol = None
+    Bebop()
+
+cold = time_it(make_bebop_cold)
+warm = time_it(make_bebop_warm)
+print("Bebop(): cold %.2f ms, warm %.2f ms (%.1fx faster)" % (cold, warm, cold / warm))
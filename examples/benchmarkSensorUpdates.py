@@ -0,0 +1,97 @@
+"""
+Measures how many sensor updates per second BebopSensors and MinidroneSensors can store using typical
+telemetry.  The chain of name comparisons the sensors used before the per sensor handlers is included for
+comparison.  No drone is needed.
+
+Author: Amy McGovern
+"""
+import struct
+import time
+from pyparrot.commandsandsensors.DroneSensorParser import DroneSensorParser
+from pyparrot.Bebop import BebopSensors
+from pyparrot.Minidrone import MinidroneSensors
+
+num_updates = 500000
+
+# decode a mix of frequent Bebop sensors once so only the updates are timed
+bebop_parser = DroneSensorParser(drone_type="Bebop2")
+bebop_messages = [
+    struct.pack("<BBHfff", 1, 4, 6, 0.01, -0.02, 1.57),        # AttitudeChanged
+    struct.pack("<BBHfff", 1, 4, 5, 0.5, 0.1, -0.1),           # SpeedChanged
+    struct.pack("<BBHd", 1, 4, 8, 1.25),                       # AltitudeChanged
+    struct.pack("<BBHddd", 1, 4, 4, 35.2, -97.4, 350.0),       # PositionChanged
+    struct.pack("<BBHB", 0, 5, 1, 87),                         # BatteryStateChanged
+    struct.pack("<BBHB", 1, 4, 1, 2),                          # FlyingStateChanged
+]
+bebop_updates = [sensor[0:3] for data in bebop_messages for sensor in bebop_parser.extract_sensor_values(data)]
+
+# and the minidrone sensors (the updates are made up since the minidrone XML ids differ between versions)
+minidrone_parser = DroneSensorParser(drone_type="Minidrone")
+minidrone_updates = [
+    ("DroneSpeed_speed_x", 0.1, minidrone_parser.sensor_tuple_cache),
+    ("DroneSpeed_speed_y", 0.2, minidrone_parser.sensor_tuple_cache),
+    ("DroneSpeed_speed_z", 0.0, minidrone_parser.sensor_tuple_cache),
+    ("DroneSpeed_ts", 1200, minidrone_parser.sensor_tuple_cache),
+    ("DroneQuaternion_q_w", 1.0, minidrone_parser.sensor_tuple_cache),
+    ("DroneQuaternion_q_z", 0.0, minidrone_parser.sensor_tuple_cache),
+    ("BatteryStateChanged_battery_percent", 87, minidrone_parser.sensor_tuple_cache),
+    ("PilotingStateChanged_extra", 3, minidrone_parser.sensor_tuple_cache),
+]
+
+bebop_flags = [(name, attribute) for (name, attribute) in BebopSensors.sensor_flags.items()]
+
+def bebop_name_chain_update(sensors, sensor_name, sensor_value, sensor_enum):
+    """
+    The old update: an enum probe and then one comparison per sensor the Bebop knows about
+    """
+    if (sensor_name, "enum") in sensor_enum:
+        if (sensor_value is None or sensor_value > len(sensor_enum[(sensor_name, "enum")])):
+            value = "UNKNOWN_ENUM_VALUE"
+        else:
+            value = sensor_enum[(sensor_name, "enum")][sensor_value]
+        sensors.sensors_dict[sensor_name] = value
+    else:
+        sensors.sensors_dict[sensor_name] = sensor_value
+
+    if (sensor_name == "FlyingStateChanged_state"):
+        sensors.flying_state = sensors.sensors_dict["FlyingStateChanged_state"]
+    if (sensor_name == "BatteryStateChanged_battery_percent"):
+        sensors.battery = sensor_value
+    for (name, attribute) in bebop_flags:
+        if (sensor_name == name):
+            setattr(sensors, attribute, True)
+
+minidrone_attributes = [(name, attribute) for (name, attribute) in MinidroneSensors.sensor_attributes.items()]
+
+def minidrone_name_chain_update(sensors, name, value, sensor_enum):
+    """
+    The old update: an enum probe and then an elif chain over the sensors the minidrone knows about
+    """
+    if (name, "enum") in sensor_enum:
+        if (value > len(sensor_enum[(name, "enum")])):
+            value = "UNKNOWN_ENUM_VALUE"
+        else:
+            value = sensor_enum[(name, "enum")][value]
+
+    for (sensor_name, attribute) in minidrone_attributes:
+        if (name == sensor_name):
+            setattr(sensors, attribute, value)
+            break
+    else:
+        sensors.sensors_dict[name] = value
+
+def updates_per_second(update, sensors, updates):
+    start_time = time.perf_counter()
+    for i in range(num_updates):
+        (name, value, sensor_enum) = updates[i % len(updates)]
+        update(sensors, name, value, sensor_enum)
+    return num_updates / (time.perf_counter() - start_time)
+
+for (label, sensors_class, name_chain_update, updates) in (
+        ("Bebop", BebopSensors, bebop_name_chain_update, bebop_updates),
+        ("Minidrone", MinidroneSensors, minidrone_name_chain_update, minidrone_updates)):
+    before = updates_per_second(name_chain_update, sensors_class(), updates)
+    after = updates_per_second(sensors_class.update, sensors_class(), updates)
+
+    print("%s name comparisons: %d updates/s" % (label, before))
+    print("%s sensor handlers:  %d updates/s (%.1fx)" % (label, after, after / before))
@@ -0,0 +1,90 @@
+"""
+Checks that the wifi connection resends an acked command whose ack was lost.  A fake drone on this machine
+answers the TCP handshake and acks every command except the first ack of one of them, which it drops.  The
+batch still succeeds because that command is sent again after the timeout.  The fake drone acks right away, so
+a few more commands must also bring the adaptive timeout below the fixed 0.5 seconds used before.  No drone is needed (the fake
+drone uses the handshake port 44444 and the c2d port 54321 on 127.0.0.1).
+
+Author: Amy McGovern
+"""
+import json
+import socket
+import struct
+import threading
+from pyparrot.networking.wifiConnection import WifiConnection
+from pyparrot.commandsandsensors.DroneCommandParser import DroneCommandParser
+
+c2d_port = 54321
+
+# sequence number whose first ack is dropped
+drop_seq = 3
+
+frame_header = struct.Struct("<BBBI")
+sends_by_seq = dict()
+
+def fake_handshake(server):
+    (conn, addr) = server.accept()
+    request = json.loads(conn.recv(4096).decode("utf-8"))
+    conn.send((json.dumps({"status": 0, "c2d_port": c2d_port}) + "\0").encode("utf-8"))
+    conn.close()
+    return request["d2c_port"]
+
+def fake_drone(udp_sock, d2c_port):
+    while (True):
+        try:
+            (data, addr) = udp_sock.recvfrom(4096)
+        except OSError:
+            return
+
+        # a datagram can hold several frames
+        offset = 0
+        while (offset + frame_header.size <= len(data)):
+            (data_type, buffer_id, seq, size) = frame_header.unpack_from(data, offset)
+            offset += size
+
+            # only the commands (DATA_WITH_ACK) on the ack buffer (11) are acked
+            if (data_type != 4 or buffer_id != 11):
+                continue
+
+            sends_by_seq[seq] = sends_by_seq.get(seq, 0) + 1
+            if (seq == drop_seq and sends_by_seq[seq] == 1):
+                print("fake drone: dropping the ack of packet %d" % seq)
+                continue
+
+            ack = frame_header.pack(1, 139, seq, frame_header.size + 1) + struct.pack("<B", seq)
+            udp_sock.sendto(ack, ("127.0.0.1", d2c_port))
+
+server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+server.bind(("127.0.0.1", 44444))
+server.listen(1)
+
+drone_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+drone_sock.bind(("127.0.0.1", c2d_port))
+
+connection = WifiConnection(None, drone_type="Bebop2", ip_address="127.0.0.1")
+handshake_thread = threading.Thread(target=lambda: fake_drone(drone_sock, fake_handshake(server)))
+handshake_thread.daemon = True
+handshake_thread.start()
+
+if (connection.connect(3)):
+    parser = DroneCommandParser()
+    max_altitude = parser.get_command_tuple("ardrone3", "PilotingSettings", "MaxAltitude")
+    acked = connection.send_command_batch_ack([(max_altitude, [10.0])] * 6)
+
+    resent = [seq for (seq, num_sends) in sends_by_seq.items() if num_sends > 1]
+    print("batch acked: %s" % acked)
+    print("packets sent more than once: %s" % resent)
+
+    # fast acks after the backoff of the dropped one
+    for i in range(20):
+        connection.send_param_command_packet(max_altitude, param_tuple=[10.0], param_type_tuple=["float"])
+    rto = connection.rtt_estimator.get_rto()
+    print(connection.rtt_estimator)
+    print("timeout below 0.5 s: %s" % (rto < 0.5))
+    print("PASS" if (acked and drop_seq in resent and rto < 0.5) else "FAIL")
+
+    connection.disconnect()
+
+drone_sock.close()
+server.close()
@@ -8,7 +8,11 @@ Author: Amy McGovern
 from pyparrot.Minidrone import Mambo
 import cv2
 
-mambo = Mambo(None, use_wifi=True) #address is None since it only works with WiFi anyway
+# you will need to change this to the address of YOUR mambo
+mamboAddr = "e0:14:d0:63:3d:d0"
+
+# the pictures are downloaded over BLE FTP (wifi FTP is disabled by the firmware)
+mambo = Mambo(mamboAddr, use_wifi=False)
 print("trying to connect to mambo now")
 success = mambo.connect(num_retries=3)
 print("connected: %s" % success)
@@ -6,12 +6,45 @@ Author: Amy McGovern, dramymcgovern@gmail.com
 """
 import time
 from pyparrot.networking.wifiConnection import WifiConnection
+from pyparrot.networking.pcmdScheduler import PCMDScheduler
 from pyparrot.utils.colorPrint import color_print
 from pyparrot.commandsandsensors.DroneCommandParser import DroneCommandParser
-from pyparrot.commandsandsensors.DroneSensorParser import DroneSensorParser
+from pyparrot.commandsandsensors.DroneSensorParser import DroneSensorParser, make_sensor_handler
 from datetime import datetime
 
 class AnafiSensors:
+    # sensors that are also saved outside the dictionary for internal use (sensor name -> attribute)
+    sensor_attributes = {
+        "FlyingStateChanged_state": "flying_state",
+        "BatteryStateChanged_battery_percent": "battery",
+    }
+
+    # sensors that set a flag when they arrive (sensor name -> attribute set to True)
+    sensor_flags = {
+        "PilotingState_FlatTrimChanged": "flat_trim_changed",
+        "moveByEnd_dX": "RelativeMoveEnded",
+        "OrientationV2_tilt": "CameraMoveEnded_tilt",
+        "OrientationV2_pan": "CameraMoveEnded_pan",
+        "MaxAltitudeChanged_current": "max_altitude_changed",
+        "MaxDistanceChanged_current": "max_distance_changed",
+        "NoFlyOverMaxDistanceChanged_shouldNotFlyOver": "no_fly_over_max_distance_changed",
+        "MaxTiltChanged_current": "max_tilt_changed",
+        "MaxPitchRollRotationSpeedChanged_current": "max_pitch_roll_rotation_speed_changed",
+        "MaxVerticalSpeedChanged_current": "max_vertical_speed_changed",
+        "MaxRotationSpeedChanged_current": "max_rotation_speed_changed",
+        "HullProtectionChanged_present": "hull_protection_changed",
+        "OutdoorChanged_present": "outdoor_mode_changed",
+        "PictureFormatChanged_type": "picture_format_changed",
+        "AutoWhiteBalanceChanged_type": "auto_white_balance_changed",
+        "ExpositionChanged_value": "exposition_changed",
+        "SaturationChanged_value": "saturation_changed",
+        "TimelapseChanged_enabled": "timelapse_changed",
+        "VideoStabilizationModeChanged_mode": "video_stabilization_changed",
+        "VideoRecordingModeChanged_mode": "video_recording_changed",
+        "VideoFramerateChanged_framerate": "video_framerate_changed",
+        "VideoResolutionsChanged_type": "video_resolutions_changed",
+    }
+
     def __init__(self):
         self.sensors_dict = dict()
         self.RelativeMoveEnded = False
@@ -22,10 +55,12 @@ class AnafiSensors:
         self.max_altitude_changed = False
         self.max_distance_changed = False
         self.no_fly_over_max_distance = False
+        self.no_fly_over_max_distance_changed = False
         self.max_tilt_changed = False
         self.max_pitch_roll_rotation_speed_changed = False
         self.max_vertical_speed_changed = False
         self.max_rotation_speed = False
+        self.max_rotation_speed_changed = False
         self.hull_protection_changed = False
         self.outdoor_mode_changed = False
         self.picture_format_changed = False
@@ -44,6 +79,9 @@ class AnafiSensors:
         # this is optionally set elsewhere
         self.user_callback_function = None
 
+        # sensor name -> function storing its value (see make_sensor_handler)
+        self.sensor_handlers = dict()
+
     def set_user_callback_function(self, function, args):
         """
         Sets the user callback function (called everytime the sensors are updated)
@@ -56,97 +94,18 @@ class AnafiSensors:
         self.user_callback_function_args = args
 
     def update(self, sensor_name, sensor_value, sensor_enum):
-        if (sensor_name is None):
-            print("Error empty sensor")
-            return
-
-
-        if (sensor_name, "enum") in sensor_enum:
-            # grab the string value
-            if (sensor_value is None or sensor_value > len(sensor_enum[(sensor_name, "enum")])):
-                value = "UNKNOWN_ENUM_VALUE"
-            else:
-                enum_value = sensor_enum[(sensor_name, "enum")][sensor_value]
-                value = enum_value
-
-            self.sensors_dict[sensor_name] = value
-
-        else:
-            # regular sensor
-            self.sensors_dict[sensor_name] = sensor_value
-
-        # some sensors are saved outside the dictionary for internal use (they are also in the dictionary)
-        if (sensor_name == "FlyingStateChanged_state"):
-            self.flying_state = self.sensors_dict["FlyingStateChanged_state"]
-
-        if (sensor_name == "PilotingState_FlatTrimChanged"):
-            self.flat_trim_changed = True
-
-        if (sensor_name == "moveByEnd_dX"):
-            self.RelativeMoveEnded = True
-
-        if (sensor_name == "OrientationV2_tilt"):
-            self.CameraMoveEnded_tilt = True
-
-        if (sensor_name == "OrientationV2_pan"):
-            self.CameraMoveEnded_pan = True
-
-        if (sensor_name == "MaxAltitudeChanged_current"):
-            self.max_altitude_changed = True
-
-        if (sensor_name == "MaxDistanceChanged_current"):
-            self.max_distance_changed = True
-
-        if (sensor_name == "NoFlyOverMaxDistanceChanged_shouldNotFlyOver"):
-            self.no_fly_over_max_distance_changed = True
-
-        if (sensor_name == "MaxTiltChanged_current"):
-            self.max_tilt_changed = True
-
-        if (sensor_name == "MaxPitchRollRotationSpeedChanged_current"):
-            self.max_pitch_roll_rotation_speed_changed = True
-
-        if (sensor_name == "MaxVerticalSpeedChanged_current"):
-            self.max_vertical_speed_changed = True
-
-        if (sensor_name == "MaxRotationSpeedChanged_current"):
-            self.max_rotation_speed_changed = True
-
-        if (sensor_name == "HullProtectionChanged_present"):
-            self.hull_protection_changed = True
-
-        if (sensor_name == "OutdoorChanged_present"):
-            self.outdoor_mode_changed = True
-
-        if (sensor_name == "BatteryStateChanged_battery_percent"):
-            self.battery = sensor_value
-
-        if (sensor_name == "PictureFormatChanged_type"):
-            self.picture_format_changed = True
-
-        if (sensor_name == "AutoWhiteBalanceChanged_type"):
-            self.auto_white_balance_changed = True
-
-        if (sensor_name == "ExpositionChanged_value"):
-            self.exposition_changed = True
-
-        if (sensor_name == "SaturationChanged_value"):
-            self.saturation_changed = True
-
-        if (sensor_name == "TimelapseChanged_enabled"):
-            self.timelapse_changed = True
-
-        if (sensor_name == "VideoStabilizationModeChanged_mode"):
-            self.video_stabilization_changed = True
-
-        if (sensor_name == "VideoRecordingModeChanged_mode"):
-            self.video_recording_changed = True
+        handler = self.sensor_handlers.get(sensor_name)
+        if (handler is None):
+            if (sensor_name is None):
+                print("Error empty sensor")
+                return
 
-        if (sensor_name == "VideoFramerateChanged_framerate"):
-            self.video_framerate_changed = True
+            handler = make_sensor_handler(self, sensor_name, sensor_enum,
+                                          attribute=self.sensor_attributes.get(sensor_name),
+                                          flag=self.sensor_flags.get(sensor_name))
+            self.sensor_handlers[sensor_name] = handler
 
-        if (sensor_name == "VideoResolutionsChanged_type"):
-            self.video_resolutions_changed = True
+        handler(sensor_value)
 
         # call the user callback if it isn't None
         if (self.user_callback_function is not None):
@@ -158,14 +117,17 @@ class AnafiSensors:
         return str
 
 class Anafi():
-    def __init__(self, drone_type="Anafi", ip_address=None):
+    def __init__(self, drone_type="Anafi", ip_address=None, source_address=None, bind_interface=None):
         """
         Create a new Anafi object.  Assumes you have connected to the Anafi's wifi
 
+        :param source_address: optional local IP address of the wifi adapter to use for this drone
+        :param bind_interface: optional name of the wifi adapter to use for this drone (linux only)
         """
         self.drone_type = drone_type
 
-        self.drone_connection = WifiConnection(self, drone_type=drone_type, ip_address=ip_address)
+        self.drone_connection = WifiConnection(self, drone_type=drone_type, ip_address=ip_address,
+                                               source_address=source_address, bind_interface=bind_interface)
 
         # intialize the command parser
         self.command_parser = DroneCommandParser()
@@ -174,6 +136,9 @@ class Anafi():
         self.sensors = AnafiSensors()
         self.sensor_parser = DroneSensorParser(drone_type=drone_type)
 
+        # fixed rate PCMD sender (see start_pcmd_scheduler)
+        self.pcmd_scheduler = None
+
     def set_user_sensor_callback(self, function, args):
         """
         Set the (optional) user callback function for sensors.  Every time a sensor
@@ -232,6 +197,7 @@ class Anafi():
 
         :return: void
         """
+        self.stop_pcmd_scheduler()
         self.drone_connection.disconnect()
 
     def ask_for_state_update(self):
@@ -397,6 +363,55 @@ class Anafi():
 
         self.drone_connection.send_pcmd_command(command_tuple, my_roll, my_pitch, my_yaw, my_vertical, duration)
 
+    def start_pcmd_scheduler(self, rate=30, setpoint_timeout=0.5):
+        """
+        Start a background thread that sends PCMD at a fixed rate.  Use set_setpoint to change what it
+        sends (it does not block) and stop_pcmd_scheduler when you are done.  If no new setpoint arrives
+        for setpoint_timeout seconds, the Anafi is told to hover.
+
+        :param rate: number of PCMD packets per second (25 to 50 works well)
+        :param setpoint_timeout: seconds without a new setpoint before hovering
+        :return: nothing
+        """
+        if (self.pcmd_scheduler is None):
+            command_tuple = self.command_parser.get_command_tuple("ardrone3", "Piloting", "PCMD")
+            self.pcmd_scheduler = PCMDScheduler(self.drone_connection, command_tuple, rate, setpoint_timeout)
+        else:
+            self.pcmd_scheduler.period = 1.0 / rate
+            self.pcmd_scheduler.setpoint_timeout = setpoint_timeout
+
+        self.pcmd_scheduler.start()
+
+    def set_setpoint(self, roll, pitch, yaw, vertical_movement):
+        """
+        Set the PCMD values sent by the scheduler (see start_pcmd_scheduler).  Each argument ranges from
+        -100 to 100 and is clipped to that range.  Returns right away.
+
+        :param roll: roll in -100 to 100
+        :param pitch: pitch in -100 to 100
+        :param yaw: yaw in -100 to 100
+        :param vertical_movement: vertical speed in -100 to 100
+        :return: nothing
+        """
+        if (self.pcmd_scheduler is None):
+            color_print("Call start_pcmd_scheduler before set_setpoint", "ERROR")
+            return
+
+        self.pcmd_scheduler.set_setpoint(roll, pitch, yaw, vertical_movement)
+
+    def stop_pcmd_scheduler(self):
+        """
+        Stop the PCMD scheduler thread (the last packet it sends is a hover)
+
+        :return: the rate and jitter statistics from the scheduler (see PCMDScheduler.get_stats) or None
+        if it was not running
+        """
+        if (self.pcmd_scheduler is None):
+            return None
+
+        self.pcmd_scheduler.stop()
+        return self.pcmd_scheduler.get_stats()
+
 
     def flip(self, direction):
         """
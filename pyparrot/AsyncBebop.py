@@ -0,0 +1,323 @@
+"""
+asyncio versions of the Bebop and Anafi classes.  They use AsyncWifiConnection so many drones can be flown
+from one event loop (for example next to a web backend) without a thread per drone.  Every method that waits
+(for an ack, a sensor change or a duration) is a coroutine.
+
+    async def main():
+        bebop = AsyncBebop(d2c_port=0)
+        if (await bebop.connect(10)):
+            await bebop.safe_takeoff(10)
+            await bebop.fly_direct(0, 20, 0, 0, duration=1)
+            await bebop.safe_land(10)
+            await bebop.disconnect()
+
+    asyncio.run(main())
+
+Author: Amy McGovern, dramymcgovern@gmail.com
+"""
+import asyncio
+import time
+from pyparrot.networking.asyncWifiConnection import AsyncWifiConnection
+from pyparrot.utils.colorPrint import color_print
+from pyparrot.commandsandsensors.DroneCommandParser import DroneCommandParser
+from pyparrot.commandsandsensors.DroneSensorParser import DroneSensorParser
+from pyparrot.Bebop import BebopSensors
+from pyparrot.Anafi import AnafiSensors
+
+
+class AsyncBebop():
+    def __init__(self, drone_type="Bebop2", ip_address=None, d2c_port=43210, source_address=None, bind_interface=None):
+        """
+        Create a new AsyncBebop object.  Assumes you have connected to the Bebop's wifi
+
+        :param drone_type: Bebop or Bebop2
+        :param ip_address: IP address of the drone (found with mDNS if None)
+        :param d2c_port: local UDP port for the drone's data (0 picks a free port, needed for several drones)
+        :param source_address: optional local IP address of the wifi adapter to use for this drone
+        :param bind_interface: optional name of the wifi adapter to use for this drone (linux only)
+        """
+        self.drone_type = drone_type
+
+        self.drone_connection = AsyncWifiConnection(self, drone_type=drone_type, ip_address=ip_address,
+                                                    d2c_port=d2c_port, source_address=source_address,
+                                                    bind_interface=bind_interface)
+
+        # intialize the command parser
+        self.command_parser = DroneCommandParser()
+
+        # initialize the sensors and the parser
+        self.sensors = self._create_sensors()
+        self.sensor_parser = DroneSensorParser(drone_type=drone_type)
+
+    def _create_sensors(self):
+        return BebopSensors()
+
+    def set_user_sensor_callback(self, function, args):
+        """
+        Set the (optional) user callback function for sensors.  Every time a sensor
+        is updated, it calls this function (from the event loop, so it must not block).
+
+        :param function: name of the function
+        :param args: tuple of arguments to the function
+        :return: nothing
+        """
+        self.sensors.set_user_callback_function(function, args)
+
+    def update_sensors(self, data_type, buffer_id, sequence_number, raw_data, ack):
+        """
+        Update the sensors (called by the wifi connection)
+
+        :param data: raw data packet that needs to be parsed
+        :param ack: True if this packet needs to be ack'd and False otherwise
+        """
+        sensor_list = self.sensor_parser.extract_sensor_values(raw_data)
+        if (sensor_list is not None):
+            for sensor in sensor_list:
+                (sensor_name, sensor_value, sensor_enum, header_tuple) = sensor
+                if (sensor_name is not None):
+                    self.sensors.update(sensor_name, sensor_value, sensor_enum)
+                else:
+                    color_print("data type %d buffer id %d sequence number %d" % (data_type, buffer_id, sequence_number), "WARN")
+                    color_print("This sensor is missing (likely because we don't need it)", "WARN")
+
+        if (ack):
+            self.drone_connection.ack_packet(buffer_id, sequence_number)
+
+    async def connect(self, num_retries):
+        """
+        Connects to the drone
+
+        :param num_retries: number of times to retry
+        :return: True if it succeeds and False otherwise
+        """
+        return await self.drone_connection.connect(num_retries)
+
+    async def disconnect(self):
+        """
+        Disconnect from the drone.  Always call this at the end of your programs.
+
+        :return: void
+        """
+        await self.drone_connection.disconnect()
+
+    async def smart_sleep(self, timeout):
+        """
+        Sleep without blocking the other drones or tasks on the event loop
+
+        :param timeout: number of seconds to sleep
+        """
+        await self.drone_connection.smart_sleep(timeout)
+
+    async def _wait_for_sensor(self, is_done, timeout):
+        """
+        Sleep in small steps until is_done() is True or the timeout expires
+
+        :return: True if is_done() became True
+        """
+        end_time = time.monotonic() + timeout
+        while (not is_done()):
+            if (time.monotonic() >= end_time):
+                return False
+            await asyncio.sleep(0.1)
+        return True
+
+    async def send_command(self, project, myclass, cmd, param_tuple=None, param_type_tuple=None, ack=True):
+        """
+        Send any command from the XML files by name.  For example
+        await bebop.send_command("ardrone3", "PilotingSettings", "MaxTilt", [10.0])
+
+        :param project: project name in the XML (e.g. ardrone3 or common)
+        :param myclass: class name in the XML
+        :param cmd: command name in the XML
+        :param param_tuple: the parameter values (if any)
+        :param param_type_tuple: the parameter types (looked up in the XML if None)
+        :param ack: send on the ack channel and wait for the ack
+        :return: True if the command was sent (and acked) and False otherwise
+        """
+        command_tuple = self.command_parser.get_command_tuple(project, myclass, cmd)
+        if (ack):
+            return await self.drone_connection.send_param_command_packet(command_tuple, param_tuple,
+                                                                         param_type_tuple, ack=True)
+        self.drone_connection.send_param_command_packet(command_tuple, param_tuple, param_type_tuple, ack=False)
+        return True
+
+    async def ask_for_state_update(self):
+        """
+        Ask for a full state update
+
+        :return: True if the command was acked and False otherwise
+        """
+        command_tuple = self.command_parser.get_command_tuple("common", "Common", "AllStates")
+        return await self.drone_connection.send_noparam_command_packet_ack(command_tuple)
+
+    async def flat_trim(self, duration=0):
+        """
+        Sends the flat_trim command.  If duration is greater than 0, waits until the trim is done or
+        duration seconds pass.
+        """
+        command_tuple = self.command_parser.get_command_tuple("ardrone3", "Piloting", "FlatTrim")
+        await self.drone_connection.send_noparam_command_packet_ack(command_tuple)
+
+        if (duration > 0):
+            await self._wait_for_sensor(lambda: self.sensors.flat_trim_changed, duration)
+
+    async def takeoff(self):
+        """
+        Sends the takeoff command
+
+        :return: True if the command was acked and False otherwise
+        """
+        command_tuple = self.command_parser.get_command_tuple("ardrone3", "Piloting", "TakeOff")
+        return await self.drone_connection.send_noparam_command_packet_ack(command_tuple)
+
+    async def safe_takeoff(self, timeout):
+        """
+        Sends commands to takeoff until the drone reports it is flying or hovering
+
+        :param timeout: quit trying to takeoff if it takes more than timeout seconds
+        """
+        start_time = time.monotonic()
+        while (self.sensors.flying_state != "takingoff" and (time.monotonic() - start_time < timeout)):
+            if (self.sensors.flying_state == "emergency"):
+                return
+            await self.takeoff()
+            await self.smart_sleep(1)
+
+        while ((self.sensors.flying_state not in ("flying", "hovering") and
+                (time.monotonic() - start_time < timeout))):
+            if (self.sensors.flying_state == "emergency"):
+                return
+            await self.smart_sleep(1)
+
+    async def land(self):
+        """
+        Sends the land command
+
+        :return: True if the command was acked and False otherwise
+        """
+        command_tuple = self.command_parser.get_command_tuple("ardrone3", "Piloting", "Landing")
+        return await self.drone_connection.send_noparam_command_packet_ack(command_tuple)
+
+    def emergency_land(self):
+        """
+        Sends the land command on the high priority/emergency channel (returns right away)
+        """
+        command_tuple = self.command_parser.get_command_tuple("ardrone3", "Piloting", "Landing")
+        self.drone_connection.send_noparam_high_priority_command_packet(command_tuple)
+
+    def is_landed(self):
+        """
+        Returns true if it is landed or emergency and False otherwise
+        """
+        return (self.sensors.flying_state in ("landed", "emergency"))
+
+    async def safe_land(self, timeout):
+        """
+        Sends the land command until the drone reports it is landed
+
+        :param timeout: quit trying if it takes more than timeout seconds
+        """
+        start_time = time.monotonic()
+        while (self.sensors.flying_state not in ("landing", "landed") and (time.monotonic() - start_time < timeout)):
+            if (self.sensors.flying_state == "emergency"):
+                return
+            color_print("trying to land", "INFO")
+            await self.land()
+            await self.smart_sleep(1)
+
+        while (self.sensors.flying_state != "landed" and (time.monotonic() - start_time < timeout)):
+            if (self.sensors.flying_state == "emergency"):
+                return
+            await self.smart_sleep(1)
+
+    def _ensure_fly_command_in_range(self, value):
+        """
+        :return: value clipped to -100 to 100
+        """
+        return min(100, max(-100, value))
+
+    async def fly_direct(self, roll, pitch, yaw, vertical_movement, duration=None):
+        """
+        Direct fly commands using PCMD.  Each argument ranges from -100 to 100 (clipped to that range).
+
+        :param roll:
+        :param pitch:
+        :param yaw:
+        :param vertical_movement:
+        :param duration: seconds to keep sending the command or None to send it once
+        """
+        my_roll = self._ensure_fly_command_in_range(roll)
+        my_pitch = self._ensure_fly_command_in_range(pitch)
+        my_yaw = self._ensure_fly_command_in_range(yaw)
+        my_vertical = self._ensure_fly_command_in_range(vertical_movement)
+
+        command_tuple = self.command_parser.get_command_tuple("ardrone3", "Piloting", "PCMD")
+        if (duration is None):
+            self.drone_connection.send_single_pcmd_command(command_tuple, my_roll, my_pitch, my_yaw, my_vertical)
+        else:
+            await self.drone_connection.send_pcmd_command(command_tuple, my_roll, my_pitch, my_yaw, my_vertical,
+                                                          duration)
+
+    async def flip(self, direction):
+        """
+        Sends the flip command.  Valid directions to flip are: front, back, right, left
+
+        :return: True if the command was acked and False otherwise
+        """
+        fixed_direction = direction.lower()
+        if (fixed_direction not in ("front", "back", "right", "left")):
+            color_print("Error: %s is not a valid direction.  Must be one of front, back, right, or left" % direction,
+                        "ERROR")
+            return False
+
+        (command_tuple, enum_tuple) = self.command_parser.get_command_tuple_with_enum("ardrone3",
+                                                                                      "Animations", "Flip", fixed_direction)
+        return await self.drone_connection.send_enum_command_packet_ack(command_tuple, enum_tuple)
+
+    async def move_relative(self, dx, dy, dz, dradians, timeout=30):
+        """
+        Move relative to our current position and wait until the move is done
+
+        :param dx: change in front axis (meters)
+        :param dy: change in right/left (positive is right) (meters)
+        :param dz: change in height (positive is DOWN) (meters)
+        :param dradians: change in heading in radians
+        :param timeout: maximum number of seconds to wait for the move to end
+        :return: True if the move ended and False otherwise
+        """
+        command_tuple = self.command_parser.get_command_tuple("ardrone3", "Piloting", "moveBy")
+        self.sensors.RelativeMoveEnded = False
+        await self.drone_connection.send_param_command_packet(command_tuple, [dx, dy, dz, dradians],
+                                                              ['float', 'float', 'float', 'float'])
+
+        return await self._wait_for_sensor(lambda: self.sensors.RelativeMoveEnded, timeout)
+
+    async def start_video_stream(self):
+        """
+        Sends the start stream command (RTP on the stream port of the wifi connection)
+        """
+        return await self.send_command("ardrone3", "MediaStreaming", "VideoEnable", [1], ['u8'])
+
+    async def stop_video_stream(self):
+        """
+        Sends the stop stream command
+        """
+        return await self.send_command("ardrone3", "MediaStreaming", "VideoEnable", [0], ['u8'])
+
+
+class AsyncAnafi(AsyncBebop):
+    def __init__(self, drone_type="Anafi", ip_address=None, d2c_port=43210, source_address=None, bind_interface=None):
+        """
+        Create a new AsyncAnafi object.  Assumes you have connected to the Anafi's wifi
+
+        :param drone_type: Anafi
+        :param ip_address: IP address of the drone (found with mDNS if None)
+        :param d2c_port: local UDP port for the drone's data (0 picks a free port, needed for several drones)
+        :param source_address: optional local IP address of the wifi adapter to use for this drone
+        :param bind_interface: optional name of the wifi adapter to use for this drone (linux only)
+        """
+        AsyncBebop.__init__(self, drone_type=drone_type, ip_address=ip_address, d2c_port=d2c_port,
+                            source_address=source_address, bind_interface=bind_interface)
+
+    def _create_sensors(self):
+        return AnafiSensors()
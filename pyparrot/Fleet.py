@@ -0,0 +1,190 @@
+"""
+Fly several wifi drones (Bebop, Anafi or Mambo with the FPV camera) from one program.
+
+Each drone gets its own d2c port so the drones can share one process, the handshakes are done in parallel, and
+one thread reads every drone's UDP socket with a selector and hands the data to that drone's sensor parser.
+takeoff_all, land_all and emergency_all send to every drone at once.
+
+    fleet = Fleet()
+    fleet.add_drone("bebop1", Bebop(ip_address="192.168.42.1"))
+    fleet.add_drone("anafi1", Anafi(ip_address="192.168.43.1"))
+    if (all(fleet.connect(10).values())):
+        fleet.takeoff_all()
+        fleet.smart_sleep(5)
+        fleet.land_all()
+    fleet.disconnect()
+
+Author: Amy McGovern, dramymcgovern@gmail.com
+"""
+import selectors
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pyparrot.utils.colorPrint import color_print
+from pyparrot.Minidrone import Minidrone
+from pyparrot.networking.wifiConnection import _max_datagram_size
+
+
+class Fleet:
+    def __init__(self, first_d2c_port=43210, first_stream_port=55004):
+        """
+        :param first_d2c_port: d2c port of the first drone added (the next drones use the following ports)
+        :param first_stream_port: video stream port of the first drone added (each drone uses two ports:
+                                  the stream port and the stream control port right after it)
+        """
+        self.first_d2c_port = first_d2c_port
+        self.first_stream_port = first_stream_port
+
+        # name -> drone object, in the order they were added
+        self.drones = dict()
+
+        self._selector = None
+        self._listener_thread = None
+        self.is_listening = False
+
+    def add_drone(self, name, drone):
+        """
+        Add a drone to the fleet (before calling connect).  The drone must use wifi.
+
+        :param name: name for the drone (used as the key of the results)
+        :param drone: Bebop, Anafi or Minidrone (with use_wifi=True) object
+        :return: nothing
+        """
+        if (name in self.drones):
+            color_print("Error: there is already a drone named %s in the fleet" % name, "ERROR")
+            return
+
+        connection = drone.drone_connection
+        connection.udp_receive_port = self.first_d2c_port + len(self.drones)
+        connection.profile_name = name
+
+        # the Mambo does not stream video over RTP
+        if (hasattr(connection, "stream_port")):
+            connection.stream_port = self.first_stream_port + 2 * len(self.drones)
+            connection.stream_control_port = connection.stream_port + 1
+        self.drones[name] = drone
+
+    def _for_all(self, function):
+        """
+        Call function(drone) for every drone at the same time
+
+        :return: dictionary of drone name -> what the function returned
+        """
+        if (len(self.drones) == 0):
+            return dict()
+
+        with ThreadPoolExecutor(max_workers=len(self.drones)) as executor:
+            futures = dict((name, executor.submit(function, drone)) for (name, drone) in self.drones.items())
+
+        return dict((name, future.result()) for (name, future) in futures.items())
+
+    def connect(self, num_retries):
+        """
+        Connect to all of the drones at once and start listening to them
+
+        :param num_retries: number of times to retry each connection
+        :return: dictionary of drone name -> True if that drone connected
+        """
+        results = self._for_all(lambda drone: drone.drone_connection.connect(num_retries, start_listener=False))
+
+        # one selector for all of the connected drones
+        self._selector = selectors.DefaultSelector()
+        for (name, connected) in results.items():
+            if (connected):
+                connection = self.drones[name].drone_connection
+                connection.udp_receive_sock.setblocking(False)
+                self._selector.register(connection.udp_receive_sock, selectors.EVENT_READ, connection)
+            else:
+                color_print("Error: could not connect to %s" % name, "ERROR")
+
+        self.is_listening = True
+        self._listener_thread = threading.Thread(target=self._listen_sockets)
+        self._listener_thread.daemon = True
+        self._listener_thread.start()
+
+        return results
+
+    def _listen_sockets(self):
+        """
+        Read every drone's socket as data arrives and hand it to that drone's connection.
+        Runs until disconnect is called.
+        """
+        receive_buffer = bytearray(_max_datagram_size)
+        receive_view = memoryview(receive_buffer)
+
+        while (self.is_listening):
+            for (key, events) in self._selector.select(timeout=0.5):
+                try:
+                    num_bytes = key.fileobj.recv_into(receive_buffer)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError as e:
+                    color_print("Error reading from the drone: %s" % e, "ERROR")
+                    continue
+
+                try:
+                    key.data.handle_data(receive_view[:num_bytes])
+                except Exception as e:
+                    color_print("Error handling data from the drone: %s" % e, "ERROR")
+
+    def disconnect(self):
+        """
+        Stop listening and disconnect from all of the drones.  Always call this at the end of your programs.
+
+        :return: nothing
+        """
+        self.is_listening = False
+        if (self._listener_thread is not None):
+            self._listener_thread.join()
+            self._listener_thread = None
+
+        if (self._selector is not None):
+            self._selector.close()
+            self._selector = None
+
+        # each drone's own disconnect also stops its PCMD scheduler (with a final hover) before closing
+        self._for_all(lambda drone: drone.disconnect())
+
+    def _get_command_tuple(self, drone, cmd):
+        """
+        :return: the Piloting command tuple for this type of drone
+        """
+        if (isinstance(drone, Minidrone)):
+            return drone.command_parser.get_command_tuple("minidrone", "Piloting", cmd)
+        return drone.command_parser.get_command_tuple("ardrone3", "Piloting", cmd)
+
+    def takeoff_all(self):
+        """
+        Send takeoff to every drone at once and wait for the acks
+
+        :return: dictionary of drone name -> True if that drone acked the takeoff
+        """
+        return self._for_all(lambda drone: drone.drone_connection.send_noparam_command_packet_ack(
+            self._get_command_tuple(drone, "TakeOff")))
+
+    def land_all(self):
+        """
+        Send land to every drone at once and wait for the acks
+
+        :return: dictionary of drone name -> True if that drone acked the landing
+        """
+        return self._for_all(lambda drone: drone.drone_connection.send_noparam_command_packet_ack(
+            self._get_command_tuple(drone, "Landing")))
+
+    def emergency_all(self):
+        """
+        Send emergency (motors off) to every drone on the high priority channel.  Nothing waits for an ack so
+        every drone gets it right away.
+
+        :return: nothing
+        """
+        for drone in self.drones.values():
+            drone.drone_connection.send_noparam_high_priority_command_packet(self._get_command_tuple(drone, "Emergency"))
+
+    def smart_sleep(self, timeout):
+        """
+        Sleep while the listener thread keeps handling the data from the drones
+
+        :param timeout: number of seconds to sleep
+        """
+        time.sleep(timeout)
@@ -8,6 +8,7 @@ Author: Valentin Benke, https://github.com/Vabe7, groundcam support
 """
 import time
 from pyparrot.networking.wifiConnection import WifiConnection
+from pyparrot.networking.pcmdScheduler import PCMDScheduler
 try:
     from pyparrot.networking.bleConnection import BLEConnection
     BLEAvailable = True
@@ -15,7 +16,7 @@ except:
     BLEAvailable = False
 from pyparrot.utils.colorPrint import color_print
 from pyparrot.commandsandsensors.DroneCommandParser import DroneCommandParser
-from pyparrot.commandsandsensors.DroneSensorParser import DroneSensorParser
+from pyparrot.commandsandsensors.DroneSensorParser import DroneSensorParser, make_sensor_handler
 import math
 from os.path import join
 import inspect
@@ -36,6 +37,29 @@ class MinidroneSensors:
     Store the minidrone's last known sensor values
     """
 
+    # sensors saved as attributes (sensor name -> attribute), the others go in sensors_dict
+    sensor_attributes = {
+        "BatteryStateChanged_battery_percent": "battery",
+        "FlyingStateChanged_state": "flying_state",
+        "ClawState_id": "claw_id",
+        "ClawState_state": "claw_state",
+        "GunState_id": "gun_id",
+        "GunState_state": "gun_state",
+        "DroneSpeed_speed_x": "speed_x",
+        "DroneSpeed_speed_y": "speed_y",
+        "DroneSpeed_speed_z": "speed_z",
+        "DroneSpeed_ts": "speed_ts",
+        "DroneAltitude_altitude": "altitude",
+        "DroneAltitude_ts": "altitude_ts",
+        "DroneQuaternion_q_w": "quaternion_w",
+        "DroneQuaternion_q_x": "quaternion_x",
+        "DroneQuaternion_q_y": "quaternion_y",
+        "DroneQuaternion_q_z": "quaternion_z",
+        "DroneQuaternion_ts": "quaternion_ts",
+        "FlyingModeChanged_mode": "flying_mode",
+        "PlaneGearBoxChanged_state": "plane_gear_box",
+    }
+
     def __init__(self):
 
         # default to full battery
@@ -75,6 +99,9 @@ class MinidroneSensors:
         # this is optionally set elsewhere
         self.user_callback_function = None
 
+        # sensor name -> function storing its value (see make_sensor_handler)
+        self.sensor_handlers = dict()
+
     def set_user_callback_function(self, function, args):
         """
         Sets the user callback function (called everytime the sensors are updated)
@@ -97,62 +124,19 @@ class MinidroneSensors:
         """
         #print("updating sensor %s" % name)
         #print(value)
-        if (name is None):
-            print("Error empty sensor")
-            return
+        handler = self.sensor_handlers.get(name)
+        if (handler is None):
+            if (name is None):
+                print("Error empty sensor")
+                return
 
+            # the known sensors are saved as attributes and the new ones in the dict for now
+            attribute = self.sensor_attributes.get(name)
+            handler = make_sensor_handler(self, name, sensor_enum, save_in_dict=(attribute is None),
+                                          attribute=attribute)
+            self.sensor_handlers[name] = handler
 
-        if (name, "enum") in sensor_enum:
-            # grab the string value
-            if (value > len(sensor_enum[(name, "enum")])):
-                value = "UNKNOWN_ENUM_VALUE"
-            else:
-                enum_value = sensor_enum[(name, "enum")][value]
-                value = enum_value
-
-
-        # add it to the sensors
-        if (name == "BatteryStateChanged_battery_percent"):
-            self.battery = value
-        elif (name == "FlyingStateChanged_state"):
-            self.flying_state = value
-        elif (name == "ClawState_id"):
-            self.claw_id = value
-        elif (name == "ClawState_state"):
-            self.claw_state = value
-        elif (name == "GunState_id"):
-            self.gun_id = value
-        elif (name == "GunState_state"):
-            self.gun_state = value
-        elif (name == "DroneSpeed_speed_x"):
-            self.speed_x = value
-        elif (name == "DroneSpeed_speed_y"):
-            self.speed_y = value
-        elif (name == "DroneSpeed_speed_z"):
-            self.speed_z = value
-        elif (name == "DroneSpeed_ts"):
-            self.speed_ts = value
-        elif (name == "DroneAltitude_altitude"):
-            self.altitude = value
-        elif (name == "DroneAltitude_ts"):
-            self.altitude_ts = value
-        elif (name == "DroneQuaternion_q_w"):
-            self.quaternion_w = value
-        elif (name == "DroneQuaternion_q_x"):
-            self.quaternion_x = value
-        elif (name == "DroneQuaternion_q_y"):
-            self.quaternion_y = value
-        elif (name == "DroneQuaternion_q_z"):
-            self.quaternion_z = value
-        elif (name == "DroneQuaternion_ts"):
-            self.quaternion_ts = value
-        elif (name == "FlyingModeChanged_mode"):
-            self.flying_mode = value
-        elif (name == "PlaneGearBoxChanged_state"):
-            self.plane_gear_box = value
-        else:
-            #print "new sensor - add me to the struct but saving in the dict for now"
-            self.sensors_dict[name] = value
+        handler(value)
 
         # call the user callback if it isn't None
         if (self.user_callback_function is not None):
@@ -227,19 +211,26 @@ class MinidroneSensors:
 
 
 class MamboGroundcam:
-    def __init__(self):
+    def __init__(self, ble_ftp=None):
         """
         Initialises the FTP-Session for the picture-download.
-        Only works with WiFi.
+        Wifi FTP is disabled by the firmware so the pictures are only available over BLE FTP.
+        Note the BLE FTP framing follows the Parrot SDK but it has not been tested on a real Mambo yet: if the
+        downloads fail, the MD5 error printed by BLEFtp shows the raw last packet.
+
+        :param ble_ftp: the BLEFtp of the BLE connection (None when connected over wifi)
         """
         self.MEDIA_PATH = '/internal_000/mambo/media'  # Filepath on the Mambo
+        self.ble_ftp = ble_ftp
+        self._file_sizes = dict()  # file name -> size from the last listing
         # groundcam remains broken on 3.0.26 and now it times out
         #try:
         #    self.ftp = FTP('192.168.99.3')  # IP-Address of the drone itself
         #    login = self.ftp.login()
         #    print("FTP login success is %s" % login)
         #except:
-        print("ERROR: ftp login is disabled by parrot firmware 3.0.25 and 26.  Groundcam will not work.")
+        if (ble_ftp is None):
+            print("ERROR: ftp login is disabled by parrot firmware 3.0.25 and 26.  Groundcam will not work over wifi.")
         self.ftp = None
 
         # get the path for the config files
@@ -248,11 +239,9 @@ class MamboGroundcam:
         if (shortPathIndex == -1):
             # handle Windows paths
             shortPathIndex = fullPath.rfind("\\")
-        print(shortPathIndex)
         shortPath = fullPath[0:shortPathIndex]
         self.imagePath = join(shortPath, "images")
         self.storageFile = join(self.imagePath, "groundcam.jpg")
-        print(self.storageFile)
         #self.storageFile = tempfile.NamedTemporaryFile()
 
     def _close(self):
@@ -264,6 +253,13 @@ class MamboGroundcam:
         Retruns a list with the names of the pictures stored on the Mambo.
         :return The list as an array, if there isn't any file, the array is empty.
         """
+        if (self.ble_ftp is not None):
+            files = self.ble_ftp.list_files(self.MEDIA_PATH)
+            if (files is None):
+                return list()
+            self._file_sizes = dict(files)
+            return sorted(self._file_sizes.keys())
+
         if (self.ftp is None):
             return list()
         else:
@@ -280,6 +276,20 @@ class MamboGroundcam:
         :param cv2_flag: if true this function will return a cv2 image object, if false the name of the temporary file will be returned
         :return False if there was an error during download, if cv2 is True a cv2 frame or it just returns the file name of the temporary file
         """
+        if (self.ble_ftp is not None):
+            # the size from the last listing lets the download allocate its buffer once
+            size = self._file_sizes.get(filename)
+            data = self.ble_ftp.get_file("%s/%s" % (self.MEDIA_PATH, filename), size)
+            if (data is None):
+                return False
+            with open(self.storageFile, "wb") as image_file:
+                image_file.write(data)
+            if cv2_flag and OpenCVAvailable:
+                img = cv2.imread(self.storageFile)
+                return img
+            else:
+                return filename
+
         # handle the broken firmware upgrade
         if (self.ftp is None):
             return False
@@ -302,12 +312,14 @@ class MamboGroundcam:
         Deletes a file on the drone
         :param filename: Filename of the file you wnat to delete
         '''
-        if (self.ftp is not None):
+        if (self.ble_ftp is not None):
+            self.ble_ftp.delete_file("%s/%s" % (self.MEDIA_PATH, filename))
+        elif (self.ftp is not None):
             self.ftp.delete(filename)
 
 
 class Minidrone:
-    def __init__(self, address="", use_wifi=False):
+    def __init__(self, address="", use_wifi=False, source_address=None, bind_interface=None):
         """
         If you need BLE: Initialize with its BLE address - if you don't know the address, call findMambo
         and that will discover it for you.
@@ -315,12 +327,15 @@ class Minidrone:
         ensure you have connected your machine to the wifi on the camera before attempting this or it will not work.
         :param address: unique address for this mambo (can be ignored if you are using wifi)
         :param use_wifi: set to True to connect with wifi instead of BLE
+        :param source_address: optional local IP address of the wifi adapter to use (wifi only)
+        :param bind_interface: optional name of the wifi adapter to use (wifi only, linux only)
         """
         self.address = address
         self.use_wifi = use_wifi
         self.groundcam = None
         if (use_wifi):
-            self.drone_connection = WifiConnection(self, drone_type="Mambo")
+            self.drone_connection = WifiConnection(self, drone_type="Mambo", source_address=source_address,
+                                                   bind_interface=bind_interface)
             # initialize groundcam
             self.groundcam = MamboGroundcam()
         else:
@@ -338,6 +353,9 @@ class Minidrone:
         self.sensors = MinidroneSensors()
         self.sensor_parser = DroneSensorParser(drone_type="Minidrone")
 
+        # fixed rate PCMD sender (see start_pcmd_scheduler)
+        self.pcmd_scheduler = None
+
 
     def set_user_sensor_callback(self, function, args):
         """
@@ -617,6 +635,55 @@ class Minidrone:
         else:
             self.drone_connection.send_pcmd_command(command_tuple, my_roll, my_pitch, my_yaw, my_vertical, duration)
 
+    def start_pcmd_scheduler(self, rate=30, setpoint_timeout=0.5):
+        """
+        Start a background thread that sends PCMD at a fixed rate.  Use set_setpoint to change what it
+        sends (it does not block) and stop_pcmd_scheduler when you are done.  If no new setpoint arrives
+        for setpoint_timeout seconds, the minidrone is told to hover.
+
+        :param rate: number of PCMD packets per second (25 to 50 works well)
+        :param setpoint_timeout: seconds without a new setpoint before hovering
+        :return: nothing
+        """
+        if (self.pcmd_scheduler is None):
+            command_tuple = self.command_parser.get_command_tuple("minidrone", "Piloting", "PCMD")
+            self.pcmd_scheduler = PCMDScheduler(self.drone_connection, command_tuple, rate, setpoint_timeout)
+        else:
+            self.pcmd_scheduler.period = 1.0 / rate
+            self.pcmd_scheduler.setpoint_timeout = setpoint_timeout
+
+        self.pcmd_scheduler.start()
+
+    def set_setpoint(self, roll, pitch, yaw, vertical_movement):
+        """
+        Set the PCMD values sent by the scheduler (see start_pcmd_scheduler).  Each argument ranges from
+        -100 to 100 and is clipped to that range.  Returns right away.
+
+        :param roll: roll in -100 to 100
+        :param pitch: pitch in -100 to 100
+        :param yaw: yaw in -100 to 100
+        :param vertical_movement: vertical speed in -100 to 100
+        :return: nothing
+        """
+        if (self.pcmd_scheduler is None):
+            color_print("Call start_pcmd_scheduler before set_setpoint", "ERROR")
+            return
+
+        self.pcmd_scheduler.set_setpoint(roll, pitch, yaw, vertical_movement)
+
+    def stop_pcmd_scheduler(self):
+        """
+        Stop the PCMD scheduler thread (the last packet it sends is a hover)
+
+        :return: the rate and jitter statistics from the scheduler (see PCMDScheduler.get_stats) or None
+        if it was not running
+        """
+        if (self.pcmd_scheduler is None):
+            return None
+
+        self.pcmd_scheduler.stop()
+        return self.pcmd_scheduler.get_stats()
+
 
 
     def open_claw(self):
@@ -742,6 +809,14 @@ class Minidrone:
 
 
 class Mambo(Minidrone):
+    def __init__(self, address="", use_wifi=False, source_address=None, bind_interface=None):
+        """
+        Same as Minidrone but over BLE the groundcam pictures are read with BLE FTP (see MamboGroundcam)
+        """
+        Minidrone.__init__(self, address, use_wifi, source_address, bind_interface)
+
+        if (not use_wifi and self.drone_connection is not None):
+            self.groundcam = MamboGroundcam(self.drone_connection.ftp)
 
     def disconnect(self):
         """
@@ -750,6 +825,7 @@ class Mambo(Minidrone):
 
         :return: void
         """
+        self.stop_pcmd_scheduler()
         self.drone_connection.disconnect()
         if self.groundcam is not None:
             self.groundcam._close()
@@ -782,6 +858,7 @@ class Swing(Minidrone):
 
         :return: void
         """
+        self.stop_pcmd_scheduler()
         self.drone_connection.disconnect()
 
 
@@ -0,0 +1,150 @@
+"""
+Command encoder shared by the wifi and BLE connections.  The argument types come from the protocol
+XML and each command is compiled once into a struct.Struct plus a preallocated bytearray frame, so
+sending a command only writes the sequence number and the argument values into the template.
+
+Author: Amy McGovern, dramymcgovern@gmail.com
+"""
+import struct
+from pyparrot.commandsandsensors.DroneProtocol import get_drone_protocol
+
+# struct format characters for the fixed size argument types
+# enums are always sent as 32 bit integers
+_command_format_chars = {
+    "u8": "B", "i8": "b",
+    "u16": "H", "i16": "h",
+    "u32": "I", "i32": "i",
+    "u64": "Q", "i64": "q",
+    "float": "f", "double": "d",
+    "enum": "i",
+}
+
+_command_id_struct = struct.Struct("<BBH")
+
+
+class DroneCommandEncoder:
+    def __init__(self, header_format, has_frame_size):
+        """
+        Create an encoder for one transport.  The transport header is laid out as the channel values
+        (given to add_channel), then the sequence number (one byte), then (optionally) the size of the
+        whole frame as a 32 bit integer.
+
+        wifi uses "<BBBI" (data type, buffer id, sequence number, frame size) and
+        BLE uses "<BB" (data type, sequence number).
+
+        :param header_format: struct format of the transport header
+        :param has_frame_size: True if the last header field is the size of the whole frame
+        """
+        self.header_struct = struct.Struct(header_format)
+        self.has_frame_size = has_frame_size
+
+        # byte offset of the sequence number inside the header
+        self.seq_offset = self.header_struct.size - 1
+        if (has_frame_size):
+            self.seq_offset -= 4
+
+        self.protocol = get_drone_protocol()
+
+        # channel name -> header values that never change for that channel
+        self.channels = dict()
+
+        # (channel, command tuple, arg types) -> (frame template, argument struct)
+        self.templates = dict()
+
+    def add_channel(self, channel, header_values):
+        """
+        Register the constant header values (everything before the sequence number) for a channel
+
+        :param channel: name of the channel (e.g. 'SEND_WITH_ACK')
+        :param header_values: tuple of the header values that come before the sequence number
+        :return: nothing
+        """
+        self.channels[channel] = tuple(header_values)
+
+    def get_arg_types(self, command_tuple):
+        """
+        Return the argument types for a command from the protocol XML
+
+        :param command_tuple: (project_id, class_id, cmd_id)
+        :return: tuple of argument type strings (empty if the command is unknown)
+        """
+        command_info = self.protocol.get_command_by_id(*command_tuple)
+        if (command_info is None):
+            return ()
+        return command_info[2]
+
+    def _compile(self, channel, command_tuple, arg_types):
+        """
+        Build the frame template and argument struct for a command on a channel
+
+        :return: (template, argument struct) or None if the command has variable size (string) arguments
+        """
+        try:
+            arg_struct = struct.Struct("<" + "".join(_command_format_chars[arg_type] for arg_type in arg_types))
+        except KeyError:
+            return None
+
+        frame_size = self.header_struct.size + _command_id_struct.size + arg_struct.size
+        header_values = self.channels[channel] + (0,)
+        if (self.has_frame_size):
+            header_values += (frame_size,)
+
+        template = bytearray(frame_size)
+        self.header_struct.pack_into(template, 0, *header_values)
+        _command_id_struct.pack_into(template, self.header_struct.size, *command_tuple)
+
+        return (template, arg_struct)
+
+    def encode(self, channel, seq, command_tuple, args=(), arg_types=None):
+        """
+        Encode a command frame.
+
+        The returned bytearray is reused the next time the same command is encoded on the same channel,
+        so send it right away (or copy it with bytes() if it needs to be kept, e.g. for retransmission).
+
+        :param channel: name of the channel (registered with add_channel)
+        :param seq: sequence number for the frame
+        :param command_tuple: (project_id, class_id, cmd_id) from the command parser
+        :param args: the argument values
+        :param arg_types: optional argument type strings (looked up in the XML if None)
+        :return: the encoded frame
+        """
+        if (arg_types is None):
+            arg_types = self.get_arg_types(command_tuple)
+        else:
+            arg_types = tuple(arg_types[:len(args)])
+
+        key = (channel, command_tuple, arg_types)
+        compiled = self.templates.get(key)
+        if (compiled is None):
+            compiled = self._compile(channel, command_tuple, arg_types)
+            if (compiled is None):
+                return self._encode_variable_size(channel, seq, command_tuple, args, arg_types)
+            self.templates[key] = compiled
+
+        (template, arg_struct) = compiled
+        template[self.seq_offset] = seq
+        if (args):
+            arg_struct.pack_into(template, self.header_struct.size + 4, *args)
+
+        return template
+
+    def _encode_variable_size(self, channel, seq, command_tuple, args, arg_types):
+        """
+        Slow path for commands with string arguments (null terminated UTF-8).  These are not cached.
+
+        :return: the encoded frame
+        """
+        arg_bytes = bytearray()
+        for (arg, arg_type) in zip(args, arg_types):
+            if (arg_type == "string"):
+                arg_bytes += arg.encode("utf-8") + b"\0"
+            else:
+                arg_bytes += struct.pack("<" + _command_format_chars[arg_type], arg)
+
+        frame_size = self.header_struct.size + _command_id_struct.size + len(arg_bytes)
+        header_values = self.channels[channel] + (seq,)
+        if (self.has_frame_size):
+            header_values += (frame_size,)
+
+        return bytearray(self.header_struct.pack(*header_values) + _command_id_struct.pack(*command_tuple)) + arg_bytes
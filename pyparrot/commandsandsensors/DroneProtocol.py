@@ -0,0 +1,245 @@
+"""
+Process-wide registry of the ARSDK protocol (commands, sensors, argument types and enums).
+
+The XML files are parsed once per process and flattened into dictionaries so that both the
+command parser and the sensor parser can do O(1) lookups by name or by id.  The untangle trees
+are thrown away as soon as the tables are built so every drone object in the process shares
+the same (small) tables instead of holding its own copy of the XML.
+
+The flattened tables are also saved (with marshal) in a user cache directory, keyed by a hash
+of the XML files, so later processes skip the XML parsing entirely.  The cache is rebuilt
+automatically whenever the XML changes.  Set PYPARROT_CACHE_DIR to move the cache.
+
+Author: Amy McGovern, dramymcgovern@gmail.com
+"""
+import untangle
+import threading
+import hashlib
+import marshal
+import sys
+import os
+from os.path import join
+from pyparrot.utils.colorPrint import color_print
+
+# the XML files (projects) that pyparrot knows how to talk to
+PROTOCOL_FILES = ('common.xml', 'ardrone3.xml', 'minidrone.xml')
+
+# bump this if the layout of the cached tables changes
+CACHE_FORMAT_VERSION = 1
+
+
+def get_cache_dir():
+    """
+    Return the directory used for the precompiled protocol tables
+
+    :return: path to the cache directory (it may not exist yet)
+    """
+    if ("PYPARROT_CACHE_DIR" in os.environ):
+        return os.environ["PYPARROT_CACHE_DIR"]
+
+    if (sys.platform.startswith("win") and "LOCALAPPDATA" in os.environ):
+        return join(os.environ["LOCALAPPDATA"], "pyparrot", "Cache")
+
+    cache_home = os.environ.get("XDG_CACHE_HOME", join(os.path.expanduser("~"), ".cache"))
+    return join(cache_home, "pyparrot")
+
+
+class DroneProtocol:
+    def __init__(self, xml_files=PROTOCOL_FILES, use_cache=True):
+        """
+        Load the lookup tables from the on-disk cache or parse the protocol XML files to build them.
+        Normally you do not create this directly: call get_drone_protocol() to share one instance
+        across the whole process.
+
+        :param xml_files: names of the XML files (in this directory) to load
+        :param use_cache: set to False to always parse the XML (and not touch the on-disk cache)
+        """
+        # project name -> project id
+        self.project_ids = dict()
+
+        # (project, class, cmd) names -> (project_id, class_id, cmd_id)
+        self.command_ids = dict()
+
+        # (project, class, cmd, enum name) -> enum index (first enum argument that has that name)
+        self.command_enum_ids = dict()
+
+        # (project_id, class_id, cmd_id) -> (cmd name, arg names, arg types, arg enums)
+        # arg enums holds a tuple of enum names for enum arguments and None otherwise
+        self.commands_by_id = dict()
+
+        # grab module path per http://www.karoltomala.com/blog/?p=622
+        path = os.path.abspath(__file__)
+        dir_path = os.path.dirname(path)
+        xml_paths = [join(dir_path, xml_file) for xml_file in xml_files]
+
+        self.cache_file = None
+        self.loaded_from_cache = False
+
+        if (use_cache):
+            self.cache_file = join(get_cache_dir(), "protocol-%s.marshal" % self._hash_xml_files(xml_paths))
+            self.loaded_from_cache = self._load_cache()
+
+        if (not self.loaded_from_cache):
+            for xml_path in xml_paths:
+                self._load_project(untangle.parse(xml_path))
+
+            if (use_cache):
+                self._save_cache()
+
+    def _hash_xml_files(self, xml_paths):
+        """
+        Hash the XML files (plus the python and cache versions since marshal is version specific)
+
+        :param xml_paths: full paths to the XML files
+        :return: hex digest naming the cache file
+        """
+        xml_hash = hashlib.sha1()
+        xml_hash.update(("%d.%d-%d" % (sys.version_info[0], sys.version_info[1], CACHE_FORMAT_VERSION)).encode('utf-8'))
+        for xml_path in xml_paths:
+            with open(xml_path, 'rb') as xml_file:
+                xml_hash.update(xml_file.read())
+
+        return xml_hash.hexdigest()
+
+    def _load_cache(self):
+        """
+        Load the tables from the cache file
+
+        :return: True if the cache was loaded and False if it is missing or unreadable
+        """
+        try:
+            with open(self.cache_file, 'rb') as cache:
+                (self.project_ids, self.command_ids,
+                 self.command_enum_ids, self.commands_by_id) = marshal.loads(cache.read())
+            return True
+        except Exception:
+            return False
+
+    def _save_cache(self):
+        """
+        Save the tables to the cache file.  Failures are ignored (the cache is only an optimization).
+
+        :return: nothing
+        """
+        tables = (self.project_ids, self.command_ids, self.command_enum_ids, self.commands_by_id)
+        tmp_file = "%s.%d.tmp" % (self.cache_file, os.getpid())
+
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(tmp_file, 'wb') as cache:
+                cache.write(marshal.dumps(tables))
+
+            # write then rename so another process never sees a half written cache
+            os.replace(tmp_file, self.cache_file)
+        except Exception:
+            color_print("Could not write the protocol cache to %s" % self.cache_file, "WARN")
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+
+    def _load_project(self, project_xml):
+        """
+        Flatten one parsed XML project into the lookup tables
+
+        :param project_xml: untangle tree for one of the protocol files
+        :return: nothing
+        """
+        project_name = project_xml.project['name']
+        project_id = int(project_xml.project['id'])
+        self.project_ids[project_name] = project_id
+
+        # older XML files call the classes myclass and newer ones call them class (which untangle renames to class_)
+        myclasses = project_xml.project.get_elements('myclass') + project_xml.project.get_elements('class_')
+
+        for myclass in myclasses:
+            class_name = myclass['name']
+            class_id = int(myclass['id'])
+
+            for cmd in myclass.get_elements('cmd'):
+                cmd_name = cmd['name']
+                cmd_id = int(cmd['id'])
+
+                arg_names = list()
+                arg_types = list()
+                arg_enums = list()
+                for arg in cmd.get_elements('arg'):
+                    arg_names.append(arg['name'])
+                    arg_types.append(arg['type'])
+
+                    if (arg['type'] == 'enum'):
+                        enum_names = tuple(e['name'] for e in arg.get_elements('enum'))
+                        arg_enums.append(enum_names)
+
+                        for e_idx, enum_name in enumerate(enum_names):
+                            enum_key = (project_name, class_name, cmd_name, enum_name)
+                            if (enum_key not in self.command_enum_ids):
+                                self.command_enum_ids[enum_key] = e_idx
+                    else:
+                        arg_enums.append(None)
+
+                id_tuple = (project_id, class_id, cmd_id)
+                self.command_ids[(project_name, class_name, cmd_name)] = id_tuple
+                self.commands_by_id[id_tuple] = (cmd_name, tuple(arg_names), tuple(arg_types), tuple(arg_enums))
+
+    def get_project_id(self, project):
+        """
+        Return the id of the named project (common, ardrone3, minidrone)
+
+        :param project: project name
+        :return: the project id or None if the project is unknown
+        """
+        return self.project_ids.get(project)
+
+    def get_command_tuple(self, project, myclass, cmd):
+        """
+        Look up the id tuple for a command by name
+
+        :param project: project name in the xml files
+        :param myclass: class name (renamed to myclass to avoid reserved name) in the xml file
+        :param cmd: command name in the xml file
+        :return: (project_id, class_id, cmd_id) or None if the command is unknown
+        """
+        return self.command_ids.get((project, myclass, cmd))
+
+    def get_enum_id(self, project, myclass, cmd, enum_name):
+        """
+        Look up the index of an enum value for a command
+
+        :param project: project name in the xml files
+        :param myclass: class name in the xml file
+        :param cmd: command name in the xml file
+        :param enum_name: name of the enum value
+        :return: the enum index or None if the enum is unknown
+        """
+        return self.command_enum_ids.get((project, myclass, cmd, enum_name))
+
+    def get_command_by_id(self, project_id, class_id, cmd_id):
+        """
+        Look up a command (or sensor) by its ids
+
+        :return: (cmd name, arg names, arg types, arg enums) or None if the ids are unknown
+        """
+        return self.commands_by_id.get((project_id, class_id, cmd_id))
+
+
+# one shared protocol for the whole process (built lazily the first time it is needed)
+_drone_protocol = None
+_drone_protocol_lock = threading.Lock()
+
+
+def get_drone_protocol():
+    """
+    Return the process-wide DroneProtocol, parsing the XML the first time it is called.
+    Safe to call from multiple threads.
+
+    :return: the shared DroneProtocol
+    """
+    global _drone_protocol
+
+    if (_drone_protocol is None):
+        with _drone_protocol_lock:
+            if (_drone_protocol is None):
+                _drone_protocol = DroneProtocol()
+
+    return _drone_protocol
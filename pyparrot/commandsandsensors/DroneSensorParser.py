@@ -3,144 +3,216 @@ Sensor parser class:  handles the XML parsing and gets the values but the actual
 since it knows what to do with it.
 """
 import struct
-import untangle
 from pyparrot.utils.colorPrint import color_print
-import os
-from os.path import join
+from pyparrot.commandsandsensors.DroneProtocol import get_drone_protocol
 
-def get_data_format_and_size(data, data_type):
+# struct format characters for the fixed size argument types (strings are handled separately)
+_sensor_format_chars = {
+    "u8": "B", "enum": "B", "i8": "b",
+    "u16": "H", "i16": "h",
+    "u32": "I", "i32": "i",
+    "u64": "Q", "i64": "q",
+    "float": "f", "double": "d",
+}
+
+# markers used in a compiled decoder for the arguments that are not fixed size numbers
+_STRING_ARG = "string"
+_FLAG_ARG = "flag"
+
+_header_struct = struct.Struct("<BBH")
+
+
+def compile_sensor_decoder(data_types):
+    """
+    Compile the argument types of one sensor message into a decoder so the whole message can be
+    unpacked at once instead of one argument at a time.
+
+    Consecutive fixed size arguments are merged into a single struct.Struct.  Strings (null terminated)
+    and arguments with no data (pure notifications, which report True) are kept as markers between them.
+
+    :param data_types: list of argument type strings (from the XML) for the message
+    :return: a function that takes the raw packet and returns a tuple of values (one per argument)
+    """
+    segments = list()
+    format_chars = ""
+
+    for data_type in data_types:
+        format_char = _sensor_format_chars.get(data_type)
+        if (format_char is not None):
+            format_chars += format_char
+            continue
+
+        if (format_chars):
+            segments.append(struct.Struct("<" + format_chars))
+            format_chars = ""
+
+        if (data_type == "string"):
+            segments.append(_STRING_ARG)
+        else:
+            segments.append(_FLAG_ARG)
+
+    if (format_chars):
+        segments.append(struct.Struct("<" + format_chars))
+
+    # fast path: the entire message is fixed size so it is one unpack call
+    if (len(segments) == 1 and isinstance(segments[0], struct.Struct)):
+        message_struct = segments[0]
+        return lambda data: message_struct.unpack_from(data, 4)
+
+    has_strings = _STRING_ARG in segments
+
+    def decode(data):
+        # memoryviews (from the wifi receive buffer) have no find() so strings are searched in a copy
+        if (has_strings and not isinstance(data, bytes)):
+            data = bytes(data)
+
+        values = list()
+        offset = 4
+        for segment in segments:
+            if (segment is _STRING_ARG):
+                end = data.find(b"\0", offset)
+                if (end == -1):
+                    end = len(data)
+                values.append(data[offset:end].decode("utf-8", "replace"))
+                offset = end + 1
+            elif (segment is _FLAG_ARG):
+                # this is usually a boolean flag stating that values have changed so set the value to True
+                values.append(True)
+            else:
+                values.extend(segment.unpack_from(data, offset))
+                offset += segment.size
+        return tuple(values)
+
+    return decode
+
+
+def decode_sensor_arguments(data, data_types):
+    """
+    Decode the arguments of one sensor message one at a time.  Slower than a compiled decoder but an argument
+    that can not be decoded (e.g. the packet is cut short) only makes that argument None, so the good values
+    next to it are kept.
+
+    :param data: the raw packet (header included)
+    :param data_types: list of argument type strings (from the XML) for the message
+    :return: tuple of values (one per argument)
     """
-    Internal function to convert data_type to the corresponding struct.pack format string
-    as per https://docs.python.org/2/library/struct.html#format-characters
+    values = list()
+    offset = 4
+    for data_type in data_types:
+        try:
+            format_char = _sensor_format_chars.get(data_type)
+            if (format_char is not None):
+                value_struct = struct.Struct("<" + format_char)
+                values.append(value_struct.unpack_from(data, offset)[0])
+                offset += value_struct.size
+            elif (data_type == "string"):
+                raw = bytes(data[offset:])
+                end = raw.find(b"\0")
+                if (end == -1):
+                    end = len(raw)
+                values.append(raw[:end].decode("utf-8", "replace"))
+                offset += end + 1
+            else:
+                # this is usually a boolean flag stating that values have changed so set the value to True
+                values.append(True)
+        except Exception as e:
+            color_print("Error parsing data for sensor argument of type %s: %s" % (data_type, e), "ERROR")
+            values.append(None)
+
+    return tuple(values)
 
-    Function contributed by awm102 on GitHub.  Amy moved this to DroneSensorParser to be
-    more general, edited a bit to fit within the drone sensor parser as well.
 
-    :param data: the data that will be packed. Not actually used here unless the data_type is string, then
-                 it is used to calculate the data size.
-    :param data_type: a string representing the data type
-    :return: a tuple of a string representing the struct.pack format for the data type and an int representing
-             the number of bytes
+def make_sensor_handler(sensors, sensor_name, sensor_enum, save_in_dict=True, attribute=None, flag=None):
     """
+    Build the function that stores the value of one sensor, so the update of the sensors is a single lookup
+    and call instead of comparing the name against every sensor it knows.  It is built the first time the
+    sensor arrives (after the parser has registered its enum strings).
 
-    if data_type == "u8" or data_type == "enum":
-        format_char = "<B"
-        data_size = 1
-    elif data_type == "i8":
-        format_char = "<b"
-        data_size = 1
-    elif data_type == "u16":
-        format_char = "<H"
-        data_size = 2
-    elif data_type == "i16":
-        format_char = "<h"
-        data_size = 2
-    elif data_type == "u32":
-        format_char = "<I"
-        data_size = 4
-    elif data_type == "i32":
-        format_char = "<i"
-        data_size = 4
-    elif data_type == "u64":
-        format_char = "<Q"
-        data_size = 8
-    elif data_type == "i64":
-        format_char = "<q"
-        data_size = 8
-    elif data_type == "float":
-        format_char = "<f"
-        data_size = 4
-    elif data_type == "double":
-        format_char = "<d"
-        data_size = 8
-    elif data_type == "string":
-        format_char = "<s"
-        data_size = len(data)
-    else:
-        format_char = ""
-        data_size = 0
-
-    return (format_char, data_size)
+    :param sensors: the object holding the sensors (it has a sensors_dict)
+    :param sensor_name: name of the sensor
+    :param sensor_enum: enum lists from the parser (an enum sensor stores the string of its value)
+    :param save_in_dict: True to save the value in sensors.sensors_dict
+    :param attribute: name of an attribute of sensors to set to the value (None for none)
+    :param flag: name of an attribute of sensors to set to True when the sensor arrives (None for none)
+    :return: function(value)
+    """
+    enum_values = sensor_enum.get((sensor_name, "enum"))
+    sensors_dict = sensors.sensors_dict
+
+    def handle(value):
+        if (enum_values is not None):
+            # grab the string value
+            if (value is None or value >= len(enum_values)):
+                value = "UNKNOWN_ENUM_VALUE"
+            else:
+                value = enum_values[value]
+
+        if (save_in_dict):
+            sensors_dict[sensor_name] = value
+        if (attribute is not None):
+            setattr(sensors, attribute, value)
+        if (flag is not None):
+            setattr(sensors, flag, True)
+
+    return handle
 
 
 class DroneSensorParser:
     def __init__(self, drone_type):
-        # grab module path per http://www.karoltomala.com/blog/?p=622
-        path = os.path.abspath(__file__)
-        dir_path = os.path.dirname(path)
-
-        self.common_sensors = untangle.parse(join(dir_path, 'common.xml'))
+        # the sensor XML is parsed once per process and shared by every drone and parser
+        self.protocol = get_drone_protocol()
 
+        # only decode the sensors for this drone's project (plus the common ones)
         if (drone_type == "Minidrone"):
-            self.drone_sensors = untangle.parse(join(dir_path, 'minidrone.xml'))
+            drone_project_id = self.protocol.get_project_id("minidrone")
         else:
-            self.drone_sensors = untangle.parse(join(dir_path, 'ardrone3.xml'))
+            drone_project_id = self.protocol.get_project_id("ardrone3")
 
-        self.project_xmls = (self.drone_sensors, self.common_sensors)
+        self.project_ids = (drone_project_id, self.protocol.get_project_id("common"))
 
         self.sensor_tuple_cache = dict()
 
+        # compiled decoders for each (project, class, cmd) as (sensor names, decoder function)
+        self.sensor_decoder_cache = dict()
+
     def extract_sensor_values(self, data):
         """
         Extract the sensor values from the data in the BLE packet
         :param data: BLE packet of sensor data
         :return: a list of tuples of (sensor name, sensor value, sensor enum, header_tuple)
         """
-        sensor_list = []
-        #print("updating sensors with ")
         try:
-            header_tuple = struct.unpack_from("<BBH", data)
-        except:
+            header_tuple = _header_struct.unpack_from(data)
+        except struct.error:
             color_print("Error: tried to parse a bad sensor packet", "ERROR")
             return None
 
-        #print(header_tuple)
-        (names, data_sizes) = self._parse_sensor_tuple(header_tuple)
-        #print("name of sensor is %s" % names)
-        #print("data size is %s" % data_sizes)
-
-        packet_offset = 4
-        if names is not None:
-            for idx, name in enumerate(names):
-                data_size = data_sizes[idx]
-                try:
-                    # figure out how to parse the data
-                    (format_string, new_offset) = get_data_format_and_size(data[packet_offset:], data_size)
-
-                    if (new_offset == 0):
-                        # this is usually a boolean flag stating that values have changed so set the value to True
-                        # and let it return the name
-                        sensor_data = True
-                    else:
-                        # real data, parse it
-                        sensor_data = struct.unpack_from(format_string, data, offset=packet_offset)
-                        sensor_data = sensor_data[0]
-                        if (data_size == "string"):
-                            packet_offset += len(sensor_data)
-                        else:
-                            packet_offset += new_offset
-                except Exception as e:
-                    sensor_data = None
-                    #print(header_tuple)
-                    color_print("Error parsing data for sensor", "ERROR")
-                    print(e)
-                    print("name of sensor is %s" % names)
-                    print("data size is %s" % data_sizes)
-                    print(len(data))
-                    print(4*(idx+1))
-
-                #print("%s %s %s" % (name,idx,sensor_data))
-                #color_print("updating the sensor!", "NONE")
-                sensor_list.append([name, sensor_data, self.sensor_tuple_cache, header_tuple])
-
-            return sensor_list
+        # compile the decoder the first time we see this sensor
+        decoder_info = self.sensor_decoder_cache.get(header_tuple)
+        if (decoder_info is None):
+            (names, data_sizes) = self._parse_sensor_tuple(header_tuple)
+            if (names is None):
+                decoder_info = (None, None, None)
+            else:
+                decoder_info = (names, compile_sensor_decoder(data_sizes), data_sizes)
+            self.sensor_decoder_cache[header_tuple] = decoder_info
 
-        else:
+        (names, decoder, data_sizes) = decoder_info
+        if (names is None):
             #color_print("Could not find sensor in list - ignoring for now.  Packet info below.", "ERROR")
             #print(header_tuple)
-            #print(names)
             return None
 
+        try:
+            values = decoder(data)
+        except Exception as e:
+            # decode the arguments one at a time so only the bad ones are lost
+            color_print("Error parsing data for sensor %s: %s" % (names, e), "ERROR")
+            values = decode_sensor_arguments(data, data_sizes)
+
+        sensor_enum = self.sensor_tuple_cache
+        return [(name, value, sensor_enum, header_tuple) for (name, value) in zip(names, values)]
+
     def _parse_sensor_tuple(self, sensor_tuple):
         """
         Parses the sensor information from the command id bytes and returns the name
@@ -156,47 +228,35 @@ class DroneSensorParser:
         if (project_id, myclass_id, cmd_id) in self.sensor_tuple_cache:
             return self.sensor_tuple_cache[(project_id, myclass_id, cmd_id)]
 
-        for project_xml in self.project_xmls:
-            #color_print("looking for project id %d in %s" % (project_id, project_xml))
-            if (project_id == int(project_xml.project['id'])):
-                #color_print("looking for myclass_id %d" % myclass_id)
-                for c in project_xml.project.myclass:
-                    #color_print("looking for cmd_id %d" % cmd_id)
-                    if int(c['id']) == myclass_id:
-                        for cmd_child in c.cmd:
-                            if int(cmd_child['id']) == cmd_id:
-                                cmd_name = cmd_child['name']
-                                sensor_names = list()
-                                data_sizes = list()
-
-                                if (hasattr(cmd_child, 'arg')):
-                                    for arg_child in cmd_child.arg:
-                                        sensor_name = cmd_name + "_" + arg_child['name']
-                                        data_size = arg_child['type']
-
-                                        # special case, if it is an enum, need to add the enum mapping into the cache
-                                        if (data_size == 'enum'):
-                                            enum_names = list()
-                                            for eitem in arg_child.enum:
-                                                #color_print(eitem)
-                                                enum_names.append(eitem['name'])
-                                            self.sensor_tuple_cache[sensor_name, "enum"] = enum_names
-                                            #color_print("added to sensor cache %s" % enum_names)
-
-                                        # save the name and sizes to a list
-                                        sensor_names.append(sensor_name)
-                                        data_sizes.append(data_size)
-                                else:
-                                    # there is no sub-child argument meaning this is just a pure notification
-                                    # special case values just use the command name and None for size
-                                    sensor_names.append(cmd_name)
-                                    data_sizes.append(None)
-
-                                # cache the results
-                                self.sensor_tuple_cache[(project_id, myclass_id, cmd_id)] = (
-                                sensor_names, data_sizes)
-                                return (sensor_names, data_sizes)
+        if (project_id in self.project_ids):
+            command_info = self.protocol.get_command_by_id(project_id, myclass_id, cmd_id)
+
+            if (command_info is not None):
+                (cmd_name, arg_names, arg_types, arg_enums) = command_info
+                sensor_names = list()
+                data_sizes = list()
+
+                if (len(arg_names) > 0):
+                    for idx, arg_name in enumerate(arg_names):
+                        sensor_name = cmd_name + "_" + arg_name
+                        data_size = arg_types[idx]
+
+                        # special case, if it is an enum, need to add the enum mapping into the cache
+                        if (data_size == 'enum'):
+                            self.sensor_tuple_cache[sensor_name, "enum"] = list(arg_enums[idx])
+
+                        # save the name and sizes to a list
+                        sensor_names.append(sensor_name)
+                        data_sizes.append(data_size)
+                else:
+                    # there is no sub-child argument meaning this is just a pure notification
+                    # special case values just use the command name and None for size
+                    sensor_names.append(cmd_name)
+                    data_sizes.append(None)
 
+                # cache the results
+                self.sensor_tuple_cache[(project_id, myclass_id, cmd_id)] = (sensor_names, data_sizes)
+                return (sensor_names, data_sizes)
 
         # didn't find it, return an error
         # cache the results
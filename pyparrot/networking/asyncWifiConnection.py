@@ -0,0 +1,354 @@
+"""
+asyncio version of the wifi connection.  The UDP traffic is handled by an asyncio.DatagramProtocol and the
+handshake uses asyncio.open_connection, so one event loop can drive many drones without a thread per drone.
+
+The packet encoding and the handling of the incoming frames are shared with WifiConnection.
+
+Author: Amy McGovern, dramymcgovern@gmail.com
+"""
+import asyncio
+import ipaddress
+import socket
+import time
+from pyparrot.utils.colorPrint import color_print
+from pyparrot.networking.wifiConnection import WifiConnection
+
+
+class DroneDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    Hands every datagram from the drone (d2c port) to the connection
+    """
+    def __init__(self, wifi_connection):
+        self.wifi_connection = wifi_connection
+
+    def datagram_received(self, data, addr):
+        self.wifi_connection.handle_data(data)
+
+    def error_received(self, exc):
+        color_print("UDP error: %s" % exc, "ERROR")
+
+
+class AsyncWifiConnection(WifiConnection):
+    """
+    Wifi connection for asyncio.  Everything runs in the event loop: connect, disconnect, smart_sleep and the
+    commands that wait for an ack are coroutines.  Commands that are not acked (PCMD, high priority) are sent
+    right away and are normal methods, as in WifiConnection.
+
+    Because _send_ack_command is a coroutine here, the ack senders inherited from WifiConnection
+    (send_noparam_command_packet_ack, send_param_command_packet with ack=True, send_enum_command_packet_ack,
+    send_turn_command) return something to await.
+
+    The send queues and the frame dispatcher are never started: everything already runs on the event loop
+    thread, so each frame is sent as soon as it is queued and parsed as soon as it arrives.
+    """
+    def __init__(self, drone, drone_type="Bebop2", ip_address=None, d2c_port=43210, source_address=None,
+                 bind_interface=None):
+        """
+        :param drone: the drone object (its update_sensors is called for every sensor frame)
+        :param drone_type: type of drone to connect to
+        :param ip_address: IP address of the drone (found with mDNS if None)
+        :param d2c_port: local UDP port for the data from the drone.  Use 0 to let the OS pick a free port
+                         (needed to run several drones from one machine)
+        :param source_address: optional local IP address to send and receive from
+        :param bind_interface: optional network interface name (e.g. wlan1) to send and receive on
+        """
+        WifiConnection.__init__(self, drone, drone_type=drone_type, ip_address=ip_address,
+                                source_address=source_address, bind_interface=bind_interface)
+        self.udp_receive_port = d2c_port
+
+        self.transport = None
+
+        # (channel, sequence id) -> future that is set when the ack arrives
+        self._ack_futures = dict()
+
+    async def connect(self, num_retries):
+        """
+        Connects to the drone
+
+        :param num_retries: maximum number of retries
+        :return: True if the connection succeeded and False otherwise
+        """
+        loop = asyncio.get_running_loop()
+
+        if (self.ip_address is None) and ("Mambo" not in self.drone_type):
+            # zeroconf blocks so keep it out of the event loop
+            found = await loop.run_in_executor(None, self._discover_with_mdns, num_retries)
+            if (not found):
+                return False
+
+        # bind the d2c port first so the handshake can tell the drone which port we got
+        await self._create_udp_connection()
+
+        handshake = await self._handshake(num_retries)
+        if (handshake):
+            self._save_profile()
+            self.is_listening = True
+            color_print("Success in setting up the wifi network to the drone!", "SUCCESS")
+            return True
+        else:
+            color_print("Error: TCP handshake failed.", "ERROR")
+            self.transport.close()
+            self.transport = None
+            return False
+
+    async def reconnect(self, num_retries=3):
+        """
+        Reconnect quickly after a short wifi drop: redo the handshake with the address the drone was last
+        reached at.  The UDP endpoint (d2c port) is kept, so the drone keeps sending to the same port.  Falls
+        back to mDNS if the drone moved and to a full connect if we were never connected.
+
+        :param num_retries: maximum number of retries
+        :return: True if the connection is back and False otherwise
+        """
+        if (self.handshake_address is None or self.transport is None):
+            return await self.connect(num_retries)
+
+        handshake = await self._try_handshake(self.handshake_address, num_retries)
+        if (not handshake and self.ip_address is None and "Mambo" not in self.drone_type):
+            found = await asyncio.get_running_loop().run_in_executor(None, self._discover_with_mdns, num_retries)
+            handshake = found and await self._try_handshake(self._get_handshake_address(), num_retries)
+
+        if (not handshake):
+            color_print("Error: could not reconnect to the drone", "ERROR")
+            return False
+
+        self._save_profile()
+
+        # the old round trip times say nothing about the new link
+        self.rtt_estimator.reset()
+        self.link_monitor.reset()
+
+        color_print("Reconnected to the drone", "SUCCESS")
+        return True
+
+    async def _try_handshake(self, address, num_retries):
+        """
+        Handshake with a known address, giving up after cached_connect_timeout seconds
+
+        :param address: (ip address, port) of the drone
+        :return: True if the handshake worked and False otherwise
+        """
+        try:
+            return await asyncio.wait_for(self._handshake(num_retries, address=address),
+                                          self.cached_connect_timeout)
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            color_print("handshake with %s:%d failed: %s" % (address[0], address[1], e), "WARN")
+            return False
+
+    async def _handshake(self, num_retries, timeout=5.0, address=None):
+        """
+        Performs the handshake over TCP to get all the connection info
+
+        :param num_retries: number of empty reads to allow before giving up
+        :param timeout: seconds to wait for each read
+        :param address: (ip address, port) to use (found from the drone type, ip_address or mDNS if None)
+        :return: True if it worked and False otherwise
+        """
+        if (address is None):
+            (address, port) = self._get_handshake_address()
+        else:
+            (address, port) = address
+            self.drone_ip = ipaddress.IPv4Address(address).exploded
+        if (self.source_address is None and self.bind_interface is None):
+            (reader, writer) = await asyncio.open_connection(address, port)
+        else:
+            sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+            self._bind_socket(sock, 0)
+            sock.setblocking(False)
+            await asyncio.get_running_loop().sock_connect(sock, (address, port))
+            (reader, writer) = await asyncio.open_connection(sock=sock)
+
+        try:
+            writer.write(bytes(self._get_handshake_json(), 'utf-8'))
+            await writer.drain()
+
+            num_try = 0
+            while (num_try < num_retries):
+                try:
+                    data = await asyncio.wait_for(reader.read(4096), timeout)
+                except asyncio.TimeoutError:
+                    data = b""
+
+                if (len(data) > 0):
+                    if (not self._handle_handshake_response(data.decode('utf-8'))):
+                        return False
+                    self.handshake_address = (self.drone_ip, port)
+                    return True
+
+                num_try += 1
+
+            return False
+        finally:
+            writer.close()
+
+    async def _create_udp_connection(self):
+        """
+        Bind the d2c port and create the datagram endpoint (also used to send to the drone)
+        """
+        loop = asyncio.get_running_loop()
+
+        sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._set_receive_buffer_size(sock)
+        self._bind_socket(sock, int(self.udp_receive_port))
+        self.udp_receive_port = sock.getsockname()[1]
+
+        (self.transport, protocol) = await loop.create_datagram_endpoint(lambda: DroneDatagramProtocol(self),
+                                                                         sock=sock)
+
+    async def disconnect(self):
+        """
+        Close the UDP endpoint
+        """
+        self.is_listening = False
+
+        for future in self._ack_futures.values():
+            future.cancel()
+        self._ack_futures.clear()
+
+        if (self.transport is not None):
+            self.transport.close()
+            self.transport = None
+
+    def safe_send(self, packet):
+        """
+        Send a packet to the drone (never blocks)
+
+        :param packet: the packet
+        """
+        if (self.transport is None):
+            color_print("Error: not connected", "ERROR")
+            return
+
+        self.transport.sendto(packet, (self.drone_ip, self.udp_send_port))
+
+    def _set_command_received(self, channel, val, seq_id):
+        """
+        Set the command received on the specified channel to the specified value (used for acks)
+        and wake up whoever is waiting for that ack
+
+        :param channel: channel
+        :param val: True or False
+        :param seq_id: sequence id of the command
+        """
+        self.command_received[(channel, seq_id)] = val
+        if (val):
+            self._ack_times[(channel, seq_id)] = time.monotonic()
+            future = self._ack_futures.get((channel, seq_id))
+            if (future is not None and not future.done()):
+                future.set_result(True)
+
+    async def _wait_for_command_received(self, channel, seq_id, timeout):
+        """
+        Wait until the command is acked or the timeout expires
+
+        :param channel: channel it was sent on
+        :param seq_id: sequence id of the command
+        :param timeout: maximum number of seconds to wait
+        :return: True if the command was acked and False otherwise
+        """
+        if (self._is_command_received(channel, seq_id)):
+            return True
+
+        future = asyncio.get_running_loop().create_future()
+        self._ack_futures[(channel, seq_id)] = future
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if (self._ack_futures.get((channel, seq_id)) is future):
+                del self._ack_futures[(channel, seq_id)]
+
+        return self._is_command_received(channel, seq_id)
+
+    def _encode_ack_command(self, command_tuple, param_tuple=(), param_type_tuple=None):
+        """
+        Encode a command for the ack channel with the next sequence id
+
+        :return: (packet, sequence id)
+        """
+        seq_id = self._next_sequence('SEND_WITH_ACK')
+        packet = self.command_encoder.encode('SEND_WITH_ACK', seq_id, command_tuple, param_tuple, param_type_tuple)
+        return (bytes(packet), seq_id)
+
+    async def _send_ack_command(self, command_tuple, param_tuple=(), param_type_tuple=None):
+        """
+        Send a command on the ack channel and wait for the ack (resending it if needed)
+
+        :return: True if the command was acked and False otherwise
+        """
+        (packet, seq_id) = self._encode_ack_command(command_tuple, param_tuple, param_type_tuple)
+        return await self.send_command_packet_ack(packet, seq_id)
+
+    async def send_command_packet_ack(self, packet, seq_id):
+        """
+        Sends the packet on the ack channel and waits for the ack (resending after the adaptive timeout)
+
+        :param packet: packet constructed according to the command rules
+        :param seq_id: sequence id of the packet
+        :return: True if the command was acked and False otherwise
+        """
+        try_num = 0
+        self._set_command_received('SEND_WITH_ACK', False, seq_id)
+        while (try_num < self.max_packet_retries and not self._is_command_received('SEND_WITH_ACK', seq_id)):
+            send_time = time.monotonic()
+            self.safe_send(packet)
+            try_num += 1
+
+            if (await self._wait_for_command_received('SEND_WITH_ACK', seq_id, self.rtt_estimator.get_rto())):
+                self._add_rtt_sample('SEND_WITH_ACK', seq_id, send_time, try_num)
+            else:
+                self.rtt_estimator.backoff()
+
+        return self._is_command_received('SEND_WITH_ACK', seq_id)
+
+    async def send_command_batch_ack(self, commands, window_size=None, ordered=False):
+        """
+        Send several commands on the ack channel with up to window_size of them waiting for their ack
+        at once (see WifiConnection.send_command_batch_ack)
+
+        :param commands: list of (command_tuple,), (command_tuple, param_tuple) or
+                         (command_tuple, param_tuple, param_type_tuple)
+        :param window_size: maximum number of unacked commands in flight (defaults to ack_window_size)
+        :param ordered: set to True to wait for each ack before sending the next command
+        :return: True if every command was acked and False otherwise
+        """
+        if (ordered):
+            window_size = 1
+        elif (window_size is None):
+            window_size = self.ack_window_size
+
+        window = asyncio.Semaphore(window_size)
+
+        async def send_one(command):
+            async with window:
+                (packet, seq_id) = self._encode_ack_command(*command)
+                return await self.send_command_packet_ack(packet, seq_id)
+
+        results = await asyncio.gather(*[send_one(command) for command in commands])
+        return all(results)
+
+    async def send_pcmd_command(self, command_tuple, roll, pitch, yaw, vertical_movement, duration):
+        """
+        Send the PCMD command every 0.1 seconds for duration seconds
+
+        :param command_tuple: command tuple per the parser
+        :param roll:
+        :param pitch:
+        :param yaw:
+        :param vertical_movement:
+        :param duration:
+        """
+        end_time = time.monotonic() + duration
+        while (time.monotonic() < end_time):
+            self.send_single_pcmd_command(command_tuple, roll, pitch, yaw, vertical_movement)
+            await asyncio.sleep(min(0.1, max(0, end_time - time.monotonic())))
+
+    async def smart_sleep(self, timeout):
+        """
+        Sleep without blocking the event loop (the datagrams keep being handled)
+
+        :param timeout: number of seconds to sleep
+        """
+        await asyncio.sleep(timeout)
@@ -1,17 +1,29 @@
-from bluepy.btle import Peripheral, UUID, DefaultDelegate, BTLEException
+from bluepy.btle import Peripheral, UUID, DefaultDelegate, BTLEException, Characteristic
 from pyparrot.utils.colorPrint import color_print
 import struct
 import time
-from pyparrot.commandsandsensors.DroneSensorParser import get_data_format_and_size
+import threading
+from collections import deque
+from pyparrot.commandsandsensors.DroneCommandEncoder import DroneCommandEncoder
+from pyparrot.networking.rttEstimator import RTTEstimator
+from pyparrot.networking.connectionProfile import BLEHandleCache
+from pyparrot.networking.bleFtp import BLEFtp
 from datetime import datetime
 
+# states of the BLE link
+LINK_CONNECTED = "connected"
+LINK_RECONNECTING = "reconnecting"
+LINK_DISCONNECTED = "disconnected"
+
+
 class MinidroneDelegate(DefaultDelegate):
     """
     Handle BLE notififications
     """
-    def __init__(self, handle_map, minidrone, ble_connection):
+    def __init__(self, handle_map, minidrone, ble_connection, ftp_handle_map=None):
         DefaultDelegate.__init__(self)
         self.handle_map = handle_map
+        self.ftp_handle_map = ftp_handle_map if ftp_handle_map is not None else dict()
         self.minidrone = minidrone
         self.ble_connection = ble_connection
         color_print("initializing notification delegate", "INFO")
@@ -22,6 +34,10 @@ class MinidroneDelegate(DefaultDelegate):
         #print "channel map is %s " % self.minidrone.characteristic_receive_uuids[self.handle_map[cHandle]]
         #print "data is %s " % data
 
+        if cHandle in self.ftp_handle_map:
+            self.ble_connection.ftp.handle_notification(self.ftp_handle_map[cHandle], data)
+            return
+
         channel = self.ble_connection.characteristic_receive_uuids[self.handle_map[cHandle]]
 
         (packet_type, packet_seq_num) = struct.unpack('<BB', data[0:2])
@@ -48,6 +64,159 @@ class MinidroneDelegate(DefaultDelegate):
             color_print(cHandle)
 
 
+class BLEIOEngine:
+    """
+    Thread that owns the bluepy Peripheral once the minidrone is connected.  bluepy is not thread safe
+    and only handles notifications inside waitForNotifications, so every write and every notification goes
+    through this one thread.  Each pass of the loop writes the queued packets and then waits for
+    notifications for at most poll_timeout seconds, which bounds how long a write or a notification waits.
+
+    Commands are written in the order they were queued.  Only the newest PCMD is kept: a PCMD that has not
+    been written yet is replaced by the next one, since the drone only cares about the latest setpoint.
+    """
+    def __init__(self, ble_connection, poll_timeout=0.01):
+        """
+        :param ble_connection: the BLEConnection that owns the peripheral and the characteristics
+        :param poll_timeout: longest time (seconds) to wait for notifications before writing again
+        """
+        self.ble_connection = ble_connection
+        self.poll_timeout = poll_timeout
+
+        self._lock = threading.Lock()
+        self._command_queue = deque()
+        self._pcmd_packet = None
+        self._running = False
+        self.thread = None
+
+        self.num_writes = 0
+        self.num_pcmd_writes = 0
+        self.num_pcmd_replaced = 0
+        self.num_notifications = 0
+        self.max_loop_time = 0.0
+
+    def start(self):
+        """
+        Start the I/O thread
+
+        :return: nothing
+        """
+        self._running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Write anything still queued and stop the I/O thread
+
+        :return: nothing
+        """
+        self._running = False
+
+        # disconnect can be called from a sensor callback, which runs on the I/O thread itself
+        if (self.thread is not None and self.thread is not threading.current_thread()):
+            self.thread.join()
+        self.thread = None
+
+    def is_running(self):
+        """
+        :return: True if the I/O thread is running
+        """
+        return self._running
+
+    def in_io_thread(self):
+        """
+        :return: True if called from the I/O thread (e.g. from a sensor callback)
+        """
+        return (threading.current_thread() is self.thread)
+
+    def queue_write(self, channel, packet):
+        """
+        Queue a packet to be written on a send characteristic (returns right away)
+
+        :param channel: name of the send characteristic (e.g. 'SEND_WITH_ACK')
+        :param packet: the packet (bytes)
+        :return: nothing
+        """
+        with self._lock:
+            self._command_queue.append((channel, packet))
+
+    def queue_pcmd(self, packet):
+        """
+        Set the PCMD packet to write next, replacing one that was not written yet (returns right away).
+        PCMD packets are dropped while the link is down: an old setpoint is worse than none.
+
+        :param packet: the PCMD packet (bytes)
+        :return: nothing
+        """
+        if (self.ble_connection.link_state != LINK_CONNECTED):
+            self.ble_connection.num_pcmd_dropped += 1
+            return
+
+        with self._lock:
+            if (self._pcmd_packet is not None):
+                self.num_pcmd_replaced += 1
+            self._pcmd_packet = packet
+
+    def _write_pending(self):
+        with self._lock:
+            commands = self._command_queue
+            self._command_queue = deque()
+            pcmd_packet = self._pcmd_packet
+            self._pcmd_packet = None
+
+        for (channel, packet) in commands:
+            self.ble_connection._safe_ble_write(self.ble_connection._get_write_characteristic(channel), packet)
+            self.num_writes += 1
+
+        if (pcmd_packet is not None):
+            self.ble_connection._safe_ble_write(self.ble_connection.send_characteristics['SEND_NO_ACK'], pcmd_packet)
+            self.num_writes += 1
+            self.num_pcmd_writes += 1
+
+    def _run(self):
+        peripheral = self.ble_connection.drone_connection
+
+        while (self._running):
+            loop_start = time.monotonic()
+
+            self._write_pending()
+
+            # keep trying to get a lost link back (each try is bounded by reconnect_deadline)
+            if (self.ble_connection.link_state == LINK_DISCONNECTED):
+                self.ble_connection._reconnect()
+                continue
+
+            try:
+                if (peripheral.waitForNotifications(self.poll_timeout)):
+                    self.num_notifications += 1
+            except BTLEException:
+                # stopped from a callback on this thread: the peripheral is being closed on purpose
+                if (not self._running):
+                    break
+                color_print("reconnecting to wait", "WARN")
+                self.ble_connection._reconnect()
+
+            self.max_loop_time = max(self.max_loop_time, time.monotonic() - loop_start)
+
+        # don't drop commands queued right before stopping (e.g. a landing), unless the link is already closed
+        if (self.ble_connection.link_state == LINK_CONNECTED):
+            self._write_pending()
+
+    def get_stats(self):
+        """
+        :return: dictionary with the number of writes, PCMD writes, PCMD packets replaced before being
+        written, notifications handled and the longest pass through the loop (seconds)
+        """
+        return {
+            'num_writes': self.num_writes,
+            'num_pcmd_writes': self.num_pcmd_writes,
+            'num_pcmd_replaced': self.num_pcmd_replaced,
+            'num_notifications': self.num_notifications,
+            'max_loop_time': self.max_loop_time,
+        }
+
+
 class BLEConnection:
     def __init__(self, address, minidrone):
         """
@@ -122,7 +291,8 @@ class BLEConnection:
         # FTP commandsandsensors (obtained via ARUTILS_BLEFtp.m in the SDK)
         self.ftp_commands = {
             "list": "LIS",
-            "get": "GET"
+            "get": "GET",
+            "delete": "DEL"
         }
 
         # need to save for communication (but they are initialized in connect)
@@ -132,6 +302,12 @@ class BLEConnection:
         self.handshake_characteristics = dict()
         self.ftp_characteristics = dict()
 
+        # lists and downloads files over the FTP characteristics (e.g. the groundcam pictures)
+        self.ftp = BLEFtp(self)
+
+        # GATT handles saved from the last discovery (so a connect or reconnect can skip the discovery)
+        self.handle_cache = BLEHandleCache()
+
         self.data_types = {
             'ACK': 1,
             'DATA_NO_ACK': 2,
@@ -146,13 +322,48 @@ class BLEConnection:
             'ACK_COMMAND': False
         }
 
-        # instead of parsing the XML file every time, cache the results
-        self.command_tuple_cache = dict()
-        self.sensor_tuple_cache = dict()
+        # commands are packed into preallocated frames (one per command and send characteristic)
+        self.command_encoder = DroneCommandEncoder("<BB", has_frame_size=False)
+        self.command_encoder.add_channel('SEND_NO_ACK', (self.data_types['DATA_NO_ACK'],))
+        self.command_encoder.add_channel('SEND_WITH_ACK', (self.data_types['DATA_WITH_ACK'],))
+
+        # argument types of PCMD (flag, roll, pitch, yaw, gaz, timestamp) for the preallocated PCMD frame
+        self._pcmd_arg_types = ('u8', 'i8', 'i8', 'i8', 'i8', 'u32')
 
         # maximum number of times to try a packet before assuming it failed
         self.max_packet_retries = 3
 
+        # measures the ack round trip time to decide how long to wait before sending a packet again
+        # (rtt_estimator.get_stats() shows the current link estimates)
+        self.rtt_estimator = RTTEstimator(initial_rto=0.5)
+
+        # once connected, this thread does all of the reads and writes (see BLEIOEngine)
+        self.io_engine = BLEIOEngine(self)
+
+        # protects the send counters and the shared frame templates (commands can come from several threads)
+        self._send_lock = threading.Lock()
+
+        # only one acked command is in flight at a time since the acks do not say which packet they are for
+        self._ack_command_lock = threading.Lock()
+
+        # notified whenever an ack arrives
+        self._ack_condition = threading.Condition()
+
+        # a lost link is retried with exponential backoff (reconnect_initial_delay doubling up to
+        # reconnect_max_delay) for at most reconnect_deadline seconds (get_link_stats() shows how it went)
+        self.link_state = LINK_DISCONNECTED
+        self.reconnect_initial_delay = 0.1
+        self.reconnect_max_delay = 2.0
+        self.reconnect_deadline = 10.0
+
+        self.num_reconnects = 0
+        self.num_failed_reconnects = 0
+        self.total_reconnect_time = 0.0
+        self.last_reconnect_time = 0.0
+        self.max_reconnect_time = 0.0
+        self.num_pcmd_dropped = 0
+        self.num_writes_dropped = 0
+
     def connect(self, num_retries):
         """
         Connects to the drone and re-tries in case of failure the specified number of times
@@ -173,34 +384,94 @@ class BLEConnection:
                 color_print("retrying connections", "INFO")
                 try_num += 1
 
+        # from here on the I/O thread owns the peripheral
+        if (connected):
+            self.link_state = LINK_CONNECTED
+            self.io_engine.start()
+
         # fall through, return False as something failed
         return connected
 
-    def _reconnect(self, num_retries):
+    def _reconnect(self):
         """
-        Reconnect to the drone (assumed the BLE crashed)
+        Get the link back after the BLE dropped.  Tries again with exponential backoff until it works or
+        reconnect_deadline seconds pass.  Once reconnected, the send counters start over (as on a new
+        connection) and the full state is asked for again so the sensors are not stale.
 
-        :param: num_retries is the number of times to retry
-
-        :return: True if it succeeds and False otherwise
+        :return: True if it succeeds and False otherwise (the link is then LINK_DISCONNECTED)
         """
-        try_num = 1
+        self.link_state = LINK_RECONNECTING
+        start_time = time.monotonic()
+        delay = self.reconnect_initial_delay
         success = False
-        while (try_num < num_retries and not success):
+
+        try:
+            self.drone_connection.disconnect()
+        except Exception:
+            pass
+
+        while (not success):
             try:
                 color_print("trying to re-connect to the minidrone at address %s" % self.address, "WARN")
                 self.drone_connection.connect(self.address, "random")
-                color_print("connected!  Asking for services and characteristics", "SUCCESS")
+                color_print("connected!  Doing the handshake with the saved handles", "SUCCESS")
+
+                # the handles are already known so only the magic handshake is needed
+                self._setup_characteristics(use_saved_handles=True)
                 success = True
             except BTLEException:
-                color_print("retrying connections", "WARN")
-                try_num += 1
-
-        if (success):
-            # do the magic handshake
-            self._perform_handshake()
+                remaining = self.reconnect_deadline - (time.monotonic() - start_time)
+                if (remaining <= 0):
+                    break
+                color_print("retrying connections in %.1f seconds" % min(delay, remaining), "WARN")
+                time.sleep(min(delay, remaining))
+                delay = min(2 * delay, self.reconnect_max_delay)
+
+        duration = time.monotonic() - start_time
+        self.last_reconnect_time = duration
+        self.total_reconnect_time += duration
+        self.max_reconnect_time = max(self.max_reconnect_time, duration)
+
+        if (not success):
+            self.num_failed_reconnects += 1
+            self.link_state = LINK_DISCONNECTED
+            color_print("could not reconnect to the minidrone within %.1f seconds" % self.reconnect_deadline,
+                        "ERROR")
+            return False
+
+        self.num_reconnects += 1
+        with self._send_lock:
+            for channel in self.characteristic_send_counter:
+                self.characteristic_send_counter[channel] = 0
+        self.link_state = LINK_CONNECTED
+        color_print("reconnected in %.2f seconds" % duration, "SUCCESS")
+
+        # resync the sensors.  With the I/O thread, ask from another thread since the I/O thread may be the one
+        # reconnecting (and it has to write the request and read the ack)
+        if (self.io_engine.is_running()):
+            resync_thread = threading.Thread(target=self.minidrone.ask_for_state_update)
+            resync_thread.daemon = True
+            resync_thread.start()
+        else:
+            self.minidrone.ask_for_state_update()
+        return True
 
-        return success
+    def get_link_stats(self):
+        """
+        :return: dictionary with the link state, the number of reconnects that worked and failed, the last,
+                 longest and total time spent reconnecting (seconds), and the number of PCMD packets and other
+                 writes dropped while the link was down
+        """
+        return {
+            'link_state': self.link_state,
+            'num_reconnects': self.num_reconnects,
+            'num_failed_reconnects': self.num_failed_reconnects,
+            'last_reconnect_time': self.last_reconnect_time,
+            'max_reconnect_time': self.max_reconnect_time,
+            'total_reconnect_time': self.total_reconnect_time,
+            'num_pcmd_dropped': self.num_pcmd_dropped,
+            'num_writes_dropped': self.num_writes_dropped,
+        }
 
     def _connect(self):
         """
@@ -213,11 +484,50 @@ class BLEConnection:
         self.drone_connection.connect(self.address, "random")
         color_print("connected!  Asking for services and characteristics", "SUCCESS")
 
-        # re-try until all services have been found
-        allServicesFound = False
+        self._setup_characteristics(use_saved_handles=self._load_saved_handles())
+
+    def _setup_characteristics(self, use_saved_handles):
+        """
+        Do the magic handshake and set up the notifications.  With use_saved_handles, the handles from the last
+        discovery are written to directly and the full discovery only happens if that fails.
+
+        :param use_saved_handles: True to try the characteristics already known before discovering them
+        :return: throws an error if the drone connection failed
+        """
+        if (use_saved_handles):
+            try:
+                self._perform_handshake()
+            except BTLEException:
+                color_print("the saved handles did not work, asking for services and characteristics", "WARN")
+                self.handle_cache.remove(self.address)
+                use_saved_handles = False
+
+        if (not use_saved_handles):
+            self._discover_characteristics()
+
+            # do the magic handshake
+            self._perform_handshake()
+            self._save_handles()
 
         # used for notifications
-        handle_map = dict()
+        hex_by_name = dict((name, hex_str) for (hex_str, name) in self.characteristic_receive_uuids.items())
+        handle_map = dict((c.getHandle(), hex_by_name[name]) for (name, c) in self.receive_characteristics.items())
+        ftp_handle_map = dict((c.getHandle(), name) for (name, c) in self.ftp_characteristics.items())
+
+        # initialize the delegate to handle notifications
+        self.drone_connection.setDelegate(MinidroneDelegate(handle_map, self.minidrone, self, ftp_handle_map))
+
+    def _discover_characteristics(self):
+        """
+        Walk the services and characteristics of the drone to find the ones we need (slow)
+
+        :return: throws an error if the drone connection failed
+        """
+        for characteristics in self._characteristic_groups().values():
+            characteristics.clear()
+
+        # re-try until all services have been found
+        allServicesFound = False
 
         while not allServicesFound:
             # get the services
@@ -234,7 +544,6 @@ class BLEConnection:
                         hex_str = self._get_byte_str_from_uuid(c.uuid, 4, 4)
                         if hex_str in self.characteristic_receive_uuids:
                             self.receive_characteristics[self.characteristic_receive_uuids[hex_str]] = c
-                            handle_map[c.getHandle()] = hex_str
 
 
                 elif (self.service_uuids[hex_str] == 'ARCOMMAND_SENDING_SERVICE'):
@@ -268,33 +577,77 @@ class BLEConnection:
                             ['fb0f', 'fb0e', 'fb1b', 'fb1c', 'fd22', 'fd23', 'fd24', 'fd52', 'fd53', 'fd54']:
                         self.handshake_characteristics[self._get_byte_str_from_uuid(c.uuid, 3, 4)] = c
 
-            # check to see if all 8 characteristics were found
-            allServicesFound = True
-            for r_id in self.characteristic_receive_uuids.values():
-                if r_id not in self.receive_characteristics:
-                    color_print("setting to false in receive on %s" % r_id)
-                    allServicesFound = False
-
-            for s_id in self.characteristic_send_uuids.values():
-                if s_id not in self.send_characteristics:
-                    color_print("setting to false in send")
-                    allServicesFound = False
-
-            for f_id in self.characteristic_ftp_uuids.values():
-                if f_id not in self.ftp_characteristics:
-                    color_print("setting to false in ftp")
-                    allServicesFound = False
-
-            # and ensure all handshake characteristics were found
-            if len(self.handshake_characteristics.keys()) != 10:
-                color_print("setting to false in len")
+            allServicesFound = self._all_characteristics_found()
+
+    def _all_characteristics_found(self):
+        """
+        :return: True if all of the send, receive, ftp and handshake characteristics are known
+        """
+        # check to see if all 8 characteristics were found
+        allServicesFound = True
+        for r_id in self.characteristic_receive_uuids.values():
+            if r_id not in self.receive_characteristics:
+                color_print("setting to false in receive on %s" % r_id)
+                allServicesFound = False
+
+        for s_id in self.characteristic_send_uuids.values():
+            if s_id not in self.send_characteristics:
+                color_print("setting to false in send")
                 allServicesFound = False
 
-        # do the magic handshake
-        self._perform_handshake()
+        for f_id in self.characteristic_ftp_uuids.values():
+            if f_id not in self.ftp_characteristics:
+                color_print("setting to false in ftp")
+                allServicesFound = False
 
-        # initialize the delegate to handle notifications
-        self.drone_connection.setDelegate(MinidroneDelegate(handle_map, self.minidrone, self))
+        # and ensure all handshake characteristics were found
+        if len(self.handshake_characteristics.keys()) != 10:
+            color_print("setting to false in len")
+            allServicesFound = False
+
+        return allServicesFound
+
+    def _characteristic_groups(self):
+        """
+        :return: dictionary of group name (as saved in the handle cache) -> characteristics of that group
+        """
+        return {
+            'send': self.send_characteristics,
+            'receive': self.receive_characteristics,
+            'ftp': self.ftp_characteristics,
+            'handshake': self.handshake_characteristics,
+        }
+
+    def _save_handles(self):
+        """
+        Save the handles of the characteristics for this drone (in memory and on disk)
+        """
+        handles = dict()
+        for (group, characteristics) in self._characteristic_groups().items():
+            handles[group] = dict((name, ["%s" % c.uuid, c.handle, c.properties, c.valHandle])
+                                  for (name, c) in characteristics.items())
+        self.handle_cache.save(self.address, handles)
+
+    def _load_saved_handles(self):
+        """
+        Make the characteristics from the handles saved for this drone (no BLE traffic)
+
+        :return: True if every characteristic was saved and False otherwise
+        """
+        handles = self.handle_cache.get(self.address)
+        if (handles is None):
+            return False
+
+        try:
+            for (group, characteristics) in self._characteristic_groups().items():
+                characteristics.clear()
+                for (name, (uuid, handle, properties, value_handle)) in handles[group].items():
+                    characteristics[name] = Characteristic(self.drone_connection, uuid, handle, properties,
+                                                           value_handle)
+        except (KeyError, ValueError, TypeError):
+            return False
+
+        return self._all_characteristics_found()
 
     def _perform_handshake(self):
         """
@@ -320,6 +673,8 @@ class BLEConnection:
 
         :return: void
         """
+        self.io_engine.stop()
+        self.link_state = LINK_DISCONNECTED
         self.drone_connection.disconnect()
 
     def _get_byte_str_from_uuid(self, uuid, byte_start, byte_end):
@@ -343,6 +698,77 @@ class BLEConnection:
         return my_hex_str
 
 
+    def _use_io_engine(self):
+        """
+        :return: True if reads and writes have to go through the I/O thread
+        """
+        return (self.io_engine.is_running() and not self.io_engine.in_io_thread())
+
+    def _encode_packet(self, channel, command_tuple, args=(), arg_types=None):
+        """
+        Increment the send counter for the channel and encode the command (safe to call from any thread)
+
+        :param channel: send characteristic name (e.g. 'SEND_WITH_ACK')
+        :param command_tuple: command tuple from the parser
+        :param args: the argument values
+        :param arg_types: optional argument type strings (looked up in the XML if None)
+        :return: the packet (bytes)
+        """
+        with self._send_lock:
+            self.characteristic_send_counter[channel] = (self.characteristic_send_counter[channel] + 1) % 256
+            packet = self.command_encoder.encode(channel, self.characteristic_send_counter[channel],
+                                                 command_tuple, args, arg_types)
+            return bytes(packet)
+
+    def _write(self, channel, packet):
+        """
+        Write a packet on a send characteristic (queued for the I/O thread once it is running)
+
+        :param channel: send characteristic name
+        :param packet: the packet
+        :return: nothing
+        """
+        if (self._use_io_engine()):
+            self.io_engine.queue_write(channel, packet)
+        else:
+            self._safe_ble_write(characteristic=self._get_write_characteristic(channel), packet=packet)
+
+    def _get_write_characteristic(self, channel):
+        """
+        :param channel: name of a send or FTP characteristic
+        :return: the characteristic to write to
+        """
+        if (channel in self.send_characteristics):
+            return self.send_characteristics[channel]
+        return self.ftp_characteristics[channel]
+
+    def _wait_for_notifications(self, event, timeout):
+        """
+        Handle the notifications until the event is set (e.g. by the notification handler) or the timeout passes
+
+        :param event: threading.Event to wait for
+        :param timeout: maximum seconds to wait
+        :return: True if the event was set and False on a timeout
+        """
+        # the I/O thread handles the notifications
+        if (self._use_io_engine()):
+            return event.wait(timeout)
+
+        start_time = time.time()
+        while (not event.is_set()):
+            remaining = timeout - (time.time() - start_time)
+            if (remaining <= 0):
+                break
+
+            try:
+                self.drone_connection.waitForNotifications(min(remaining, 0.1))
+            except BTLEException:
+                color_print("reconnecting to wait", "WARN")
+                if (not self._reconnect()):
+                    break
+
+        return event.is_set()
+
     def send_turn_command(self, command_tuple, degrees):
         """
         Build the packet for turning and send it
@@ -351,13 +777,7 @@ class BLEConnection:
         :param degrees: how many degrees to turn
         :return: True if the command was sent and False otherwise
         """
-        self.characteristic_send_counter['SEND_WITH_ACK'] = (self.characteristic_send_counter['SEND_WITH_ACK'] + 1) % 256
-
-        packet = struct.pack("<BBBBHh", self.data_types['DATA_WITH_ACK'],
-                             self.characteristic_send_counter['SEND_WITH_ACK'],
-                             command_tuple[0], command_tuple[1], command_tuple[2],
-                             degrees)
-
+        packet = self._encode_packet('SEND_WITH_ACK', command_tuple, (degrees,), ('i16',))
         return self.send_command_packet_ack(packet)
 
     def send_auto_takeoff_command(self, command_tuple):
@@ -368,14 +788,7 @@ class BLEConnection:
         :return: True if the command was sent and False otherwise
         """
         # print command_tuple
-        self.characteristic_send_counter['SEND_WITH_ACK'] = (
-                                                                self.characteristic_send_counter[
-                                                                    'SEND_WITH_ACK'] + 1) % 256
-        packet = struct.pack("<BBBBHB", self.data_types['DATA_WITH_ACK'],
-                             self.characteristic_send_counter['SEND_WITH_ACK'],
-                             command_tuple[0], command_tuple[1], command_tuple[2],
-                             1)
-
+        packet = self._encode_packet('SEND_WITH_ACK', command_tuple, (1,), ('u8',))
         return self.send_command_packet_ack(packet)
 
 
@@ -386,20 +799,69 @@ class BLEConnection:
         :param packet: packet constructed according to the command rules (variable size, constructed elsewhere)
         :return: True if the command was sent and False otherwise
         """
+        # a command sent from a sensor callback runs in the I/O thread and must not wait for the lock
+        # (the ack it waits for would never be handled)
+        if (self._use_io_engine()):
+            with self._ack_command_lock:
+                return self._send_command_packet_ack(packet)
+
+        return self._send_command_packet_ack(packet)
+
+    def _send_command_packet_ack(self, packet):
+        """
+        Send the packet on the ack channel until it is acked or the retries run out
+
+        :param packet: the packet (bytes)
+        :return: True if the command was acked and False otherwise
+        """
         try_num = 0
         self._set_command_received('SEND_WITH_ACK', False)
         while (try_num < self.max_packet_retries and not self.command_received['SEND_WITH_ACK']):
             color_print("sending command packet on try %d" % try_num, 2)
-            self._safe_ble_write(characteristic=self.send_characteristics['SEND_WITH_ACK'], packet=packet)
-            #self.send_characteristics['SEND_WITH_ACK'].write(packet)
+            send_time = time.monotonic()
+            self._write('SEND_WITH_ACK', packet)
             try_num += 1
-            color_print("sleeping for a notification", 2)
-            #notify = self.drone.waitForNotifications(1.0)
-            self.smart_sleep(0.5)
-            #color_print("awake %s " % notify, 2)
+            color_print("waiting for the ack", 2)
+            if (self._wait_for_command_received('SEND_WITH_ACK', self.rtt_estimator.get_rto())):
+                # only measure packets sent once since a resent packet's ack could be for either send
+                if (try_num == 1):
+                    self.rtt_estimator.add_sample(time.monotonic() - send_time)
+            else:
+                self.rtt_estimator.backoff()
 
         return self.command_received['SEND_WITH_ACK']
 
+    def _wait_for_command_received(self, channel, timeout):
+        """
+        Wait until the command on the channel is acked or the timeout expires.
+        Unlike smart_sleep, this returns as soon as the ack arrives.
+
+        :param channel: channel the command was sent on
+        :param timeout: maximum number of seconds to wait
+        :return: True if the command was acked and False otherwise
+        """
+        # the I/O thread handles the notifications and tells us when the ack arrives
+        if (self._use_io_engine()):
+            with self._ack_condition:
+                self._ack_condition.wait_for(lambda: self.command_received[channel], timeout)
+            return self.command_received[channel]
+
+        start_time = time.time()
+
+        while (not self.command_received[channel]):
+            remaining = timeout - (time.time() - start_time)
+            if (remaining <= 0):
+                break
+
+            try:
+                self.drone_connection.waitForNotifications(min(remaining, 0.1))
+            except:
+                color_print("reconnecting to wait", "WARN")
+                if (not self._reconnect()):
+                    break
+
+        return self.command_received[channel]
+
     def send_single_pcmd_command(self, command_tuple, roll, pitch, yaw, vertical_movement):
         """
         Send a single PCMD command with the specified roll, pitch, and yaw.  Note
@@ -413,14 +875,16 @@ class BLEConnection:
         :param vertical_movement:
         """
 
-        self.characteristic_send_counter['SEND_NO_ACK'] = (self.characteristic_send_counter['SEND_NO_ACK'] + 1) % 256
-        packet = struct.pack("<BBBBHBbbbbI", self.data_types['DATA_NO_ACK'],
-                             self.characteristic_send_counter['SEND_NO_ACK'],
-                             command_tuple[0], command_tuple[1], command_tuple[2],
-                             1, int(roll), int(pitch), int(yaw), int(vertical_movement), 0)
+        packet = self._encode_packet('SEND_NO_ACK', command_tuple,
+                                     (1, int(roll), int(pitch), int(yaw), int(vertical_movement), 0),
+                                     self._pcmd_arg_types)
 
-        self._safe_ble_write(characteristic=self.send_characteristics['SEND_NO_ACK'], packet=packet)
-        # self.send_characteristics['SEND_NO_ACK'].write(packet)
+        if (self._use_io_engine()):
+            self.io_engine.queue_pcmd(packet)
+        elif (self.link_state != LINK_CONNECTED):
+            self.num_pcmd_dropped += 1
+        else:
+            self._safe_ble_write(characteristic=self.send_characteristics['SEND_NO_ACK'], packet=packet)
 
     def send_pcmd_command(self, command_tuple, roll, pitch, yaw, vertical_movement, duration):
         """
@@ -437,7 +901,7 @@ class BLEConnection:
         while (time.time() - start_time < duration):
 
             self.send_single_pcmd_command(command_tuple, roll, pitch, yaw, vertical_movement)
-            notify = self.drone_connection.waitForNotifications(0.1)
+            self.smart_sleep(0.1)
 
     def send_noparam_command_packet_ack(self, command_tuple):
         """
@@ -451,9 +915,7 @@ class BLEConnection:
         :param command_tuple: 3 tuple of the command bytes.  0 padded for 4th byte
         :return: True if the command was sent and False otherwise
         """
-        self.characteristic_send_counter['SEND_WITH_ACK'] = (self.characteristic_send_counter['SEND_WITH_ACK'] + 1) % 256
-        packet = struct.pack("<BBBBH", self.data_types['DATA_WITH_ACK'], self.characteristic_send_counter['SEND_WITH_ACK'],
-                             command_tuple[0], command_tuple[1], command_tuple[2])
+        packet = self._encode_packet('SEND_WITH_ACK', command_tuple, arg_types=())
         return self.send_command_packet_ack(packet)
 
 
@@ -470,20 +932,15 @@ class BLEConnection:
         :param enum_value: the enum index
         :return: nothing
         """
-        self.characteristic_send_counter['SEND_WITH_ACK'] = (self.characteristic_send_counter['SEND_WITH_ACK'] + 1) % 256
         if (usb_id is None):
-            packet = struct.pack("<BBBBBBI", self.data_types['DATA_WITH_ACK'], self.characteristic_send_counter['SEND_WITH_ACK'],
-                                 command_tuple[0], command_tuple[1], command_tuple[2], 0,
-                                 enum_value)
+            packet = self._encode_packet('SEND_WITH_ACK', command_tuple, (enum_value,), ('enum',))
         else:
-            color_print((self.data_types['DATA_WITH_ACK'], self.characteristic_send_counter['SEND_WITH_ACK'],
+            packet = self._encode_packet('SEND_WITH_ACK', command_tuple, (usb_id, enum_value), ('u8', 'enum'))
+            color_print((self.data_types['DATA_WITH_ACK'], packet[1],
                          command_tuple[0], command_tuple[1], command_tuple[2], 0, usb_id, enum_value), 1)
-            packet = struct.pack("<BBBBHBI", self.data_types['DATA_WITH_ACK'], self.characteristic_send_counter['SEND_WITH_ACK'],
-                                 command_tuple[0], command_tuple[1], command_tuple[2],
-                                 usb_id, enum_value)
         return self.send_command_packet_ack(packet)
 
-    def send_param_command_packet(self, command_tuple, param_tuple=None, param_type_tuple=0, ack=True):
+    def send_param_command_packet(self, command_tuple, param_tuple=None, param_type_tuple=None, ack=True):
         """
         Send a command packet with parameters. Ack channel is optional for future flexibility,
         but currently commands are always send over the Ack channel so it defaults to True.
@@ -492,44 +949,27 @@ class BLEConnection:
 
         :param: command_tuple: the command tuple derived from command_parser.get_command_tuple()
         :param: param_tuple (optional): the parameter values to be sent (can be found in the XML files)
-        :param: param_size_tuple (optional): a tuple of strings representing the data type of the parameters
-        e.g. u8, float etc. (can be found in the XML files)
+        :param: param_type_tuple (optional): a tuple of strings representing the data type of the parameters
+        e.g. u8, float etc.  If it is not given, the types are looked up in the XML files.
         :param: ack (optional): allows ack to be turned off if required
         :return:
         """
-        # Create lists to store the number of bytes and pack chars needed for parameters
-        # Default them to zero so that if no params are provided the packet size is correct
-        param_size_list = [0] * len(param_tuple)
-        pack_char_list = [0] * len(param_tuple)
-
-        if param_tuple is not None:
-            # Fetch the parameter sizes. By looping over the param_tuple we only get the data
-            # for requested parameters so a mismatch in params and types does not matter
-            for i, param in enumerate(param_tuple):
-                pack_char_list[i], param_size_list[i] = get_data_format_and_size(param, param_type_tuple[i])
+        if param_tuple is None:
+            param_tuple = ()
 
         if ack:
             ack_string = 'SEND_WITH_ACK'
-            data_ack_string = 'DATA_WITH_ACK'
         else:
             ack_string = 'SEND_NO_ACK'
-            data_ack_string = 'DATA_NO_ACK'
-
-        # Construct the base packet
-        self.characteristic_send_counter['SEND_WITH_ACK'] = (self.characteristic_send_counter['SEND_WITH_ACK'] + 1) % 256
-
-        # TODO:  Amy changed this to match the BLE packet structure but needs to fully test it
-        packet = struct.pack("<BBBBH", self.data_types[data_ack_string],
-                             self.characteristic_send_counter[ack_string],
-                             command_tuple[0], command_tuple[1], command_tuple[2])
 
-        if param_tuple is not None:
-            # Add in the parameter values based on their sizes
-            for i, param in enumerate(param_tuple):
-                packet += struct.pack(pack_char_list[i], param)
+        # Construct the packet from the compiled template for this command
+        packet = self._encode_packet(ack_string, command_tuple, param_tuple, param_type_tuple)
 
-        # TODO: Fix this to not go with ack always
-        return self.send_command_packet_ack(packet)
+        if ack:
+            return self.send_command_packet_ack(packet)
+        else:
+            self._write('SEND_NO_ACK', packet)
+            return True
 
     def _set_command_received(self, channel, val):
         """
@@ -539,26 +979,40 @@ class BLEConnection:
         :param val: True or False
         :return:
         """
-        self.command_received[channel] = val
+        with self._ack_condition:
+            self.command_received[channel] = val
+            if (val):
+                self._ack_condition.notify_all()
 
     def _safe_ble_write(self, characteristic, packet):
         """
-        Write to the specified BLE characteristic but first ensure the connection is valid
+        Write to the specified BLE characteristic.  If the write fails, reconnect (bounded by
+        reconnect_deadline) and write it once more.  Writes fail right away while the link is down.
 
         :param characteristic:
         :param packet:
-        :return:
+        :return: True if the packet was written and False if it was dropped
         """
-
-        success = False
-
-        while (not success):
+        # the I/O thread keeps trying to reconnect on its own so don't wait for it here
+        if (self.link_state == LINK_DISCONNECTED and self.io_engine.is_running()):
+            self.num_writes_dropped += 1
+            return False
+
+        try:
+            characteristic.write(packet)
+            return True
+        except BTLEException:
+            color_print("reconnecting to send packet", "WARN")
+
+        if (self._reconnect()):
             try:
                 characteristic.write(packet)
-                success = True
+                return True
             except BTLEException:
-                color_print("reconnecting to send packet", "WARN")
-                self._reconnect(3)
+                pass
+
+        self.num_writes_dropped += 1
+        return False
 
     def ack_packet(self, buffer_id, packet_id):
         """
@@ -568,14 +1022,14 @@ class BLEConnection:
         :return: nothing
         """
         #color_print("ack last packet on the ACK_COMMAND channel", "INFO")
-        self.characteristic_send_counter['ACK_COMMAND'] = (self.characteristic_send_counter['ACK_COMMAND'] + 1) % 256
-        packet = struct.pack("<BBB", self.data_types['ACK'], self.characteristic_send_counter['ACK_COMMAND'],
-                             packet_id)
+        with self._send_lock:
+            self.characteristic_send_counter['ACK_COMMAND'] = (self.characteristic_send_counter['ACK_COMMAND'] + 1) % 256
+            packet = struct.pack("<BBB", self.data_types['ACK'], self.characteristic_send_counter['ACK_COMMAND'],
+                                 packet_id)
         #color_print("sending packet %d %d %d" % (self.data_types['ACK'], self.characteristic_send_counter['ACK_COMMAND'],
         #                                   packet_id), "INFO")
 
-        self._safe_ble_write(characteristic=self.send_characteristics['ACK_COMMAND'], packet=packet)
-        #self.send_characteristics['ACK_COMMAND'].write(packet)
+        self._write('ACK_COMMAND', packet)
 
 
     def smart_sleep(self, timeout):
@@ -589,6 +1043,11 @@ class BLEConnection:
         :return:
         """
 
+        # the I/O thread is already handling the notifications
+        if (self._use_io_engine()):
+            time.sleep(timeout)
+            return
+
         start_time = datetime.now()
         new_time = datetime.now()
         diff = (new_time - start_time).seconds + ((new_time - start_time).microseconds / 1000000.0)
@@ -598,7 +1057,10 @@ class BLEConnection:
                 notify = self.drone_connection.waitForNotifications(0.1)
             except:
                 color_print("reconnecting to wait", "WARN")
-                self._reconnect(3)
+                if (not self._reconnect()):
+                    # the link is down so there is nothing to wait for
+                    time.sleep(max(0, timeout - diff))
+                    break
 
             new_time = datetime.now()
             diff = (new_time - start_time).seconds + ((new_time - start_time).microseconds / 1000000.0)
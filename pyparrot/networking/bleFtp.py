@@ -0,0 +1,264 @@
+"""
+FTP over BLE for the minidrones (the same protocol as ARUTILS_BLEFtp in the Parrot SDK).  Wifi FTP is disabled
+since firmware 3.0.25 but the FTP service on the BLE connection still works, so the pictures of the groundcam
+can be listed and downloaded over it.
+
+A command ("LIS" or "GET" followed by the path) is written on the handling characteristic.  The drone then
+streams the result as notifications on the getting characteristic: raw data packets, the "End of Transfer"
+packet and a last packet with the MD5 (hex) of the whole file.  After each block of BLOCK_PACKET_COUNT packets
+the drone waits for the MD5 of that block to be written back on the getting characteristic.
+
+The packets are handled as the notifications arrive (on the BLE I/O thread when it is running): each one is
+copied in place into a buffer allocated for the whole file, the MD5 is updated and the block MD5 is answered
+right away, so the drone never waits on the caller.  The caller only waits for the end of the transfer.
+
+Author: Amy McGovern, dramymcgovern@gmail.com
+"""
+import hashlib
+import re
+import threading
+import time
+from pyparrot.utils.colorPrint import color_print
+
+# protocol constants from ARUTILS_BLEFtp
+END_OF_TRANSFER = b"End of Transfer"
+BLOCK_PACKET_COUNT = 100
+COMMAND_PACKET_SIZE = 20
+MAX_COMMAND_SIZE = 132
+
+# the MD5 in the last packet: 32 hex digits, possibly after an "MD5" prefix
+_md5_pattern = re.compile(r"(?:md5)?[\s:=]*([0-9a-f]{32})")
+
+
+class BLEFtpTransfer:
+    """
+    State of one transfer (filled in as the packets arrive)
+    """
+    def __init__(self, expected_size=None):
+        """
+        :param expected_size: size of the file if it is known (the buffer is allocated for it up front)
+        """
+        self.buffer = bytearray(expected_size if expected_size is not None else 0)
+        self.num_bytes = 0
+        self.num_packets = 0
+        self.num_blocks = 0
+        self.md5 = hashlib.md5()
+        self.block_md5 = hashlib.md5()
+        self.block_packets = 0
+
+        self.end_of_file = False
+        self.drone_md5 = None
+        self.md5_packet = None
+        self.done = threading.Event()
+
+        self.start_time = time.monotonic()
+        self.end_time = None
+
+    def add_data(self, data):
+        """
+        Copy a data packet at the end of the received data (the buffer only grows if the size was unknown or wrong)
+        """
+        end = self.num_bytes + len(data)
+        if (end > len(self.buffer)):
+            self.buffer.extend(bytes(max(end - len(self.buffer), len(self.buffer))))
+        self.buffer[self.num_bytes:end] = data
+        self.num_bytes = end
+
+        self.md5.update(data)
+        self.block_md5.update(data)
+
+    def get_data(self):
+        """
+        :return: the data received (bytes)
+        """
+        return bytes(memoryview(self.buffer)[:self.num_bytes])
+
+    def md5_ok(self):
+        """
+        :return: True if the MD5 the drone sent matches the data received
+        """
+        return (self.drone_md5 is not None and self.drone_md5 == self.md5.hexdigest())
+
+    def get_stats(self):
+        """
+        :return: dictionary with the number of bytes, packets and blocks, the seconds the transfer took and its
+                 throughput (bytes per second)
+        """
+        end_time = self.end_time if self.end_time is not None else time.monotonic()
+        duration = end_time - self.start_time
+        return {
+            'num_bytes': self.num_bytes,
+            'num_packets': self.num_packets,
+            'num_blocks': self.num_blocks,
+            'duration': duration,
+            'bytes_per_second': self.num_bytes / duration if duration > 0 else 0.0,
+            'md5_ok': self.md5_ok(),
+        }
+
+
+class BLEFtp:
+    def __init__(self, ble_connection, timeout=10.0):
+        """
+        :param ble_connection: the BLEConnection (its FTP characteristics are found when it connects)
+        :param timeout: seconds to wait for the next packet before giving up on a transfer
+        """
+        self.ble_connection = ble_connection
+        self.timeout = timeout
+
+        # only one transfer at a time (the FTP characteristics are shared)
+        self._transfer_lock = threading.Lock()
+        self.transfer = None
+        self.last_stats = None
+
+    def handle_notification(self, channel, data):
+        """
+        Handle a notification on one of the FTP characteristics (called by the notification delegate)
+
+        :param channel: name of the FTP characteristic
+        :param data: the packet
+        """
+        transfer = self.transfer
+        if (channel != 'NORMAL_FTP_GETTING' or transfer is None or transfer.done.is_set()):
+            return
+
+        transfer.num_packets += 1
+
+        if (transfer.end_of_file):
+            # the packet after the end of the transfer is the MD5 of the whole file (the raw packet is kept to
+            # diagnose a mismatch)
+            transfer.md5_packet = bytes(data)
+            match = _md5_pattern.match(transfer.md5_packet.decode("utf-8", "ignore").strip("\x00").strip().lower())
+            transfer.drone_md5 = match.group(1) if match is not None else None
+            transfer.end_time = time.monotonic()
+            transfer.done.set()
+            return
+
+        if (bytes(data[0:len(END_OF_TRANSFER)]) == END_OF_TRANSFER):
+            transfer.end_of_file = True
+
+            # some firmwares put the MD5 right after the end of transfer in the same packet
+            if (len(data) >= len(END_OF_TRANSFER) + 32):
+                self.handle_notification(channel, data[len(END_OF_TRANSFER):])
+                transfer.num_packets -= 1
+            return
+
+        transfer.add_data(data)
+        transfer.block_packets += 1
+
+        if (transfer.block_packets >= BLOCK_PACKET_COUNT):
+            # the drone waits for the MD5 of the block before sending the next one
+            self.ble_connection._write('NORMAL_FTP_GETTING', transfer.block_md5.hexdigest().encode("utf-8"))
+            transfer.num_blocks += 1
+            transfer.block_packets = 0
+            transfer.block_md5 = hashlib.md5()
+
+    def _send_command(self, command, path):
+        """
+        Write an FTP command (e.g. LIS or GET) and its path on the handling characteristic
+
+        :return: True if it was written and False otherwise
+        """
+        packet = (command + path).encode("utf-8") + b"\x00"
+        if (len(packet) > MAX_COMMAND_SIZE):
+            color_print("Error: the path %s is too long for BLE FTP" % path, "ERROR")
+            return False
+
+        for start in range(0, len(packet), COMMAND_PACKET_SIZE):
+            self.ble_connection._write('NORMAL_FTP_HANDLING', packet[start:start + COMMAND_PACKET_SIZE])
+        return True
+
+    def _run_transfer(self, command, path, expected_size=None):
+        """
+        Send a command and wait for all of its data
+
+        :return: the finished BLEFtpTransfer or None if it failed
+        """
+        if ('NORMAL_FTP_HANDLING' not in self.ble_connection.ftp_characteristics):
+            color_print("Error: the BLE FTP characteristics were not found (connect first)", "ERROR")
+            return None
+
+        with self._transfer_lock:
+            transfer = BLEFtpTransfer(expected_size)
+            self.transfer = transfer
+
+            try:
+                if (not self._send_command(command, path)):
+                    return None
+
+                # wait as long as packets keep coming
+                last_packets = -1
+                while (not transfer.done.is_set() and transfer.num_packets != last_packets):
+                    last_packets = transfer.num_packets
+                    self.ble_connection._wait_for_notifications(transfer.done, self.timeout)
+            finally:
+                self.transfer = None
+
+        if (not transfer.done.is_set()):
+            color_print("Error: BLE FTP %s %s timed out after %d bytes" % (command, path, transfer.num_bytes),
+                        "ERROR")
+            return None
+
+        self.last_stats = transfer.get_stats()
+        return transfer
+
+    def list_files(self, path):
+        """
+        List a directory on the drone
+
+        :param path: directory on the drone
+        :return: list of (name, size) for the files (size is None if it could not be read), None on an error
+        """
+        transfer = self._run_transfer(self.ble_connection.ftp_commands["list"], path)
+        if (transfer is None):
+            return None
+
+        files = list()
+        for line in transfer.get_data().decode("utf-8", "ignore").splitlines():
+            fields = line.split()
+            if (len(fields) == 0 or line.startswith("d")):
+                continue
+
+            # the lines look like "ls -l": -rw-r--r-- 1 root root 12345 Jan  1 00:00 name.jpg
+            size = None
+            if (len(fields) >= 9 and fields[4].isdigit()):
+                size = int(fields[4])
+            files.append((fields[-1], size))
+        return files
+
+    def get_file(self, path, expected_size=None):
+        """
+        Download a file from the drone and check its MD5
+
+        :param path: path of the file on the drone
+        :param expected_size: size of the file if it is known (e.g. from list_files) so the buffer is allocated
+                              once
+        :return: the contents of the file (bytes) or None if the download failed or the MD5 did not match
+        """
+        transfer = self._run_transfer(self.ble_connection.ftp_commands["get"], path, expected_size)
+        if (transfer is None):
+            return None
+
+        stats = self.last_stats
+        if (not transfer.md5_ok()):
+            color_print("Error: MD5 of %s does not match (%s instead of %s, last packet was %r)" %
+                        (path, transfer.md5.hexdigest(), transfer.drone_md5, transfer.md5_packet), "ERROR")
+            return None
+
+        color_print("downloaded %s: %d bytes in %.1f seconds (%.1f kB/s)" %
+                    (path, stats['num_bytes'], stats['duration'], stats['bytes_per_second'] / 1000.0), "SUCCESS")
+        return transfer.get_data()
+
+    def delete_file(self, path):
+        """
+        Delete a file on the drone (the drone answers on the handling characteristic, which is not waited for)
+
+        :param path: path of the file on the drone
+        :return: True if the command was sent and False otherwise
+        """
+        return self._send_command(self.ble_connection.ftp_commands["delete"], path)
+
+    def get_stats(self):
+        """
+        :return: the stats of the last transfer (see BLEFtpTransfer.get_stats) or None if there was none
+        """
+        return self.last_stats
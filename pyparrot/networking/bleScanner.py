@@ -0,0 +1,241 @@
+"""
+Scans for Parrot minidrones (Mambo, Swing, ...) in the background.  A single blocking scan takes many
+seconds each time, so the scanner keeps scanning and keeps a table of the minidrones it heard recently:
+
+    - the address, address type and name of each minidrone
+    - the RSSI smoothed with an exponentially weighted moving average (a single advertisement is noisy)
+    - when it was last heard (entries not heard for expiry_time seconds are dropped)
+
+The table answers "the closest N minidrones" or "the minidrone with this name" right away.  Scanning needs BLE
+permissions (sudo on linux).
+
+Author: Amy McGovern, dramymcgovern@gmail.com
+"""
+import threading
+import time
+from bluepy.btle import Scanner, ScanEntry, DefaultDelegate, BTLEException
+from pyparrot.utils.colorPrint import color_print
+
+# the minidrones advertise the Parrot company id (0x0043) in their manufacturer data
+PARROT_MANUFACTURER_PREFIX = "4300"
+
+# names the minidrones advertise
+MINIDRONE_NAMES = ("Mambo", "Swing", "RS_", "Maclan", "Blaze", "Travis", "Airborne")
+
+
+class ScannedMinidrone:
+    """
+    A minidrone the scanner heard
+    """
+    def __init__(self, address, address_type):
+        self.address = address
+        self.address_type = address_type
+        self.name = None
+        self.rssi = None
+        self.last_rssi = None
+        self.first_seen = time.monotonic()
+        self.last_seen = self.first_seen
+        self.num_advertisements = 0
+
+    def age(self):
+        """
+        :return: seconds since the minidrone was last heard
+        """
+        return time.monotonic() - self.last_seen
+
+    def __str__(self):
+        return ("%s (%s) %s RSSI %.1f dB (last %d dB), heard %.1f seconds ago" %
+                (self.address, self.address_type, self.name, self.rssi, self.last_rssi, self.age()))
+
+
+class _ScanDelegate(DefaultDelegate):
+    def __init__(self, scanner):
+        DefaultDelegate.__init__(self)
+        self.scanner = scanner
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        self.scanner._update(dev)
+
+
+class MinidroneScanner:
+    def __init__(self, rssi_alpha=0.3, expiry_time=10.0, passive=True, scan_time=1.0, iface=0):
+        """
+        :param rssi_alpha: weight of a new RSSI in the smoothed RSSI
+        :param expiry_time: a minidrone not heard for this many seconds is dropped from the table
+        :param passive: True for passive scans (only listen to advertisements, nothing is sent) and False for
+                        active scans (ask each device for its scan response, which may have the name sooner)
+        :param scan_time: seconds each scan processes advertisements before expired entries are dropped
+        :param iface: number of the bluetooth interface (0 for hci0)
+        """
+        self.rssi_alpha = rssi_alpha
+        self.expiry_time = expiry_time
+        self.passive = passive
+        self.scan_time = scan_time
+        self.iface = iface
+
+        # address -> ScannedMinidrone
+        self.minidrones = dict()
+
+        # the table is updated on the scan thread and read on any thread
+        self._lock = threading.Lock()
+        self._found = threading.Condition(self._lock)
+
+        self._running = False
+        self._thread = None
+        self.num_scans = 0
+        self.num_scan_errors = 0
+
+    def start(self):
+        """
+        Start scanning in the background
+        """
+        if (self._running):
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop scanning (the table is kept)
+        """
+        self._running = False
+        if (self._thread is not None and self._thread is not threading.current_thread()):
+            self._thread.join()
+        self._thread = None
+
+    def is_running(self):
+        """
+        :return: True if the scan thread is running
+        """
+        return self._running
+
+    def _run(self):
+        scanner = Scanner(self.iface).withDelegate(_ScanDelegate(self))
+
+        while (self._running):
+            try:
+                scanner.clear()
+                scanner.start(passive=self.passive)
+                try:
+                    # process returns after scan_time so stop() and the expiry get a chance to run
+                    scanner.process(self.scan_time)
+                finally:
+                    scanner.stop()
+                self.num_scans += 1
+            except BTLEException as e:
+                self.num_scan_errors += 1
+                color_print("BLE scan failed (%s), trying again" % e, "WARN")
+                time.sleep(self.scan_time)
+
+            self._expire()
+
+    def _is_minidrone(self, name, manufacturer_data):
+        """
+        :return: True if the advertisement is from a Parrot minidrone
+        """
+        if (manufacturer_data is not None and manufacturer_data.startswith(PARROT_MANUFACTURER_PREFIX)):
+            return True
+        return (name is not None and any(minidrone_name in name for minidrone_name in MINIDRONE_NAMES))
+
+    def _update(self, dev):
+        """
+        Record an advertisement (called on the scan thread for every advertisement)
+
+        :param dev: the bluepy ScanEntry
+        """
+        name = dev.getValueText(ScanEntry.COMPLETE_LOCAL_NAME) or dev.getValueText(ScanEntry.SHORT_LOCAL_NAME)
+        manufacturer_data = dev.getValueText(ScanEntry.MANUFACTURER)
+
+        with self._lock:
+            minidrone = self.minidrones.get(dev.addr)
+            if (minidrone is None):
+                if (not self._is_minidrone(name, manufacturer_data)):
+                    return
+                minidrone = ScannedMinidrone(dev.addr, dev.addrType)
+                self.minidrones[dev.addr] = minidrone
+
+            # passive scans may only get the name from some of the advertisements
+            if (name is not None):
+                minidrone.name = name
+
+            if (minidrone.rssi is None):
+                minidrone.rssi = float(dev.rssi)
+            else:
+                minidrone.rssi = (1 - self.rssi_alpha) * minidrone.rssi + self.rssi_alpha * dev.rssi
+            minidrone.last_rssi = dev.rssi
+            minidrone.last_seen = time.monotonic()
+            minidrone.num_advertisements += 1
+
+            self._found.notify_all()
+
+    def _expire(self):
+        """
+        Drop the minidrones not heard for expiry_time seconds
+        """
+        with self._lock:
+            for address in [address for (address, minidrone) in self.minidrones.items()
+                            if minidrone.age() > self.expiry_time]:
+                del self.minidrones[address]
+
+    def get_minidrones(self):
+        """
+        :return: list of the minidrones heard recently (ScannedMinidrone), closest (highest smoothed RSSI) first
+        """
+        with self._lock:
+            minidrones = [minidrone for minidrone in self.minidrones.values()
+                          if minidrone.age() <= self.expiry_time]
+        return sorted(minidrones, key=lambda minidrone: minidrone.rssi, reverse=True)
+
+    def get_closest(self, num_minidrones=1):
+        """
+        :param num_minidrones: number of minidrones to return
+        :return: list of the num_minidrones closest minidrones (fewer if fewer were heard)
+        """
+        return self.get_minidrones()[:num_minidrones]
+
+    def find_by_name(self, name):
+        """
+        :param name: name of the minidrone (e.g. Mambo_123456).  A part of the name also works if it matches
+                     only one minidrone.
+        :return: the ScannedMinidrone or None if it was not heard recently
+        """
+        minidrones = self.get_minidrones()
+        for minidrone in minidrones:
+            if (minidrone.name == name):
+                return minidrone
+
+        matches = [minidrone for minidrone in minidrones if minidrone.name is not None and name in minidrone.name]
+        if (len(matches) == 1):
+            return matches[0]
+        return None
+
+    def wait_for_minidrone(self, name=None, timeout=10.0):
+        """
+        Wait until a minidrone is heard (starts the scanner if needed)
+
+        :param name: name of the minidrone to wait for (None for any minidrone)
+        :param timeout: maximum seconds to wait
+        :return: the minidrone with this name (the closest minidrone if name is None) or None on a timeout
+        """
+        if (not self._running):
+            self.start()
+
+        def find():
+            if (name is None):
+                closest = self.get_closest(1)
+                return closest[0] if closest else None
+            return self.find_by_name(name)
+
+        end_time = time.monotonic() + timeout
+        minidrone = find()
+        while (minidrone is None):
+            remaining = end_time - time.monotonic()
+            if (remaining <= 0):
+                break
+            with self._found:
+                self._found.wait(min(remaining, 0.5))
+            minidrone = find()
+        return minidrone
+
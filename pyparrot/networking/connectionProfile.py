@@ -0,0 +1,158 @@
+"""
+Remembers how each drone was last reached so the next connect can skip the slow discovery:
+
+    - ConnectionProfileCache: for wifi drones, the IP address, handshake port and the c2d port the drone gave
+      us (so connect doesn't have to wait for mDNS)
+    - BLEHandleCache: for BLE drones, the GATT handles of the characteristics (so a reconnect doesn't have to
+      walk all of the services and characteristics again)
+
+The profiles are kept in small JSON files in the pyparrot cache directory (see DroneProtocol.get_cache_dir).
+
+Author: Amy McGovern, dramymcgovern@gmail.com
+"""
+import json
+import os
+import threading
+import time
+from os.path import join
+from pyparrot.utils.colorPrint import color_print
+from pyparrot.commandsandsensors.DroneProtocol import get_cache_dir
+
+
+class ConnectionProfileCache:
+    def __init__(self, cache_file=None):
+        """
+        :param cache_file: path of the JSON file (defaults to connections.json in the pyparrot cache directory)
+        """
+        if (cache_file is None):
+            cache_file = join(get_cache_dir(), "connections.json")
+        self.cache_file = cache_file
+
+        # several connections (e.g. a Fleet) can save at the same time
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """
+        :return: dictionary of drone name -> profile (empty if the file is missing or unreadable)
+        """
+        try:
+            with open(self.cache_file, 'r') as cache:
+                profiles = json.load(cache)
+            if (isinstance(profiles, dict)):
+                return profiles
+        except Exception:
+            pass
+        return dict()
+
+    def get(self, drone_name):
+        """
+        :param drone_name: name the profile was saved under
+        :return: dictionary with address, port and c2d_port (None if there is no profile for this drone)
+        """
+        profile = self._load().get(drone_name)
+        if (profile is None or "address" not in profile or "port" not in profile):
+            return None
+        return profile
+
+    def save(self, drone_name, address, port, c2d_port):
+        """
+        Save (or replace) the profile of a drone.  Failures are ignored (the cache is only an optimization).
+
+        :param drone_name: name to save the profile under
+        :param address: IP address of the drone
+        :param port: TCP port of the handshake
+        :param c2d_port: UDP port the drone listens to (from the handshake)
+        """
+        self._save_profile(drone_name, {"address": address, "port": port, "c2d_port": c2d_port,
+                                        "saved": time.time()})
+
+    def _save_profile(self, drone_name, profile):
+        """
+        Save (or replace) one profile in the file
+        """
+        with self._lock:
+            profiles = self._load()
+            profiles[drone_name] = profile
+            self._write(profiles)
+
+    def _write(self, profiles):
+        """
+        Write all of the profiles to the file.  Failures are ignored (the cache is only an optimization).
+        """
+        tmp_file = "%s.%d.tmp" % (self.cache_file, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(tmp_file, 'w') as cache:
+                json.dump(profiles, cache, indent=2)
+
+            # write then rename so another process never sees a half written file
+            os.replace(tmp_file, self.cache_file)
+        except Exception:
+            color_print("Could not write the connection profiles to %s" % self.cache_file, "WARN")
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+
+    def remove(self, drone_name):
+        """
+        Forget the profile of a drone (e.g. it moved to a new address)
+
+        :param drone_name: name the profile was saved under
+        """
+        with self._lock:
+            profiles = self._load()
+            if (drone_name not in profiles):
+                return
+            del profiles[drone_name]
+            self._write(profiles)
+
+
+class BLEHandleCache(ConnectionProfileCache):
+    """
+    GATT handles of each BLE drone, kept in memory (for reconnects) and on disk (for the next program).
+    A profile holds, for each group of characteristics (send, receive, ftp and handshake), the name of each
+    characteristic -> [uuid, handle, properties, value handle].
+    """
+
+    # address -> profile, shared by every connection in this process
+    _memory = dict()
+
+    def __init__(self, cache_file=None):
+        """
+        :param cache_file: path of the JSON file (defaults to ble-handles.json in the pyparrot cache directory)
+        """
+        if (cache_file is None):
+            cache_file = join(get_cache_dir(), "ble-handles.json")
+        ConnectionProfileCache.__init__(self, cache_file)
+
+    def get(self, address):
+        """
+        :param address: BLE address of the drone
+        :return: the saved handles (None if this drone has none)
+        """
+        profile = BLEHandleCache._memory.get(address)
+        if (profile is None):
+            profile = self._load().get(address)
+            if (profile is not None):
+                BLEHandleCache._memory[address] = profile
+        return profile
+
+    def save(self, address, handles):
+        """
+        Save the handles of a drone
+
+        :param address: BLE address of the drone
+        :param handles: dictionary of group -> characteristic name -> [uuid, handle, properties, value handle]
+        """
+        BLEHandleCache._memory[address] = handles
+        self._save_profile(address, handles)
+
+    def remove(self, address):
+        """
+        Forget the handles of a drone (e.g. they did not work anymore after a firmware update)
+
+        :param address: BLE address of the drone
+        """
+        BLEHandleCache._memory.pop(address, None)
+        ConnectionProfileCache.remove(self, address)
@@ -0,0 +1,196 @@
+"""
+Parse/dispatch stage for the frames from the drone.  The receive thread only drains the socket, acks and
+pongs; the frames are handed to this dispatcher which parses them and calls the sensor updates (and so the
+user callback) on its own thread.  A slow user callback then delays the sensors instead of the acks.
+
+Frames the drone sends as LOW_LATENCY_DATA skip ahead of everything else and are never dropped, and the time
+they wait between the receive thread and their dispatch is measured separately.
+
+The frames the drone wants acked (events such as flying state changes) are never dropped since the drone will
+not resend a frame we acked.  The other frames (navdata the drone streams over and over) go in a bounded queue
+with an overflow policy:
+
+    OVERFLOW_DROP_OLDEST: drop the oldest queued frame (the newest values win)
+    OVERFLOW_DROP_NEWEST: drop the frame that just arrived
+    OVERFLOW_BLOCK: make the receive thread wait for room (the kernel socket buffer takes up the slack)
+
+Author: Amy McGovern, dramymcgovern@gmail.com
+"""
+import threading
+import time
+from collections import deque
+from pyparrot.utils.colorPrint import color_print
+
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+OVERFLOW_BLOCK = "block"
+
+
+class FrameDispatcher:
+    def __init__(self, handle_function, max_queue_size=128, overflow_policy=OVERFLOW_DROP_OLDEST):
+        """
+        :param handle_function: function(packet_type, buffer_id, sequence_number, data) that parses the frame
+        :param max_queue_size: maximum number of frames waiting that may be dropped
+        :param overflow_policy: OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST or OVERFLOW_BLOCK
+        """
+        if (overflow_policy not in (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_BLOCK)):
+            color_print("Error: %s is not a valid overflow policy, using %s" % (overflow_policy, OVERFLOW_DROP_OLDEST),
+                        "ERROR")
+            overflow_policy = OVERFLOW_DROP_OLDEST
+
+        self.handle_function = handle_function
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+
+        # low latency frames (time received, frame) and acked frames are never dropped, the other frames are bounded
+        self.low_latency_frames = deque()
+        self.acked_frames = deque()
+        self.frames = deque()
+
+        self._wakeup = threading.Event()
+        self._room = threading.Condition()
+        self._running = False
+        self._thread = None
+
+        self.num_dispatched = 0
+        self.num_dropped = 0
+        self.num_blocked = 0
+        self.high_water_mark = 0
+
+        self.num_low_latency = 0
+        self.total_low_latency_delay = 0.0
+        self.max_low_latency_delay = 0.0
+
+    def start(self):
+        """
+        Start the dispatch thread
+        """
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the dispatch thread (the frames still queued are dropped)
+        """
+        self._running = False
+        self._wakeup.set()
+        with self._room:
+            self._room.notify_all()
+
+        if (self._thread is not None and self._thread is not threading.current_thread()):
+            self._thread.join()
+        self._thread = None
+
+        self.low_latency_frames.clear()
+        self.acked_frames.clear()
+        self.frames.clear()
+
+    def is_running(self):
+        """
+        :return: True if the dispatch thread is running
+        """
+        return self._running
+
+    def put(self, packet_type, buffer_id, sequence_number, data, acked, low_latency=False):
+        """
+        Queue a frame for the dispatch thread.  If the thread is not running, the frame is handled now.
+
+        :param packet_type: data type of the frame
+        :param buffer_id: buffer the frame came on
+        :param sequence_number: sequence number of the frame
+        :param data: payload of the frame (copied since the receive buffer is reused)
+        :param acked: True if the frame was acked (it is then never dropped)
+        :param low_latency: True for a LOW_LATENCY_DATA frame (dispatched before all of the others)
+        """
+        if (not self._running):
+            self.handle_function(packet_type, buffer_id, sequence_number, data)
+            return
+
+        frame = (packet_type, buffer_id, sequence_number, bytes(data))
+        if (low_latency):
+            self.low_latency_frames.append((time.monotonic(), frame))
+        elif (acked):
+            self.acked_frames.append(frame)
+        else:
+            if (len(self.frames) >= self.max_queue_size):
+                if (self.overflow_policy == OVERFLOW_DROP_NEWEST):
+                    self.num_dropped += 1
+                    return
+                elif (self.overflow_policy == OVERFLOW_DROP_OLDEST):
+                    try:
+                        self.frames.popleft()
+                        self.num_dropped += 1
+                    except IndexError:
+                        pass
+                else:
+                    self.num_blocked += 1
+                    with self._room:
+                        while (len(self.frames) >= self.max_queue_size and self._running):
+                            self._room.wait(0.1)
+
+            self.frames.append(frame)
+
+        self.high_water_mark = max(self.high_water_mark, self._depth())
+        self._wakeup.set()
+
+    def _depth(self):
+        return len(self.low_latency_frames) + len(self.acked_frames) + len(self.frames)
+
+    def _next_frame(self):
+        """
+        :return: the next frame to handle (low latency first, then acked) or None if there are none
+        """
+        if (self.low_latency_frames):
+            (receive_time, frame) = self.low_latency_frames.popleft()
+            delay = time.monotonic() - receive_time
+            self.num_low_latency += 1
+            self.total_low_latency_delay += delay
+            self.max_low_latency_delay = max(self.max_low_latency_delay, delay)
+            return frame
+
+        if (self.acked_frames):
+            return self.acked_frames.popleft()
+
+        try:
+            frame = self.frames.popleft()
+        except IndexError:
+            return None
+
+        if (self.overflow_policy == OVERFLOW_BLOCK):
+            with self._room:
+                self._room.notify()
+        return frame
+
+    def _run(self):
+        while (self._running):
+            self._wakeup.wait(0.5)
+            self._wakeup.clear()
+
+            frame = self._next_frame()
+            while (frame is not None and self._running):
+                try:
+                    self.handle_function(*frame)
+                except Exception as e:
+                    color_print("Error handling data from the drone: %s" % e, "ERROR")
+                self.num_dispatched += 1
+                frame = self._next_frame()
+
+    def get_stats(self):
+        """
+        :return: dictionary with the current queue depth, the highest depth seen, the number of frames
+                 dispatched, dropped and that had to wait for room, and the number of low latency frames with the
+                 mean and maximum seconds they waited to be dispatched
+        """
+        return {
+            'depth': self._depth(),
+            'high_water_mark': self.high_water_mark,
+            'num_dispatched': self.num_dispatched,
+            'num_dropped': self.num_dropped,
+            'num_blocked': self.num_blocked,
+            'num_low_latency': self.num_low_latency,
+            'low_latency_mean_delay': (self.total_low_latency_delay / self.num_low_latency
+                                       if self.num_low_latency > 0 else 0.0),
+            'low_latency_max_delay': self.max_low_latency_delay,
+        }
@@ -0,0 +1,283 @@
+"""
+Watches the quality of the wifi link using the ARSDK ping/pong traffic that already flows.  The drone pings us
+about every second and each PING carries the drone's timestamp, so the monitor records
+
+    - the interval between the drone's pings (a gap means pings were lost, a stall means none for a while)
+    - the one-way delay variation: how much later than the fastest ping each ping arrived (the clocks are not
+      synchronized so only the variation is meaningful, it shows queueing on the link)
+    - how long our PONG took to go out after the drone's PING arrived (our share of the drone's round trip)
+
+Nothing is sent for this.  Active probing is optional (set_active_probing): we then also ping the drone every
+ping_interval seconds and record the round trip time of our pings from the PONGs echoing our timestamp.
+
+Each series is kept in a fixed size ring so the percentiles cover the recent past.  When the link looks bad
+(a stall or, with active probing, a high round trip time) the "link degraded" callback is called, and called
+again once it recovers, so mission logic can react before the drone hits its own connection timeout.  The
+checks run as the pings arrive; a timer thread only runs when there is a callback or active probing, so that a
+stall is noticed even when nothing arrives.
+
+Author: Amy McGovern, dramymcgovern@gmail.com
+"""
+import struct
+import threading
+import time
+from collections import deque
+from pyparrot.utils.colorPrint import color_print
+
+
+def _percentile(sorted_values, percent):
+    """
+    :return: the percent (0-100) percentile of a sorted list (nearest rank), None if it is empty
+    """
+    if (len(sorted_values) == 0):
+        return None
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class LinkMonitor:
+    def __init__(self, send_ping_function=None, ring_size=256, ping_interval=1.0, stall_timeout=1.5,
+                 max_rtt=0.3, rtt_alpha=0.25):
+        """
+        :param send_ping_function: function that sends a ping with the given payload (only used with active
+                                   probing)
+        :param ring_size: number of samples kept for each series
+        :param ping_interval: seconds between our pings (and between the stall checks of the timer thread)
+        :param stall_timeout: the link is degraded if no ping came from the drone for this many seconds
+        :param max_rtt: the link is degraded if the smoothed round trip time is above this many seconds
+        :param rtt_alpha: weight of a new round trip time in the smoothed one
+        """
+        self.send_ping_function = send_ping_function
+        self.ping_interval = ping_interval
+        self.stall_timeout = stall_timeout
+        self.max_rtt = max_rtt
+        self.rtt_alpha = rtt_alpha
+        self.active_probing = False
+
+        self.ping_intervals = deque(maxlen=ring_size)
+        self.delay_variations = deque(maxlen=ring_size)
+        self.pong_delays = deque(maxlen=ring_size)
+        self.rtts = deque(maxlen=ring_size)
+
+        self.degraded_callback_function = None
+        self.degraded_callback_args = None
+
+        self._started = False
+        self._running = False
+        self._thread = None
+        self._wakeup = threading.Event()
+
+        # the pings come on the receive thread, the pongs go out on the sender thread and the timer thread
+        # checks for stalls
+        self._lock = threading.Lock()
+
+        self.reset()
+
+    def reset(self):
+        """
+        Forget all of the samples (e.g. on a new connection)
+        """
+        self.ping_intervals.clear()
+        self.delay_variations.clear()
+        self.pong_delays.clear()
+        self.rtts.clear()
+
+        self.last_ping_time = None
+        self.min_delay = None
+        self.smoothed_rtt = None
+
+        self.num_pings = 0
+        self.num_pongs = 0
+        self.num_gaps = 0
+        self.num_stalls = 0
+
+        self.is_degraded = False
+        self.degraded_reason = None
+
+    def set_degraded_callback(self, function, args):
+        """
+        Set the function called when the link becomes degraded and when it recovers.  It is called as
+        function(degraded, reason, args) where degraded is True or False and reason is a string.
+
+        :param function: name of the callback function
+        :param args: arguments (tuple) to the function
+        """
+        self.degraded_callback_function = function
+        self.degraded_callback_args = args
+        self._start_thread_if_needed()
+
+    def set_active_probing(self, active):
+        """
+        Also ping the drone every ping_interval seconds to measure the round trip time (off by default: the
+        monitor then only uses the drone's pings)
+
+        :param active: True to send our own pings and False to stop
+        """
+        self.active_probing = active
+        self._start_thread_if_needed()
+
+    def start(self):
+        """
+        The connection is up (starts the timer thread if there is a callback or active probing)
+        """
+        self._started = True
+        self._start_thread_if_needed()
+
+    def stop(self):
+        """
+        The connection is going down (stops the timer thread)
+        """
+        self._started = False
+        self._running = False
+        self._wakeup.set()
+        if (self._thread is not None and self._thread is not threading.current_thread()):
+            self._thread.join()
+        self._thread = None
+
+    def _start_thread_if_needed(self):
+        with self._lock:
+            if (not self._started or self._thread is not None):
+                return
+            if (not self.active_probing and self.degraded_callback_function is None):
+                return
+
+            self._running = True
+            self._wakeup.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while (self._running):
+            if (self.active_probing and self.send_ping_function is not None):
+                self.send_ping_function(self._make_ping())
+            self.check()
+            self._wakeup.wait(self.ping_interval)
+
+    def _make_ping(self):
+        """
+        :return: payload of our ping (our clock as seconds and nanoseconds, like the drone's pings)
+        """
+        now = time.monotonic()
+        seconds = int(now)
+        return struct.pack("<qq", seconds, int((now - seconds) * 1e9))
+
+    def _parse_timestamp(self, data):
+        """
+        :return: the timestamp in a ping (seconds) or None if the payload is not one
+        """
+        if (len(data) == 16):
+            (seconds, nanoseconds) = struct.unpack("<qq", data)
+        elif (len(data) == 8):
+            (seconds, nanoseconds) = struct.unpack("<ii", data)
+        else:
+            return None
+        return seconds + nanoseconds / 1e9
+
+    def on_ping(self, data):
+        """
+        Record a PING from the drone (called by the connection for every ping)
+
+        :param data: payload of the ping
+        """
+        now = time.monotonic()
+        self.num_pings += 1
+
+        if (self.last_ping_time is not None):
+            interval = now - self.last_ping_time
+            self.ping_intervals.append(interval)
+            if (interval > 2 * self.ping_interval):
+                self.num_gaps += 1
+        self.last_ping_time = now
+
+        drone_time = self._parse_timestamp(data)
+        if (drone_time is not None):
+            delay = now - drone_time
+            if (self.min_delay is None or delay < self.min_delay):
+                self.min_delay = delay
+            self.delay_variations.append(delay - self.min_delay)
+
+        self.check()
+
+    def on_pong_sent(self, delay):
+        """
+        Record how long our PONG to a drone's PING took to go out (called by the connection as it sends it)
+
+        :param delay: seconds between the PING arriving and the PONG being sent
+        """
+        self.pong_delays.append(delay)
+
+    def on_pong(self, data):
+        """
+        Record the drone's PONG to one of our pings (only with active probing)
+
+        :param data: payload of the pong (our timestamp)
+        """
+        sent_time = self._parse_timestamp(data)
+        if (sent_time is None):
+            return
+
+        rtt = time.monotonic() - sent_time
+        if (rtt < 0 or rtt > 60):
+            # not one of ours
+            return
+
+        self.num_pongs += 1
+        self.rtts.append(rtt)
+        if (self.smoothed_rtt is None):
+            self.smoothed_rtt = rtt
+        else:
+            self.smoothed_rtt = (1 - self.rtt_alpha) * self.smoothed_rtt + self.rtt_alpha * rtt
+
+        self.check()
+
+    def check(self):
+        """
+        Decide if the link is degraded and call the callback if that changed
+        """
+        reason = None
+        if (self.last_ping_time is not None and time.monotonic() - self.last_ping_time > self.stall_timeout):
+            reason = "no ping from the drone for %.1f seconds" % (time.monotonic() - self.last_ping_time)
+        elif (self.smoothed_rtt is not None and self.smoothed_rtt > self.max_rtt):
+            reason = "round trip time is %.3f seconds" % self.smoothed_rtt
+
+        degraded = (reason is not None)
+        with self._lock:
+            if (degraded == self.is_degraded):
+                return
+            self.is_degraded = degraded
+            self.degraded_reason = reason
+
+        if (degraded):
+            if (reason.startswith("no ping")):
+                self.num_stalls += 1
+            color_print("link degraded: %s" % reason, "WARN")
+        else:
+            color_print("link recovered", "INFO")
+
+        if (self.degraded_callback_function is not None):
+            self.degraded_callback_function(degraded, reason, self.degraded_callback_args)
+
+    def get_stats(self):
+        """
+        :return: dictionary with the counts and the 50th, 90th and 99th percentiles (seconds) of the ping
+                 intervals, the one-way delay variation, the delay of our pongs and the round trip time (None
+                 without active probing)
+        """
+        # a stall is only noticed when checked
+        self.check()
+
+        stats = {
+            'num_pings': self.num_pings,
+            'num_pongs': self.num_pongs,
+            'num_gaps': self.num_gaps,
+            'num_stalls': self.num_stalls,
+            'is_degraded': self.is_degraded,
+            'smoothed_rtt': self.smoothed_rtt,
+        }
+        for (name, ring) in (('ping_interval', self.ping_intervals), ('delay_variation', self.delay_variations),
+                             ('pong_delay', self.pong_delays), ('rtt', self.rtts)):
+            values = sorted(ring)
+            for percent in (50, 90, 99):
+                stats['%s_p%d' % (name, percent)] = _percentile(values, percent)
+        return stats
@@ -0,0 +1,181 @@
+"""
+Background thread that sends PCMD at a fixed rate.  The control code (e.g. a vision loop) only sets
+the newest setpoint with set_setpoint() and never blocks: every tick the thread sends whatever setpoint
+is the most recent one.  If no new setpoint arrives for setpoint_timeout seconds, the thread falls back
+to hovering (all zeros) until a new one comes in.
+
+The ticks are scheduled on the monotonic clock from the start time (not from the previous send) so
+slow sends or sleeps do not make the rate drift.
+
+Author: Amy McGovern, dramymcgovern@gmail.com
+"""
+import threading
+import time
+import math
+from pyparrot.utils.colorPrint import color_print
+
+
+class PCMDScheduler:
+    def __init__(self, drone_connection, command_tuple, rate=30, setpoint_timeout=0.5):
+        """
+        :param drone_connection: the WifiConnection (or BLEConnection) used to send the PCMD packets
+        :param command_tuple: the PCMD command tuple from the command parser
+        :param rate: number of PCMD packets to send per second
+        :param setpoint_timeout: seconds without a new setpoint before the drone is told to hover
+        """
+        self.drone_connection = drone_connection
+        self.command_tuple = command_tuple
+        self.period = 1.0 / rate
+        self.setpoint_timeout = setpoint_timeout
+
+        # (roll, pitch, yaw, vertical_movement) and the time it was set.  The tuple is replaced
+        # as a whole so the sending thread never sees half of an update.
+        self._setpoint = (0, 0, 0, 0)
+        self._setpoint_time = None
+
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.num_sends = 0
+        self.num_hover_sends = 0
+        self.num_missed_ticks = 0
+        self._start_time = None
+        self._last_send_time = None
+
+        # running mean and variance (Welford) of the time between sends
+        self._num_periods = 0
+        self._mean_period = 0.0
+        self._m2_period = 0.0
+        self._max_jitter = 0.0
+
+    def set_setpoint(self, roll, pitch, yaw, vertical_movement):
+        """
+        Set the values to send from now on (returns right away).  Each value ranges from -100 to 100
+        and is clipped to that range.
+
+        :param roll: roll in -100 to 100
+        :param pitch: pitch in -100 to 100
+        :param yaw: yaw in -100 to 100
+        :param vertical_movement: vertical speed in -100 to 100
+        :return: nothing
+        """
+        self._setpoint = (self._clip(roll), self._clip(pitch), self._clip(yaw), self._clip(vertical_movement))
+        self._setpoint_time = time.monotonic()
+
+    def _clip(self, value):
+        return int(min(100, max(-100, value)))
+
+    def start(self):
+        """
+        Start the sending thread (the drone hovers until the first setpoint arrives)
+
+        :return: nothing
+        """
+        if (self._thread is not None and self._thread.is_alive()):
+            color_print("PCMD scheduler is already running", "WARN")
+            return
+
+        self._setpoint = (0, 0, 0, 0)
+        self._setpoint_time = None
+        self._reset_stats()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the sending thread.  The last packet sent is a hover so the drone does not keep
+        going with the last setpoint.
+
+        :return: nothing
+        """
+        if (self._thread is None):
+            return
+
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        self.drone_connection.send_single_pcmd_command(self.command_tuple, 0, 0, 0, 0)
+
+    def is_running(self):
+        """
+        :return: True if the sending thread is running
+        """
+        return (self._thread is not None and self._thread.is_alive())
+
+    def _run(self):
+        self._start_time = time.monotonic()
+        next_tick = self._start_time
+
+        while (not self._stop_event.is_set()):
+            now = time.monotonic()
+            if (now < next_tick):
+                self._stop_event.wait(next_tick - now)
+                continue
+
+            self._send(now)
+
+            # schedule from the start time so the rate does not drift.  If we fell behind by
+            # more than a tick, skip the missed ticks instead of sending a burst to catch up.
+            next_tick += self.period
+            if (now - next_tick > self.period):
+                missed = int((now - next_tick) / self.period)
+                self.num_missed_ticks += missed
+                next_tick += missed * self.period
+
+    def _send(self, now):
+        setpoint_time = self._setpoint_time
+        if (setpoint_time is None or now - setpoint_time > self.setpoint_timeout):
+            (roll, pitch, yaw, vertical_movement) = (0, 0, 0, 0)
+            self.num_hover_sends += 1
+        else:
+            (roll, pitch, yaw, vertical_movement) = self._setpoint
+
+        try:
+            self.drone_connection.send_single_pcmd_command(self.command_tuple, roll, pitch, yaw, vertical_movement)
+        except Exception as e:
+            color_print("PCMD scheduler failed to send: %s" % e, "ERROR")
+
+        if (self._last_send_time is not None):
+            self._add_period(now - self._last_send_time)
+        self._last_send_time = now
+        self.num_sends += 1
+
+    def _add_period(self, period):
+        self._num_periods += 1
+        delta = period - self._mean_period
+        self._mean_period += delta / self._num_periods
+        self._m2_period += delta * (period - self._mean_period)
+        self._max_jitter = max(self._max_jitter, abs(period - self.period))
+
+    def get_stats(self):
+        """
+        Rate and jitter of the packets sent so far
+
+        :return: dictionary with the target and achieved rate (Hz), the mean period, the jitter
+        (standard deviation of the time between sends) and the largest difference from the target
+        period (seconds), and the number of sends, hover sends and missed ticks
+        """
+        if (self._last_send_time is None):
+            elapsed = 0.0
+        else:
+            elapsed = self._last_send_time - self._start_time
+
+        if (self._num_periods > 1):
+            jitter = math.sqrt(self._m2_period / (self._num_periods - 1))
+        else:
+            jitter = 0.0
+
+        return {
+            'target_rate': 1.0 / self.period,
+            'achieved_rate': (self.num_sends - 1) / elapsed if elapsed > 0 else 0.0,
+            'mean_period': self._mean_period,
+            'jitter': jitter,
+            'max_jitter': self._max_jitter,
+            'num_sends': self.num_sends,
+            'num_hover_sends': self.num_hover_sends,
+            'num_missed_ticks': self.num_missed_ticks,
+        }
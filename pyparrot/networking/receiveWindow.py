@@ -0,0 +1,105 @@
+"""
+Tracks the sequence numbers of the frames received on one buffer of the drone.  The drone resends a
+DATA_WITH_ACK frame when our ack is late, so the same frame can arrive more than once, and frames on the
+NO_ACK buffer can be lost or arrive out of order.  The window remembers which of the last window_size
+sequence numbers were seen (a sliding bitmask, as for anti-replay windows) so duplicates are spotted, and it
+counts the frames lost, reordered and duplicated on the way.
+
+Author: Amy McGovern, dramymcgovern@gmail.com
+"""
+
+# results of ReceiveWindow.receive
+FRAME_NEW = 0         # next frame (or ahead of the next one, the ones in between are counted as lost)
+FRAME_LATE = 1        # older than the newest frame but not seen yet (it was counted as lost)
+FRAME_DUPLICATE = 2   # already received
+
+
+class ReceiveWindow:
+    def __init__(self, window_size=32):
+        """
+        :param window_size: number of sequence numbers (behind the newest one) remembered for finding
+                            duplicates.  A frame further behind than this is taken as the drone restarting its
+                            sequence numbers.
+        """
+        self.window_size = window_size
+        self._mask = (1 << window_size) - 1
+        self.reset()
+
+    def reset(self):
+        """
+        Forget all of the sequence numbers and counters (e.g. on a new connection)
+        """
+        self.last_seq = None
+
+        # bit i is set if last_seq - i has been received
+        self.seen = 0
+
+        self.num_received = 0
+        self.num_duplicates = 0
+        self.num_lost = 0
+        self.num_reordered = 0
+        self.num_resyncs = 0
+
+    def receive(self, seq_id):
+        """
+        Record a frame
+
+        :param seq_id: sequence number of the frame (0-255)
+        :return: FRAME_NEW, FRAME_LATE or FRAME_DUPLICATE
+        """
+        self.num_received += 1
+
+        if (self.last_seq is None):
+            self.last_seq = seq_id
+            self.seen = 1
+            return FRAME_NEW
+
+        ahead = (seq_id - self.last_seq) % 256
+        if (ahead == 0):
+            self.num_duplicates += 1
+            return FRAME_DUPLICATE
+
+        if (ahead < 128):
+            # newer frame: the ones we skipped are lost unless they show up late
+            self.num_lost += ahead - 1
+            self.seen = ((self.seen << ahead) | 1) & self._mask
+            self.last_seq = seq_id
+            return FRAME_NEW
+
+        behind = 256 - ahead
+        if (behind >= self.window_size):
+            # too old to be a late frame so the drone must have started over
+            self.num_resyncs += 1
+            self.last_seq = seq_id
+            self.seen = 1
+            return FRAME_NEW
+
+        if (self.seen & (1 << behind)):
+            self.num_duplicates += 1
+            return FRAME_DUPLICATE
+
+        self.seen |= (1 << behind)
+        self.num_lost -= 1
+        self.num_reordered += 1
+        return FRAME_LATE
+
+    def get_stats(self):
+        """
+        :return: dictionary with the number of frames received, duplicated, lost, reordered (arrived after a
+                 newer one) and the number of times the sequence numbers started over
+        """
+        num_expected = self.num_received - self.num_duplicates + self.num_lost
+        return {
+            'num_received': self.num_received,
+            'num_duplicates': self.num_duplicates,
+            'num_lost': self.num_lost,
+            'num_reordered': self.num_reordered,
+            'num_resyncs': self.num_resyncs,
+            'loss_rate': self.num_lost / num_expected if num_expected > 0 else 0.0,
+        }
+
+    def __str__(self):
+        stats = self.get_stats()
+        return ("%d frames, %d lost (%.1f%%), %d reordered, %d duplicates" %
+                (stats['num_received'], stats['num_lost'], 100.0 * stats['loss_rate'], stats['num_reordered'],
+                 stats['num_duplicates']))
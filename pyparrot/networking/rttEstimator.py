@@ -0,0 +1,100 @@
+"""
+Round trip time estimator for acked commands (used by both the wifi and the BLE connections).
+
+This is the TCP retransmission timer from RFC 6298: a smoothed round trip time (SRTT) and its
+variation (RTTVAR) are updated from every ack and the retransmission timeout is
+RTO = SRTT + 4 * RTTVAR, clamped to [min_rto, max_rto].  Each timeout doubles the RTO (backoff)
+until a new sample comes in.  Samples from retransmitted packets must not be added since there is
+no way to know which send the ack belongs to (Karn's algorithm).
+
+Author: Amy McGovern, dramymcgovern@gmail.com
+"""
+import threading
+
+
+class RTTEstimator:
+    def __init__(self, initial_rto=0.5, min_rto=0.15, max_rto=3.0, alpha=0.125, beta=0.25):
+        """
+        :param initial_rto: timeout (seconds) to use until the first ack is measured
+        :param min_rto: smallest timeout allowed (seconds).  Well below the fixed 0.5 seconds used before so a
+                        fast link resends sooner (a resend keeps its sequence number so the drone drops the
+                        duplicate if the ack was only late)
+        :param max_rto: largest timeout allowed, including backoff (seconds)
+        :param alpha: gain for the smoothed round trip time
+        :param beta: gain for the round trip time variation
+        """
+        self.initial_rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.alpha = alpha
+        self.beta = beta
+
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget all of the measurements (e.g. after a reconnect)
+        """
+        with self._lock:
+            self.srtt = None
+            self.rttvar = None
+            self.last_rtt = None
+            self.rto = self.initial_rto
+            self.num_samples = 0
+            self.num_timeouts = 0
+
+    def add_sample(self, rtt):
+        """
+        Update the estimates with a measured round trip time (only for packets that were sent once)
+
+        :param rtt: seconds between sending the packet and receiving its ack
+        """
+        with self._lock:
+            if (self.srtt is None):
+                self.srtt = rtt
+                self.rttvar = rtt / 2.0
+            else:
+                self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+                self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+
+            self.last_rtt = rtt
+            self.num_samples += 1
+            self.rto = min(self.max_rto, max(self.min_rto, self.srtt + 4 * self.rttvar))
+
+    def backoff(self):
+        """
+        A packet timed out: double the timeout (up to max_rto)
+        """
+        with self._lock:
+            self.num_timeouts += 1
+            self.rto = min(self.max_rto, self.rto * 2)
+
+    def get_rto(self):
+        """
+        :return: the current retransmission timeout in seconds
+        """
+        return self.rto
+
+    def get_stats(self):
+        """
+        Current estimates of the link, e.g. to watch the link quality
+
+        :return: dictionary with srtt, rttvar, last_rtt and rto (seconds) and the sample and timeout counts
+        """
+        with self._lock:
+            return {
+                'srtt': self.srtt,
+                'rttvar': self.rttvar,
+                'last_rtt': self.last_rtt,
+                'rto': self.rto,
+                'num_samples': self.num_samples,
+                'num_timeouts': self.num_timeouts,
+            }
+
+    def __str__(self):
+        stats = self.get_stats()
+        if (stats['srtt'] is None):
+            return "rtt: no samples, rto %.3f s" % stats['rto']
+        return "rtt: srtt %.3f s, rttvar %.3f s, rto %.3f s (%d samples, %d timeouts)" % (
+            stats['srtt'], stats['rttvar'], stats['rto'], stats['num_samples'], stats['num_timeouts'])
@@ -0,0 +1,263 @@
+"""
+Single sender thread for the wifi connection.  Every outgoing frame goes through one of the lanes below and
+only the sender thread assigns sequence numbers, encodes and sends, so the user thread, the listener thread
+(acks and pongs) and the vision threads can all send without racing on the sequence counters.  The lanes are
+emptied in priority order: an emergency or an ack never waits behind a command.
+
+The lanes are deques (append and popleft are atomic) so queueing a frame never takes a lock.
+
+The ARSDK allows several frames in one datagram, so the sender can optionally pack the frames queued within
+a short window into one sendto (set_batching).  That cuts the number of tiny datagrams during bursts, e.g.
+acking the flood of state frames after ask_for_state_update while PCMD is streaming.
+
+Author: Amy McGovern, dramymcgovern@gmail.com
+"""
+import threading
+import time
+from collections import deque
+from pyparrot.utils.colorPrint import color_print
+
+# lanes in priority order
+LANE_HIGH_PRIORITY = 0   # buffer 12 (emergency)
+LANE_ACK = 1             # acks of the drone's data and pongs
+LANE_PCMD = 2            # buffer 10 (PCMD and the other commands without an ack)
+LANE_COMMAND = 3         # buffer 11 (commands with an ack)
+
+lane_names = ("high_priority", "ack", "pcmd", "command")
+
+# largest UDP payload that fits in one ethernet/wifi frame (1500 byte MTU - 20 byte IP header - 8 byte UDP header)
+max_batch_size = 1472
+
+
+class SendRequest:
+    """
+    One frame waiting in a lane.  The sender fills in seq_id, packet and send_time when it is sent.
+    """
+    def __init__(self, lane, sequence_key, build):
+        """
+        :param lane: lane number
+        :param sequence_key: key of the sequence counter to use (None if the packet already has one)
+        :param build: function that takes the sequence number and returns the packet
+        """
+        self.lane = lane
+        self.sequence_key = sequence_key
+        self.build = build
+        self.queue_time = time.monotonic()
+
+        self.seq_id = None
+        self.packet = None
+        self.send_time = None
+        self._sent = threading.Event()
+
+    def wait_sent(self, timeout=None):
+        """
+        Wait until the sender has sent the frame
+
+        :param timeout: maximum number of seconds to wait (None to wait forever)
+        :return: True if the frame was sent
+        """
+        return self._sent.wait(timeout)
+
+
+class SendQueue:
+    def __init__(self, send_function, next_sequence_function):
+        """
+        :param send_function: function that sends a packet (called from the sender thread only)
+        :param next_sequence_function: function that returns the next sequence number for a key
+        """
+        self.send_function = send_function
+        self.next_sequence_function = next_sequence_function
+
+        self.lanes = tuple(deque() for name in lane_names)
+        self._wakeup = threading.Event()
+        self._running = False
+        self._thread = None
+
+        self.num_sent = [0] * len(lane_names)
+        self.total_latency = [0.0] * len(lane_names)
+        self.max_latency = [0.0] * len(lane_names)
+
+        # batching is off until set_batching is called
+        self.batch_window = 0
+        self.max_batch_size = max_batch_size
+        self.num_datagrams = 0
+
+    def set_batching(self, batch_window=0.002, max_size=max_batch_size):
+        """
+        Pack the frames queued within batch_window seconds into one datagram (up to max_size bytes).
+        High priority frames are never held back for the window.
+
+        :param batch_window: seconds to wait for more frames before sending (0 turns batching off)
+        :param max_size: maximum size of a datagram in bytes (keep it under the path MTU)
+        """
+        self.batch_window = batch_window
+        self.max_batch_size = max_size
+
+    def start(self):
+        """
+        Start the sender thread
+        """
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Send whatever is still queued and stop the sender thread
+        """
+        self._running = False
+        self._wakeup.set()
+        if (self._thread is not None):
+            self._thread.join()
+            self._thread = None
+
+    def is_running(self):
+        """
+        :return: True if the sender thread is running
+        """
+        return self._running
+
+    def put(self, lane, sequence_key, build):
+        """
+        Queue a frame (returns right away).  If the sender thread is not running, the frame is sent now.
+
+        :param lane: one of the LANE_ constants
+        :param sequence_key: key of the sequence counter for this frame (None if build ignores the sequence)
+        :param build: function that takes the sequence number and returns the packet
+        :return: the SendRequest (wait_sent() tells when it has gone out)
+        """
+        request = SendRequest(lane, sequence_key, build)
+        if (self._running):
+            self.lanes[lane].append(request)
+            self._wakeup.set()
+        else:
+            self._send(request)
+        return request
+
+    def _run(self):
+        while (self._running):
+            self._wakeup.wait(0.5)
+            self._wakeup.clear()
+            self._send_all()
+
+        # don't drop what was queued right before stopping (e.g. a landing)
+        self._send_all()
+
+    def _next_request(self):
+        """
+        :return: the oldest request of the highest priority lane that is not empty (None if all are empty)
+        """
+        for lane in self.lanes:
+            if (lane):
+                return lane.popleft()
+        return None
+
+    def _send_all(self):
+        if (self.batch_window > 0):
+            self._send_batches()
+            return
+
+        # always go back to the highest priority lane after each frame
+        request = self._next_request()
+        while (request is not None):
+            self._send(request)
+            request = self._next_request()
+
+    def _send_batches(self):
+        # give the other threads a moment to queue more frames (but never delay an emergency)
+        if (not self.lanes[LANE_HIGH_PRIORITY]):
+            time.sleep(self.batch_window)
+
+        datagram = bytearray()
+        batch = []
+        request = self._next_request()
+        while (request is not None):
+            packet = self._build(request)
+            if (packet is not None):
+                if (batch and len(datagram) + len(packet) > self.max_batch_size):
+                    self._send_datagram(datagram, batch)
+                    datagram = bytearray()
+                    batch = []
+                datagram += packet
+                batch.append(request)
+            else:
+                self._sent(request)
+            request = self._next_request()
+
+        if (batch):
+            self._send_datagram(datagram, batch)
+
+    def _build(self, request):
+        """
+        Assign the sequence number and build the packet
+
+        :return: the packet (None if it could not be built)
+        """
+        if (request.sequence_key is not None):
+            request.seq_id = self.next_sequence_function(request.sequence_key)
+
+        request.send_time = time.monotonic()
+        try:
+            request.packet = request.build(request.seq_id)
+        except Exception as e:
+            color_print("Error building packet: %s" % e, "ERROR")
+        return request.packet
+
+    def _send(self, request):
+        packet = self._build(request)
+        if (packet is not None):
+            self._send_datagram(packet, [request])
+        else:
+            self._sent(request)
+
+    def _send_datagram(self, datagram, batch):
+        """
+        Send one datagram holding the packets of every request in batch
+        """
+        try:
+            self.send_function(datagram)
+        except Exception as e:
+            color_print("Error sending packet: %s" % e, "ERROR")
+
+        self.num_datagrams += 1
+        for request in batch:
+            self._sent(request)
+
+    def _sent(self, request):
+        # from queueing to handing the datagram to the kernel
+        latency = time.monotonic() - request.queue_time
+        self.num_sent[request.lane] += 1
+        self.total_latency[request.lane] += latency
+        self.max_latency[request.lane] = max(self.max_latency[request.lane], latency)
+
+        request._sent.set()
+
+    def get_stats(self):
+        """
+        :return: dictionary of lane name -> queue depth, number of frames sent and the mean and maximum
+                 time (seconds) from queueing to the end of the sendto
+        """
+        stats = dict()
+        for (lane_number, name) in enumerate(lane_names):
+            num_sent = self.num_sent[lane_number]
+            stats[name] = {
+                'depth': len(self.lanes[lane_number]),
+                'num_sent': num_sent,
+                'mean_latency': self.total_latency[lane_number] / num_sent if num_sent > 0 else 0.0,
+                'max_latency': self.max_latency[lane_number],
+            }
+        return stats
+
+    def get_batching_stats(self):
+        """
+        :return: dictionary with the number of frames and datagrams sent, the mean number of frames per datagram
+                 and the number of sendto calls saved by batching
+        """
+        num_frames = sum(self.num_sent)
+        return {
+            'num_frames': num_frames,
+            'num_datagrams': self.num_datagrams,
+            'frames_per_datagram': num_frames / self.num_datagrams if self.num_datagrams > 0 else 0.0,
+            'num_sends_saved': num_frames - self.num_datagrams,
+        }
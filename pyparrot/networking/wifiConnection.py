@@ -13,7 +13,20 @@ import json
 from pyparrot.utils.colorPrint import color_print
 import struct
 import threading
-from pyparrot.commandsandsensors.DroneSensorParser import get_data_format_and_size
+from collections import deque
+from pyparrot.commandsandsensors.DroneCommandEncoder import DroneCommandEncoder
+from pyparrot.networking.rttEstimator import RTTEstimator
+from pyparrot.networking.connectionProfile import ConnectionProfileCache
+from pyparrot.networking.frameDispatcher import FrameDispatcher
+from pyparrot.networking.linkMonitor import LinkMonitor
+from pyparrot.networking.receiveWindow import ReceiveWindow, FRAME_NEW, FRAME_DUPLICATE
+from pyparrot.networking.sendQueue import SendQueue, LANE_HIGH_PRIORITY, LANE_ACK, LANE_PCMD, LANE_COMMAND
+
+# header of every ARSDK frame: data type, buffer id, sequence number, frame size (including the header)
+_frame_header_struct = struct.Struct("<BBBI")
+
+# largest datagram we expect from the drone
+_max_datagram_size = 66000
 
 class mDNSListener(object):
     """
@@ -37,11 +50,19 @@ class mDNSListener(object):
 
 class WifiConnection:
 
-    def __init__(self, drone, drone_type="Bebop2", ip_address=None):
+    def __init__(self, drone, drone_type="Bebop2", ip_address=None, source_address=None, bind_interface=None):
         """
         Can be a connection to a Anafi, Bebop, Bebop2 or a Mambo right now
 
+        Every Anafi is at 192.168.42.1 and every Mambo at 192.168.99.3, so to fly several of them from one
+        machine each one needs its own wifi adapter.  Give either the local IP address of the adapter
+        (source_address) or its name (bind_interface, Linux only and needs root or CAP_NET_RAW) and all of
+        this drone's sockets are bound to that adapter.
+
         :param type: type of drone to connect to
+        :param ip_address: IP address of the drone (found with mDNS if None)
+        :param source_address: optional local IP address to send and receive from
+        :param bind_interface: optional network interface name (e.g. wlan1) to send and receive on
         """
         self.is_connected = False
         if (drone_type not in ("Anafi", "Bebop", "Bebop2", "Mambo", "Disco")):
@@ -55,6 +76,8 @@ class WifiConnection:
         self.udp_receive_port = 43210
         self.is_listening = True  # for the UDP listener
         self.ip_address = ip_address
+        self.source_address = source_address
+        self.bind_interface = bind_interface
 
         if (drone_type is "Bebop"):
             self.mdns_address = "_arsdk-0901._udp.local."
@@ -120,6 +143,38 @@ class WifiConnection:
 
         self.data_buffers = (self.buffer_ids['ACK_DRONE_DATA'], self.buffer_ids['NO_ACK_DRONE_DATA'])
 
+        # sequence numbers seen on each data buffer (for duplicates, losses and reordering)
+        self.receive_windows = dict((buffer_id, ReceiveWindow()) for buffer_id in self.data_buffers)
+
+        # the sensor frames are parsed (and the user callback called) on the dispatcher thread so the receive
+        # thread only drains the socket, acks and pongs.  Set frame_dispatcher.max_queue_size and
+        # overflow_policy before connecting to change how it handles a backlog (get_stats() shows the drops)
+        self.frame_dispatcher = FrameDispatcher(self._dispatch_frame)
+
+        # link quality from the drone's pings and our pongs (link_monitor.get_stats() for the percentiles,
+        # link_monitor.set_degraded_callback() to hear when the link gets bad and
+        # link_monitor.set_active_probing(True) to also measure the round trip time with our own pings)
+        self.link_monitor = LinkMonitor(self._send_ping)
+
+        # size of the kernel receive buffer of the UDP socket in bytes (None keeps the OS default)
+        self.receive_buffer_size = None
+
+        # where the drone was last found, saved under profile_name (set it to tell several drones apart).
+        # connect tries the saved address right away while mDNS runs, and reconnect reuses it.
+        self.profile_cache = ConnectionProfileCache()
+        self.profile_name = drone_type
+        self.cached_connect_timeout = 2.0
+        self.handshake_address = None
+
+        # commands are packed into preallocated frames (one per command and send buffer)
+        self.command_encoder = DroneCommandEncoder("<BBBI", has_frame_size=True)
+        self.command_encoder.add_channel('SEND_NO_ACK', (self.data_types_by_name['DATA_NO_ACK'],
+                                                         self.buffer_ids['SEND_NO_ACK']))
+        self.command_encoder.add_channel('SEND_WITH_ACK', (self.data_types_by_name['DATA_WITH_ACK'],
+                                                           self.buffer_ids['SEND_WITH_ACK']))
+        self.command_encoder.add_channel('SEND_HIGH_PRIORITY', (self.data_types_by_name['LOW_LATENCY_DATA'],
+                                                                self.buffer_ids['SEND_HIGH_PRIORITY']))
+
         # store whether a command was acked
         self.command_received = {
             'SEND_WITH_ACK': False,
@@ -127,52 +182,72 @@ class WifiConnection:
             'ACK_COMMAND': False
         }
 
-        # maximum number of times to try a packet before assuming it failed
-        self.max_packet_retries = 1
+        # maximum number of times to try a packet before assuming it failed (each resend waits for the
+        # backed off timeout, as on BLE)
+        self.max_packet_retries = 3
+
+        # number of times safe_send tries the socket (making a new socket after each error)
+        self.max_socket_retries = 1
+
+        # measures the ack round trip time to decide how long to wait before sending a packet again
+        # (rtt_estimator.get_stats() shows the current link estimates)
+        self.rtt_estimator = RTTEstimator(initial_rto=0.5)
+
+        # time each ack arrived (keyed like command_received) for the round trip measurements
+        self._ack_times = dict()
+
+        # maximum number of acked commands in flight at once for send_command_batch_ack
+        self.ack_window_size = 8
+
+        # the listener thread notifies this whenever an ack arrives
+        self._ack_condition = threading.Condition()
+
+        # argument types of PCMD (flag, roll, pitch, yaw, gaz, timestamp) for the preallocated PCMD frame
+        self._pcmd_arg_types = ('u8', 'i8', 'i8', 'i8', 'i8', 'u32')
 
         # threading lock for waiting
         self._lock = threading.Lock()
 
+        # every frame is sent (and gets its sequence number) on the sender thread, in priority order
+        # (send_queue.get_stats() shows the queue depths and latencies).  send_queue.set_batching() packs the frames
+        # queued within a few milliseconds into one datagram (send_queue.get_batching_stats() shows the savings)
+        self.send_queue = SendQueue(self.safe_send, self._next_sequence)
+
+        # high priority (emergency) frames have their own socket and sender thread so they never wait behind
+        # the other sends (get_low_latency_stats() shows the latency of this lane)
+        self.high_priority_queue = SendQueue(self._send_high_priority, self._next_sequence)
+        self.high_priority_sock = None
+
 
-    def connect(self, num_retries):
+    def connect(self, num_retries, start_listener=True):
         """
         Connects to the drone
 
         :param num_retries: maximum number of retries
+        :param start_listener: start a thread that listens to the UDP socket.  Set to False if something else
+                               reads udp_receive_sock and calls handle_data (e.g. a Fleet)
 
         :return: True if the connection succeeded and False otherwise
         """
 
         if (self.ip_address is None) and ("Mambo" not in self.drone_type):
-            print("Setting up mDNS listener since this is not a Mambo")
-            #parrot's latest mambo firmware (3.0.26 broke all of the mDNS services so this is (temporarily) commented
-            #out but it is backwards compatible and will work with the hard-coded addresses for now.
-            zeroconf = Zeroconf()
-            listener = mDNSListener(self)
-
-            print("Making a browser for %s" % self.mdns_address)
-
-            browser = ServiceBrowser(zeroconf, self.mdns_address , listener)
-
-            # basically have to sleep until the info comes through on the listener
-            num_tries = 0
-            while (num_tries < num_retries and not self.is_connected):
-                time.sleep(1)
-                num_tries += 1
-
-            # if we didn't hear the listener, return False
-            if (not self.is_connected):
-                color_print("connection failed: did you remember to connect your machine to the Drone's wifi network?", "ERROR")
-                return False
-            else:
-                browser.cancel()
+            handshake = self._discover_and_handshake(num_retries)
+        else:
+            # perform the handshake and get the UDP info
+            handshake = self._handshake(num_retries)
 
-        # perform the handshake and get the UDP info
-        handshake = self._handshake(num_retries)
         if (handshake):
+            self._save_profile()
+            self.is_listening = True
             self._create_udp_connection()
-            self.listener_thread = threading.Thread(target=self._listen_socket)
-            self.listener_thread.start()
+            self.send_queue.start()
+            self.high_priority_queue.start()
+            self.frame_dispatcher.start()
+            self.link_monitor.reset()
+            self.link_monitor.start()
+            if (start_listener):
+                self.listener_thread = threading.Thread(target=self._listen_socket)
+                self.listener_thread.start()
 
             color_print("Success in setting up the wifi network to the drone!", "SUCCESS")
             return True
@@ -180,6 +255,93 @@ class WifiConnection:
             color_print("Error: TCP handshake failed.", "ERROR")
             return False
 
+    def _discover_and_handshake(self, num_retries):
+        """
+        Handshake with the address saved in the connection profile while mDNS looks for the drone in the
+        background.  If the saved address doesn't answer, wait for mDNS and handshake with what it finds.
+
+        :param num_retries: maximum number of retries
+        :return: True if the handshake worked and False otherwise
+        """
+        profile = self.profile_cache.get(self.profile_name)
+        if (profile is None):
+            if (not self._discover_with_mdns(num_retries)):
+                return False
+            return self._handshake(num_retries)
+
+        browser = self._start_mdns_browser()
+        color_print("trying the saved address %s for %s" % (profile["address"], self.profile_name), "INFO")
+        if (self._try_handshake((profile["address"], profile["port"]), num_retries)):
+            browser.cancel()
+            return True
+
+        color_print("the saved address did not answer, waiting for mDNS", "WARN")
+        if (not self._discover_with_mdns(num_retries, browser)):
+            return False
+        return self._handshake(num_retries)
+
+    def _try_handshake(self, address, num_retries):
+        """
+        Handshake with a known address, giving up after cached_connect_timeout seconds
+
+        :param address: (ip address, port) of the drone
+        :return: True if the handshake worked and False otherwise
+        """
+        try:
+            return self._handshake(num_retries, address=address, timeout=self.cached_connect_timeout)
+        except (OSError, ValueError) as e:
+            color_print("handshake with %s:%d failed: %s" % (address[0], address[1], e), "WARN")
+            return False
+
+    def _save_profile(self):
+        """
+        Save where the drone was reached so the next connect can skip mDNS
+        """
+        if (self.handshake_address is not None):
+            (address, port) = self.handshake_address
+            self.profile_cache.save(self.profile_name, address, port, self.udp_send_port)
+
+    def _start_mdns_browser(self):
+        """
+        Start looking for the drone with mDNS (connection_info is set when the drone answers)
+
+        :return: the ServiceBrowser
+        """
+        print("Setting up mDNS listener since this is not a Mambo")
+        #parrot's latest mambo firmware (3.0.26 broke all of the mDNS services so this is (temporarily) commented
+        #out but it is backwards compatible and will work with the hard-coded addresses for now.
+        zeroconf = Zeroconf()
+        listener = mDNSListener(self)
+
+        print("Making a browser for %s" % self.mdns_address)
+
+        return ServiceBrowser(zeroconf, self.mdns_address , listener)
+
+    def _discover_with_mdns(self, num_retries, browser=None):
+        """
+        Find the drone with mDNS (sets connection_info when the drone answers)
+
+        :param num_retries: maximum number of seconds to wait for the drone
+        :param browser: ServiceBrowser that is already running (one is started if None)
+        :return: True if the drone was found and False otherwise
+        """
+        if (browser is None):
+            browser = self._start_mdns_browser()
+
+        # basically have to sleep until the info comes through on the listener
+        num_tries = 0
+        while (num_tries < num_retries and not self.is_connected):
+            time.sleep(1)
+            num_tries += 1
+
+        # if we didn't hear the listener, return False
+        if (not self.is_connected):
+            color_print("connection failed: did you remember to connect your machine to the Drone's wifi network?", "ERROR")
+            return False
+        else:
+            browser.cancel()
+            return True
+
     def _listen_socket(self):
         """
         Listens to the socket and sleeps in between receives.
@@ -187,40 +349,53 @@ class WifiConnection:
         """
 
         print("starting listening at ")
-        data = None
+
+        # one receive buffer for the whole connection: the frames are handed on as memoryviews into it
+        receive_buffer = bytearray(_max_datagram_size)
+        receive_view = memoryview(receive_buffer)
 
         while (self.is_listening):
             try:
-                (data, address) = self.udp_receive_sock.recvfrom(66000)
+                num_bytes = self.udp_receive_sock.recv_into(receive_buffer)
 
             except socket.timeout:
                 print("timeout - trying again")
+                continue
 
             except:
-                pass
+                continue
 
-            self.handle_data(data)
+            self.handle_data(receive_view[:num_bytes])
 
         color_print("disconnecting", "INFO")
         self.disconnect()
 
     def handle_data(self, data):
         """
-        Handles the data as it comes in
+        Handles the data as it comes in.  A datagram can hold several frames: each frame is handed to
+        handle_frame as a memoryview into the datagram (no copies), so it is only valid during that call.
 
-        :param data: raw data packet
+        :param data: raw data packet (bytes, bytearray or memoryview)
         :return:
         """
         # got the idea to of how to handle this data nicely (handling the perhaps extra data in the packets)
         # and unpacking the critical info first (id, size etc) from
         # https://github.com/N-Bz/bybop/blob/8d4c569c8e66bd1f0fdd768851409ca4b86c4ecd/src/Bybop_NetworkAL.py
 
-        my_data = data
+        my_data = memoryview(data)
+        data_size = len(my_data)
+        offset = 0
 
-        while (my_data):
+        while (offset + _frame_header_struct.size <= data_size):
             #print("inside loop to handle data ")
-            (data_type, buffer_id, packet_seq_id, packet_size) = struct.unpack('<BBBI', my_data[0:7])
-            recv_data = my_data[7:packet_size]
+            (data_type, buffer_id, packet_seq_id, packet_size) = _frame_header_struct.unpack_from(my_data, offset)
+
+            # a frame can never be smaller than its header (guards against looping forever on garbage)
+            if (packet_size < _frame_header_struct.size):
+                color_print("Error: bad frame size %d in datagram" % packet_size, "ERROR")
+                break
+
+            recv_data = my_data[offset + _frame_header_struct.size:offset + packet_size]
 
             #print("\tgot a data type of of %d " % data_type)
             #print("\tgot a buffer id of of %d " % buffer_id)
@@ -229,14 +404,17 @@ class WifiConnection:
             self.handle_frame(data_type, buffer_id, packet_seq_id, recv_data)
 
             # loop in case there is more data
-            my_data = my_data[packet_size:]
-            #print("assigned more data")
+            offset += packet_size
         #print("ended loop handling data")
 
     def handle_frame(self, packet_type, buffer_id, packet_seq_id, recv_data):
         if (buffer_id == self.buffer_ids['PING']):
             #color_print("this is a ping!  need to pong", "INFO")
             self._send_pong(recv_data)
+            self.link_monitor.on_ping(recv_data)
+        elif (buffer_id == self.buffer_ids['PONG']):
+            # the drone's answer to one of our pings
+            self.link_monitor.on_pong(recv_data)
 
         if (self.data_types_by_number[packet_type] == 'ACK'):
             #print("setting command received to true")
@@ -246,17 +424,54 @@ class WifiConnection:
         elif (self.data_types_by_number[packet_type] == 'DATA_NO_ACK'):
             #print("DATA NO ACK")
             if (buffer_id in self.data_buffers):
-                self.drone.update_sensors(packet_type, buffer_id, packet_seq_id, recv_data, ack=False)
+                # a late frame holds older values than the ones already applied so drop it
+                if (self.receive_windows[buffer_id].receive(packet_seq_id) == FRAME_NEW):
+                    self.frame_dispatcher.put(packet_type, buffer_id, packet_seq_id, recv_data, acked=False)
         elif (self.data_types_by_number[packet_type] == 'LOW_LATENCY_DATA'):
-            print("Need to handle Low latency data")
+            # never acked: drop the late frames and dispatch the others ahead of the rest
+            if (buffer_id != self.buffer_ids['VIDEO_DATA']):
+                window = self.receive_windows.setdefault(buffer_id, ReceiveWindow())
+                if (window.receive(packet_seq_id) == FRAME_NEW):
+                    self.frame_dispatcher.put(packet_type, buffer_id, packet_seq_id, recv_data, acked=False,
+                                              low_latency=True)
         elif (self.data_types_by_number[packet_type] == 'DATA_WITH_ACK'):
             #print("DATA WITH ACK")
             if (buffer_id in self.data_buffers):
-                self.drone.update_sensors(packet_type, buffer_id, packet_seq_id, recv_data, ack=True)
+                # ack right away (before parsing) so the drone doesn't resend it
+                self.ack_packet(buffer_id, packet_seq_id)
+
+                # the drone resent it if our ack was late: don't apply it twice
+                if (self.receive_windows[buffer_id].receive(packet_seq_id) != FRAME_DUPLICATE):
+                    self.frame_dispatcher.put(packet_type, buffer_id, packet_seq_id, recv_data, acked=True)
         else:
             color_print("HELP ME", "ERROR")
             print("got a different type of data - help")
 
+    def _dispatch_frame(self, packet_type, buffer_id, packet_seq_id, recv_data):
+        """
+        Parse a sensor frame and update the sensors (called by the frame dispatcher).  The frame was already
+        acked by the receive thread.
+        """
+        self.drone.update_sensors(packet_type, buffer_id, packet_seq_id, recv_data, ack=False)
+
+    def _send_ping(self, data):
+        """
+        Send a PING to the drone (it answers with a PONG holding the same data)
+
+        :param data: payload of the ping (our timestamp)
+        :return: nothing
+        """
+        size = len(data)
+        self._queue(LANE_ACK, 'PING',
+                    lambda seq: struct.pack("<BBBI", self.data_types_by_name['DATA_NO_ACK'], self.buffer_ids['PING'],
+                                            seq, size + 7) + data)
+
+    def get_receive_stats(self):
+        """
+        :return: dictionary of data buffer id -> frames received, duplicated, lost and reordered on that buffer
+        """
+        return dict((buffer_id, window.get_stats()) for (buffer_id, window) in list(self.receive_windows.items()))
+
     def _send_pong(self, data):
         """
         Send a PONG back to a PING
@@ -265,14 +480,18 @@ class WifiConnection:
         :return: nothing
         """
 
+        # copy the data since the receive buffer is reused before the pong goes out
+        data = bytes(data)
         size = len(data)
+        ping_time = time.monotonic()
 
-        self.sequence_counter['PONG'] = (self.sequence_counter['PONG'] + 1) % 256
+        def build(seq):
+            # the sender thread builds the pong right before sending it
+            self.link_monitor.on_pong_sent(time.monotonic() - ping_time)
+            return struct.pack("<BBBI", self.data_types_by_name['DATA_NO_ACK'], self.buffer_ids['PONG'],
+                               seq, size + 7) + data
 
-        packet = struct.pack("<BBBI", self.data_types_by_name['DATA_NO_ACK'], self.buffer_ids['PONG'],
-                             self.sequence_counter['PONG'], size + 7)
-        packet += data
-        self.safe_send(packet)
+        self._queue(LANE_ACK, 'PONG', build)
 
 
 
@@ -284,7 +503,11 @@ class WifiConnection:
         :param val: True or False
         :return:
         """
-        self.command_received[(channel, seq_id)] = val
+        with self._ack_condition:
+            self.command_received[(channel, seq_id)] = val
+            if (val):
+                self._ack_times[(channel, seq_id)] = time.monotonic()
+                self._ack_condition.notify_all()
 
     def _is_command_received(self, channel, seq_id):
         """
@@ -294,49 +517,52 @@ class WifiConnection:
         :param seq_id: sequence id of the command
         :return:
         """
-        return self.command_received[(channel, seq_id)]
+        return self.command_received.get((channel, seq_id), False)
 
-    def _handshake(self, num_retries):
+    def _wait_for_command_received(self, channel, seq_id, timeout):
+        """
+        Block until the command is acked (signalled by the listener thread) or the timeout expires
+
+        :param channel: channel it was sent on
+        :param seq_id: sequence id of the command
+        :param timeout: maximum number of seconds to wait
+        :return: True if the command was acked and False otherwise
+        """
+        with self._ack_condition:
+            return self._ack_condition.wait_for(lambda: self._is_command_received(channel, seq_id), timeout)
+
+    def _handshake(self, num_retries, address=None, timeout=None):
         """
         Performs the handshake over TCP to get all the connection info
 
+        :param num_retries: number of empty reads to allow before giving up
+        :param address: (ip address, port) to use (found from the drone type, ip_address or mDNS if None)
+        :param timeout: seconds to wait for the connection and each read (None waits forever)
         :return: True if it worked and False otherwise
         """
 
         # create the TCP socket for the handshake
         tcp_sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+        tcp_sock.settimeout(timeout)
+        if (self.source_address is not None or self.bind_interface is not None):
+            self._bind_socket(tcp_sock, 0)
         #print (self.connection_info.address, self.connection_info.port)
         #print(ipaddress.IPv4Address(self.connection_info.address))
 
-        # connect
-        # handle the broken mambo firmware by hard-coding the port and IP address
-        if ("Mambo" in self.drone_type):
-            self.drone_ip = "192.168.99.3"
-            tcp_sock.connect(("192.168.99.3", 44444))
+        if (address is None):
+            address = self._get_handshake_address()
         else:
-            if (self.ip_address is None):
-                self.drone_ip = ipaddress.IPv4Address(self.connection_info.address).exploded
-                tcp_sock.connect((self.drone_ip, self.connection_info.port))
-            else:
-                self.drone_ip = ipaddress.IPv4Address(self.ip_address).exploded
-                tcp_sock.connect((self.drone_ip, 44444))
+            self.drone_ip = ipaddress.IPv4Address(address[0]).exploded
 
+        # connect
+        try:
+            tcp_sock.connect(address)
+        except OSError:
+            tcp_sock.close()
+            raise
 
         # send the handshake information
-        if(self.drone_type in ("Anafi", "Bebop", "Bebop2", "Disco")):
-            # For Bebop add video stream ports to the json request
-            json_string = json.dumps({"d2c_port":self.udp_receive_port,
-                                      "controller_type":"computer",
-                                      "controller_name":"pyparrot",
-                                      "arstream2_client_stream_port":self.stream_port,
-                                      "arstream2_client_control_port":self.stream_control_port})
-        else:
-            json_string = json.dumps({"d2c_port":self.udp_receive_port,
-                                      "controller_type":"computer",
-                                      "controller_name":"pyparrot"})
-            
-        json_obj = json.loads(json_string)
-        print(json_string)
+        json_string = self._get_handshake_json()
         try:
             # python 3
             tcp_sock.send(bytes(json_string, 'utf-8'))
@@ -349,22 +575,16 @@ class WifiConnection:
         finished = False
         num_try = 0
         while (not finished and num_try < num_retries):
-            data = tcp_sock.recv(4096).decode('utf-8')
+            try:
+                data = tcp_sock.recv(4096).decode('utf-8')
+            except socket.timeout:
+                break
             if (len(data) > 0):
-                if (self.drone_type == "Anafi"):
-                  my_data = data #data[0:-1]
-                else:
-                  my_data = data[0:-1]
-                print("mydata", my_data)
-                self.udp_data = json.loads(str(my_data))
-
                 # if the drone refuses the connection, return false
-                if (self.udp_data['status'] != 0):
+                if (not self._handle_handshake_response(data)):
+                    tcp_sock.close()
                     return False
 
-                print(self.udp_data)
-                self.udp_send_port = self.udp_data['c2d_port']
-                print("c2d_port is %d" % self.udp_send_port)
                 finished = True
             else:
                 num_try += 1
@@ -372,8 +592,74 @@ class WifiConnection:
         # cleanup
         tcp_sock.close()
 
+        if (finished):
+            self.handshake_address = (self.drone_ip, address[1])
         return finished
 
+    def _get_handshake_address(self):
+        """
+        Figure out the drone's IP address (saved in drone_ip) and the TCP port for the handshake
+
+        :return: (ip address, port)
+        """
+        # handle the broken mambo firmware by hard-coding the port and IP address
+        if ("Mambo" in self.drone_type):
+            self.drone_ip = "192.168.99.3"
+            return ("192.168.99.3", 44444)
+        else:
+            if (self.ip_address is None):
+                self.drone_ip = ipaddress.IPv4Address(self.connection_info.address).exploded
+                return (self.drone_ip, self.connection_info.port)
+            else:
+                self.drone_ip = ipaddress.IPv4Address(self.ip_address).exploded
+                return (self.drone_ip, 44444)
+
+    def _get_handshake_json(self):
+        """
+        :return: the JSON string sent to the drone in the handshake
+        """
+        if(self.drone_type in ("Anafi", "Bebop", "Bebop2", "Disco")):
+            # For Bebop add video stream ports to the json request
+            json_string = json.dumps({"d2c_port":self.udp_receive_port,
+                                      "controller_type":"computer",
+                                      "controller_name":"pyparrot",
+                                      "arstream2_client_stream_port":self.stream_port,
+                                      "arstream2_client_control_port":self.stream_control_port})
+        else:
+            json_string = json.dumps({"d2c_port":self.udp_receive_port,
+                                      "controller_type":"computer",
+                                      "controller_name":"pyparrot"})
+
+        print(json_string)
+        return json_string
+
+    def _handle_handshake_response(self, data):
+        """
+        Parse the drone's answer to the handshake and save the c2d port
+
+        :param data: the (decoded) response from the drone
+        :return: True if the drone accepted the connection and False otherwise
+        """
+        if (self.drone_type == "Anafi"):
+          my_data = data #data[0:-1]
+        else:
+          my_data = data[0:-1]
+        print("mydata", my_data)
+        self.udp_data = json.loads(str(my_data))
+
+        # if the drone refuses the connection, return false
+        if (self.udp_data['status'] != 0):
+            return False
+
+        print(self.udp_data)
+        self.udp_send_port = self.udp_data['c2d_port']
+        print("c2d_port is %d" % self.udp_send_port)
+
+        # the drone starts its sequence numbers over on a new connection
+        for window in self.receive_windows.values():
+            window.reset()
+        return True
+
 
     def _create_udp_connection(self):
         """
@@ -393,8 +679,52 @@ class WifiConnection:
         #These new setsockopt lines solving it (at least at my device)
         self.udp_receive_sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
         self.udp_send_sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
-        
-        self.udp_receive_sock.bind(('0.0.0.0', int(self.udp_receive_port)))
+
+        self._set_receive_buffer_size(self.udp_receive_sock)
+        self._bind_socket(self.udp_receive_sock, int(self.udp_receive_port))
+        if (self.source_address is not None or self.bind_interface is not None):
+            self._bind_socket(self.udp_send_sock, 0)
+
+        self.high_priority_sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        if (self.source_address is not None or self.bind_interface is not None):
+            self._bind_socket(self.high_priority_sock, 0)
+
+    def _set_receive_buffer_size(self, sock):
+        """
+        Set the kernel receive buffer size of a socket to receive_buffer_size (if it is set).  A bigger buffer
+        rides out bursts of frames from the drone without the kernel dropping them.
+
+        :param sock: the socket
+        """
+        if (self.receive_buffer_size is not None):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(self.receive_buffer_size))
+
+    def _bind_socket(self, sock, port):
+        """
+        Bind a socket to the adapter for this drone (see source_address and bind_interface)
+
+        :param sock: the socket
+        :param port: local port (0 for any)
+        """
+        if (self.bind_interface is not None):
+            # SO_BINDTODEVICE is 25 on linux (older pythons do not define the constant)
+            sock.setsockopt(socket.SOL_SOCKET, getattr(socket, "SO_BINDTODEVICE", 25),
+                            self.bind_interface.encode('utf-8') + b'\0')
+
+        if (self.source_address is not None):
+            sock.bind((self.source_address, port))
+        else:
+            sock.bind(('0.0.0.0', port))
+
+    def get_video_sdp(self):
+        """
+        SDP description of this drone's RTP video stream (Bebop and Disco), for ffmpeg, VLC or OpenCV.
+        Use it instead of utils/bebop.sdp when the drone is not at 192.168.42.1 or when the stream ports
+        were changed (e.g. several drones at once).
+
+        :return: the SDP as a string
+        """
+        return "c=IN IP4 %s\nm=video %d RTP/AVP 96\na=rtpmap:96 H264/90000\n" % (self.drone_ip, self.stream_port)
 
 
     def _connect_listener_called(self, connection_info):
@@ -413,6 +743,10 @@ class WifiConnection:
         Disconnect cleanly from the sockets
         """
         self.is_listening = False
+        self.link_monitor.stop()
+        self.high_priority_queue.stop()
+        self.send_queue.stop()
+        self.frame_dispatcher.stop()
 
         # Sleep for a moment to allow all socket activity to cease before closing
         # This helps to avoids a Winsock error regarding a operations on a closed socket
@@ -423,9 +757,56 @@ class WifiConnection:
         try:
             self.udp_receive_sock.close()
             self.udp_send_sock.close()
+            if (self.high_priority_sock is not None):
+                self.high_priority_sock.close()
+                self.high_priority_sock = None
         except:
             pass
 
+    def reconnect(self, num_retries=3):
+        """
+        Reconnect quickly after a short wifi drop: redo the handshake with the address the drone was last
+        reached at and make new send sockets.  The d2c socket, the threads, the parsers and the sensors are
+        kept as they are.  Falls back to a full discovery if the drone moved.
+
+        :param num_retries: maximum number of retries
+        :return: True if the connection is back and False otherwise
+        """
+        # after a disconnect (or if we never connected) everything has to be set up again
+        if (self.handshake_address is None or not self.is_listening):
+            return self.connect(num_retries)
+
+        handshake = self._try_handshake(self.handshake_address, num_retries)
+        if (not handshake and self.ip_address is None and "Mambo" not in self.drone_type):
+            self.is_connected = False
+            handshake = self._discover_with_mdns(num_retries) and self._try_handshake(
+                self._get_handshake_address(), num_retries)
+
+        if (not handshake):
+            color_print("Error: could not reconnect to the drone", "ERROR")
+            return False
+
+        self._save_profile()
+
+        # the old send sockets may be bound to an address that went away with the wifi
+        for sock in (self.udp_send_sock, self.high_priority_sock):
+            try:
+                sock.close()
+            except Exception:
+                pass
+        self.udp_send_sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self.high_priority_sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        if (self.source_address is not None or self.bind_interface is not None):
+            self._bind_socket(self.udp_send_sock, 0)
+            self._bind_socket(self.high_priority_sock, 0)
+
+        # the old round trip times say nothing about the new link
+        self.rtt_estimator.reset()
+        self.link_monitor.reset()
+
+        color_print("Reconnected to the drone", "SUCCESS")
+        return True
+
     def safe_send(self, packet):
 
         packet_sent = False
@@ -433,33 +814,248 @@ class WifiConnection:
 
         try_num = 0
 
-        while (not packet_sent and try_num < self.max_packet_retries):
+        while (not packet_sent and try_num < self.max_socket_retries):
             try:
                 self.udp_send_sock.sendto(packet, (self.drone_ip, self.udp_send_port))
                 packet_sent = True
             except:
                 #print "resetting connection"
                 self.udp_send_sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+                if (self.source_address is not None or self.bind_interface is not None):
+                    self._bind_socket(self.udp_send_sock, 0)
                 #self.udp_send_sock.connect((self.drone_ip, self.udp_send_port))
                 try_num += 1
 
+    def _send_high_priority(self, packet):
+        """
+        Send a high priority packet on its own socket (falls back to the normal socket if there is none
+        or it fails)
+
+        :param packet: the packet
+        """
+        if (self.high_priority_sock is not None):
+            try:
+                self.high_priority_sock.sendto(packet, (self.drone_ip, self.udp_send_port))
+                return
+            except OSError as e:
+                color_print("Error sending on the high priority socket: %s" % e, "ERROR")
+
+        self.safe_send(packet)
+
+    def get_low_latency_stats(self):
+        """
+        :return: dictionary with the stats of the high priority frames sent (number sent and the mean and
+                 maximum seconds from the call to the end of the sendto) and of the LOW_LATENCY_DATA frames
+                 received (number and the mean and maximum seconds before they were dispatched)
+        """
+        send_stats = self.high_priority_queue.get_stats()['high_priority']
+        receive_stats = self.frame_dispatcher.get_stats()
+        return {
+            'num_sent': send_stats['num_sent'],
+            'send_mean_latency': send_stats['mean_latency'],
+            'send_max_latency': send_stats['max_latency'],
+            'num_received': receive_stats['num_low_latency'],
+            'receive_mean_delay': receive_stats['low_latency_mean_delay'],
+            'receive_max_delay': receive_stats['low_latency_max_delay'],
+        }
+
+    def _next_sequence(self, key):
+        """
+        Next sequence number for a buffer (only called from the sender thread)
+
+        :param key: name of the buffer in sequence_counter (or the buffer id for acks)
+        :return: the sequence number
+        """
+        if (key not in self.sequence_counter):
+            self.sequence_counter[key] = 0
+        else:
+            self.sequence_counter[key] = (self.sequence_counter[key] + 1) % 256
+        return self.sequence_counter[key]
+
+    def _queue(self, lane, sequence_key, build):
+        """
+        Queue a frame for the sender thread (returns right away)
+
+        :param lane: one of the sendQueue LANE_ constants
+        :param sequence_key: sequence counter to use (None if the packet already has its sequence number)
+        :param build: function that takes the sequence number and returns the packet
+        :return: the SendRequest
+        """
+        if (lane == LANE_HIGH_PRIORITY):
+            return self.high_priority_queue.put(lane, sequence_key, build)
+        return self.send_queue.put(lane, sequence_key, build)
+
+    def _queue_packet(self, lane, packet):
+        """
+        Queue a packet that is already complete (e.g. a resend)
+
+        :return: the SendRequest
+        """
+        return self._queue(lane, None, lambda seq: packet)
+
+    def _queue_command(self, lane, channel, command_tuple, param_tuple=(), param_type_tuple=None):
+        """
+        Queue a command that is not acked (the sender thread encodes it with the next sequence number)
+
+        :param lane: LANE_PCMD or LANE_HIGH_PRIORITY
+        :param channel: 'SEND_NO_ACK' or 'SEND_HIGH_PRIORITY'
+        :return: the SendRequest
+        """
+        return self._queue(lane, channel,
+                           lambda seq: self.command_encoder.encode(channel, seq, command_tuple, param_tuple,
+                                                                   param_type_tuple))
+
+    def _queue_ack_command(self, command_tuple, param_tuple=(), param_type_tuple=None):
+        """
+        Queue a command on the ack channel without waiting for the ack
+
+        :return: the SendRequest (its seq_id and packet are set once it is sent)
+        """
+        def build(seq):
+            # forget any old ack for this sequence number before the packet goes out
+            self._set_command_received('SEND_WITH_ACK', False, seq)
+            return bytes(self.command_encoder.encode('SEND_WITH_ACK', seq, command_tuple, param_tuple,
+                                                     param_type_tuple))
+
+        return self._queue(LANE_COMMAND, 'SEND_WITH_ACK', build)
+
+    def _send_ack_command(self, command_tuple, param_tuple=(), param_type_tuple=None):
+        """
+        Send a command on the ack channel and wait for the ack (resending it if needed)
+
+        :return: True if the command was acked and False otherwise
+        """
+        request = self._queue_ack_command(command_tuple, param_tuple, param_type_tuple)
+        request.wait_sent()
+        return self._wait_for_ack_or_resend(request, request.seq_id, request.packet)
+
+    def _wait_for_ack_or_resend(self, request, seq_id, packet):
+        """
+        Wait for the ack of a packet on the ack channel, resending it after the adaptive timeout
+        (up to max_packet_retries sends in total)
+
+        :param request: SendRequest of the first send
+        :param seq_id: sequence id of the packet
+        :param packet: the packet (to resend)
+        :return: True if the packet was acked and False otherwise
+        """
+        num_sends = 1
+        while (True):
+            request.wait_sent()
+
+            # returns as soon as the ack arrives (or resends after the adaptive timeout)
+            timeout = max(0, request.send_time + self.rtt_estimator.get_rto() - time.monotonic())
+            if (self._wait_for_command_received('SEND_WITH_ACK', seq_id, timeout)):
+                self._add_rtt_sample('SEND_WITH_ACK', seq_id, request.send_time, num_sends)
+                return True
+
+            self.rtt_estimator.backoff()
+            if (num_sends >= self.max_packet_retries):
+                return False
+
+            color_print("sending packet on try %d" % num_sends)
+            request = self._queue_packet(LANE_COMMAND, packet)
+            num_sends += 1
 
     def send_command_packet_ack(self, packet, seq_id):
         """
         Sends the actual packet on the ack channel.  Internal function only.
 
         :param packet: packet constructed according to the command rules (variable size, constructed elsewhere)
+        :param seq_id: sequence id already in the packet
         :return: True if the command was sent and False otherwise
         """
-        try_num = 0
         self._set_command_received('SEND_WITH_ACK', False, seq_id)
-        while (try_num < self.max_packet_retries and not self._is_command_received('SEND_WITH_ACK', seq_id)):
-            color_print("sending packet on try %d", try_num)
-            self.safe_send(packet)
-            try_num += 1
-            self.smart_sleep(0.5)
+        request = self._queue_packet(LANE_COMMAND, packet)
+        return self._wait_for_ack_or_resend(request, seq_id, packet)
 
-        return self._is_command_received('SEND_WITH_ACK', seq_id)
+    def _add_rtt_sample(self, channel, seq_id, send_time, num_sends):
+        """
+        Add the round trip time of an acked packet to the estimator.  Packets that were sent more than once
+        are skipped since the ack could belong to any of the sends (Karn's algorithm).
+
+        :param channel: channel the packet was sent on
+        :param seq_id: sequence id of the packet
+        :param send_time: time.monotonic() when the packet was (last) sent
+        :param num_sends: number of times the packet was sent
+        """
+        ack_time = self._ack_times.pop((channel, seq_id), None)
+        if (num_sends == 1 and ack_time is not None):
+            self.rtt_estimator.add_sample(max(0.0, ack_time - send_time))
+
+    def send_command_batch_ack(self, commands, window_size=None, ordered=False):
+        """
+        Send several commands on the ack channel without waiting for each ack before sending the next one.
+        Up to window_size commands are in flight at once; each one is tracked by its sequence id and only
+        the unacked ones are resent (after the adaptive timeout, up to max_packet_retries sends in total).
+
+        Example (preflight settings on a Bebop):
+
+            parser = bebop.command_parser
+            bebop.drone_connection.send_command_batch_ack([
+                (parser.get_command_tuple("ardrone3", "PilotingSettings", "MaxAltitude"), [10.0]),
+                (parser.get_command_tuple("ardrone3", "PilotingSettings", "MaxTilt"), [10.0]),
+                (parser.get_command_tuple("ardrone3", "SpeedSettings", "MaxVerticalSpeed"), [1.0])])
+
+        :param commands: list of (command_tuple,), (command_tuple, param_tuple) or
+                         (command_tuple, param_tuple, param_type_tuple) (types are looked up in the XML if missing)
+        :param window_size: maximum number of unacked commands in flight (defaults to ack_window_size)
+        :param ordered: set to True if the drone must receive the commands in order.  Each command is then
+                        acked before the next one is sent (a resent command could otherwise arrive after a
+                        later one)
+        :return: True if every command was acked and False otherwise
+        """
+        if (ordered):
+            window_size = 1
+        elif (window_size is None):
+            window_size = self.ack_window_size
+
+        to_send = deque(commands)
+        num_acked = 0
+
+        # sequence id -> [request of the last send, number of sends]
+        in_flight = dict()
+
+        while (to_send or in_flight):
+            # fill the window
+            while (to_send and len(in_flight) < window_size):
+                request = self._queue_ack_command(*to_send.popleft())
+                request.wait_sent()
+                in_flight[request.seq_id] = [request, 1]
+
+            # sleep until an ack arrives or the oldest packet needs to be resent
+            rto = self.rtt_estimator.get_rto()
+            oldest_send = min(sent[0].send_time for sent in in_flight.values())
+            timeout = max(0, oldest_send + rto - time.monotonic())
+            with self._ack_condition:
+                self._ack_condition.wait_for(
+                    lambda: any(self._is_command_received('SEND_WITH_ACK', seq_id) for seq_id in in_flight), timeout)
+
+            # retire the acked packets and resend the ones that timed out
+            now = time.monotonic()
+            timed_out = False
+            for seq_id in list(in_flight.keys()):
+                (request, num_sends) = in_flight[seq_id]
+                if (self._is_command_received('SEND_WITH_ACK', seq_id)):
+                    self._add_rtt_sample('SEND_WITH_ACK', seq_id, request.send_time, num_sends)
+                    num_acked += 1
+                    del in_flight[seq_id]
+                elif (now - request.send_time >= rto):
+                    timed_out = True
+                    if (num_sends < self.max_packet_retries):
+                        color_print("resending packet %d on try %d" % (seq_id, num_sends))
+                        resend = self._queue_packet(LANE_COMMAND, request.packet)
+                        resend.wait_sent()
+                        in_flight[seq_id] = [resend, num_sends + 1]
+                    else:
+                        color_print("packet %d was never acked" % seq_id, "WARN")
+                        del in_flight[seq_id]
+
+            # back off once per timeout (like a single TCP retransmission timer), not once per packet
+            if (timed_out):
+                self.rtt_estimator.backoff()
+
+        return (num_acked == len(commands))
 
     def send_command_packet_noack(self, packet):
         """
@@ -468,9 +1064,7 @@ class WifiConnection:
         :param packet: packet constructed according to the command rules (variable size, constructed elsewhere)
         :return: True if the command was sent and False otherwise
         """
-        try_num = 0
-        color_print("sending packet on try %d", try_num)
-        self.safe_send(packet)
+        self._queue_packet(LANE_PCMD, packet)
 
     def send_noparam_high_priority_command_packet(self, command_tuple):
         """
@@ -478,14 +1072,7 @@ class WifiConnection:
         :param command_tuple:
         :return:
         """
-        self.sequence_counter['SEND_HIGH_PRIORITY'] = (self.sequence_counter['SEND_HIGH_PRIORITY'] + 1) % 256
-
-        packet = struct.pack("<BBBIBBH", self.data_types_by_name['LOW_LATENCY_DATA'],
-                             self.buffer_ids['SEND_HIGH_PRIORITY'],
-                             self.sequence_counter['SEND_HIGH_PRIORITY'], 11,
-                             command_tuple[0], command_tuple[1], command_tuple[2])
-
-        self.safe_send(packet)
+        self._queue_command(LANE_HIGH_PRIORITY, 'SEND_HIGH_PRIORITY', command_tuple, param_type_tuple=())
 
 
     def send_noparam_command_packet_ack(self, command_tuple):
@@ -494,16 +1081,9 @@ class WifiConnection:
         :param command_tuple:
         :return:
         """
-        self.sequence_counter['SEND_WITH_ACK'] = (self.sequence_counter['SEND_WITH_ACK'] + 1) % 256
-
-        packet = struct.pack("<BBBIBBH", self.data_types_by_name['DATA_WITH_ACK'],
-                             self.buffer_ids['SEND_WITH_ACK'],
-                             self.sequence_counter['SEND_WITH_ACK'], 11,
-                             command_tuple[0], command_tuple[1], command_tuple[2])
+        return self._send_ack_command(command_tuple, param_type_tuple=())
 
-        return self.send_command_packet_ack(packet, self.sequence_counter['SEND_WITH_ACK'])
-
-    def send_param_command_packet(self, command_tuple, param_tuple=None, param_type_tuple=0,ack=True):
+    def send_param_command_packet(self, command_tuple, param_tuple=None, param_type_tuple=None, ack=True):
         """
         Send a command packet with parameters. Ack channel is optional for future flexibility,
         but currently commands are always send over the Ack channel so it defaults to True.
@@ -512,55 +1092,18 @@ class WifiConnection:
 
         :param: command_tuple: the command tuple derived from command_parser.get_command_tuple()
         :param: param_tuple (optional): the parameter values to be sent (can be found in the XML files)
-        :param: param_size_tuple (optional): a tuple of strings representing the data type of the parameters
-        e.g. u8, float etc. (can be found in the XML files)
+        :param: param_type_tuple (optional): a tuple of strings representing the data type of the parameters
+        e.g. u8, float etc.  If it is not given, the types are looked up in the XML files.
         :param: ack (optional): allows ack to be turned off if required
         :return:
         """
-# TODO: This function could potentially be extended to encompass send_noparam_command_packet_ack
-# and send_enum_command_packet_ack if desired for more modular code.
-# TODO: The function could be improved by looking up the parameter data types in the xml files
-# in the same way the send_enum_command_packet_ack does. 
-
-        # Create lists to store the number of bytes and pack chars needed for parameters
-        # Default them to zero so that if no params are provided the packet size is correct 
-        param_size_list = [0] * len(param_tuple)
-        pack_char_list = [0] * len(param_tuple)
-        
-        if param_tuple is not None:
-            # Fetch the parameter sizes. By looping over the param_tuple we only get the data
-            # for requested parameters so a mismatch in params and types does not matter
-            for i,param in enumerate(param_tuple):
-                pack_char_list[i], param_size_list[i] = get_data_format_and_size(param, param_type_tuple[i])
-            
-        if ack:
-            ack_string = 'SEND_WITH_ACK'
-            data_ack_string = 'DATA_WITH_ACK'
-        else:
-            ack_string = 'SEND_NO_ACK'
-            data_ack_string = 'DATA_NO_ACK'
-
-        # Construct the base packet
-        self.sequence_counter[ack_string] = (self.sequence_counter[ack_string] + 1) % 256
-
-        # Calculate packet size:
-        # base packet <BBBIBBH is 11 bytes, param_size_list can be added up
-        packet_size = 11 + sum(param_size_list)
-        
-        packet = struct.pack("<BBBIBBH", self.data_types_by_name[data_ack_string],
-                             self.buffer_ids[ack_string],
-                             self.sequence_counter[ack_string], packet_size,
-                             command_tuple[0], command_tuple[1], command_tuple[2])
-
-        if param_tuple is not None:
-            # Add in the parameter values based on their sizes
-            for i,param in enumerate(param_tuple):
-                packet += struct.pack(pack_char_list[i],param)
+        if param_tuple is None:
+            param_tuple = ()
 
         if ack:
-            return self.send_command_packet_ack(packet, self.sequence_counter['SEND_WITH_ACK'])
+            return self._send_ack_command(command_tuple, param_tuple, param_type_tuple)
         else:
-            return self.send_command_packet_noack(packet)
+            self._queue_command(LANE_PCMD, 'SEND_NO_ACK', command_tuple, param_tuple, param_type_tuple)
 
 
     def send_single_pcmd_command(self, command_tuple, roll, pitch, yaw, vertical_movement):
@@ -575,16 +1118,8 @@ class WifiConnection:
         :param yaw:
         :param vertical_movement:
         """
-        self.sequence_counter['SEND_NO_ACK'] = (self.sequence_counter['SEND_NO_ACK'] + 1) % 256
-        packet = struct.pack("<BBBIBBHBbbbbI",
-                             self.data_types_by_name['DATA_NO_ACK'],
-                             self.buffer_ids['SEND_NO_ACK'],
-                             self.sequence_counter['SEND_NO_ACK'],
-                             20,
-                             command_tuple[0], command_tuple[1], command_tuple[2],
-                             1, int(roll), int(pitch), int(yaw), int(vertical_movement), 0)
-
-        self.safe_send(packet)
+        self._queue_command(LANE_PCMD, 'SEND_NO_ACK', command_tuple,
+                            (1, int(roll), int(pitch), int(yaw), int(vertical_movement), 0), self._pcmd_arg_types)
 
     def send_pcmd_command(self, command_tuple, roll, pitch, yaw, vertical_movement, duration):
         """
@@ -618,16 +1153,8 @@ class WifiConnection:
         :param change_z: change in z
         :param change_angle: change in angle
         """
-        self.sequence_counter['SEND_WITH_ACK'] = (self.sequence_counter['SEND_WITH_ACK'] + 1) % 256
-        packet = struct.pack("<BBBIBBHffff",
-                             self.data_types_by_name['DATA_WITH_ACK'],
-                             self.buffer_ids['SEND_WITH_ACK'],
-                             self.sequence_counter['SEND_WITH_ACK'],
-                             27,
-                             command_tuple[0], command_tuple[1], command_tuple[2],
-                             change_x, change_y, change_z, change_angle)
-
-        self.safe_send(packet)
+        self._queue_ack_command(command_tuple, (change_x, change_y, change_z, change_angle),
+                                ('float', 'float', 'float', 'float'))
 
     def send_turn_command(self, command_tuple, degrees):
         """
@@ -637,17 +1164,7 @@ class WifiConnection:
         :param degrees: how many degrees to turn
         :return: True if the command was sent and False otherwise
         """
-        self.sequence_counter['SEND_WITH_ACK'] = (self.sequence_counter['SEND_WITH_ACK'] + 1) % 256
-
-        packet = struct.pack("<BBBIBBHh",
-                             self.data_types_by_name['DATA_WITH_ACK'],
-                             self.buffer_ids['SEND_WITH_ACK'],
-                             self.sequence_counter['SEND_WITH_ACK'],
-                             13,
-                             command_tuple[0], command_tuple[1], command_tuple[2],
-                             degrees)
-
-        return self.send_command_packet_ack(packet, self.sequence_counter['SEND_WITH_ACK'])
+        return self._send_ack_command(command_tuple, (degrees,), ('i16',))
 
 
     def send_camera_move_command(self, command_tuple, pan, tilt):
@@ -658,16 +1175,7 @@ class WifiConnection:
         :param pan:
         :param tilt:
         """
-        self.sequence_counter['SEND_WITH_ACK'] = (self.sequence_counter['SEND_WITH_ACK'] + 1) % 256
-        packet = struct.pack("<BBBIBBHff",
-                             self.data_types_by_name['DATA_WITH_ACK'],
-                             self.buffer_ids['SEND_WITH_ACK'],
-                             self.sequence_counter['SEND_WITH_ACK'],
-                             19,
-                             command_tuple[0], command_tuple[1], command_tuple[2],
-                             pan, tilt)
-
-        self.safe_send(packet)
+        self._queue_ack_command(command_tuple, (pan, tilt), ('float', 'float'))
 
     def send_enum_command_packet_ack(self, command_tuple, enum_value, usb_id=None):
         """
@@ -681,21 +1189,10 @@ class WifiConnection:
         :param enum_value: the enum index
         :return: nothing
         """
-        self.sequence_counter['SEND_WITH_ACK'] = (self.sequence_counter['SEND_WITH_ACK'] + 1) % 256
-
         if (usb_id is None):
-            packet = struct.pack("<BBBIBBHI", self.data_types_by_name['DATA_WITH_ACK'],
-                                 self.buffer_ids['SEND_WITH_ACK'],
-                                 self.sequence_counter['SEND_WITH_ACK'], 15,
-                                 command_tuple[0], command_tuple[1], command_tuple[2],
-                                 enum_value)
+            return self._send_ack_command(command_tuple, (enum_value,), ('enum',))
         else:
-            packet = struct.pack("<BBBIBBHBI", self.data_types_by_name['DATA_WITH_ACK'],
-                                 self.buffer_ids['SEND_WITH_ACK'],
-                                 self.sequence_counter['SEND_WITH_ACK'], 16,
-                                 command_tuple[0], command_tuple[1], command_tuple[2],
-                                 usb_id, enum_value)
-        return self.send_command_packet_ack(packet, self.sequence_counter['SEND_WITH_ACK'])
+            return self._send_ack_command(command_tuple, (usb_id, enum_value), ('u8', 'enum'))
 
     def smart_sleep(self, timeout):
         """
@@ -727,13 +1224,5 @@ class WifiConnection:
         #color_print("ack: buffer id of %d and packet id of %d" % (buffer_id, packet_id))
         new_buf_id = (buffer_id + 128) % 256
 
-        if (new_buf_id not in self.sequence_counter):
-            self.sequence_counter[new_buf_id] = 0
-        else:
-            self.sequence_counter[new_buf_id] = (self.sequence_counter[new_buf_id] + 1) % 256
-
-        packet = struct.pack("<BBBIB", self.data_types_by_name['ACK'], new_buf_id,
-                             self.sequence_counter[new_buf_id], 8,
-                             packet_id)
-
-        self.safe_send(packet)
+        self._queue(LANE_ACK, new_buf_id,
+                    lambda seq: struct.pack("<BBBIB", self.data_types_by_name['ACK'], new_buf_id, seq, 8, packet_id))
@@ -1,48 +1,70 @@
 """
 Find the BLE address for a mambo.  To run this,
 
-sudo python findMambo.py
+sudo python findMinidrone.py
 
 Note that the sudo is necessary for BLE permissions on linux.  It is only needed on
 this program and nothing else.
 
+By default it listens for 10 seconds and prints every minidrone it heard, closest first.  Use --name to stop
+as soon as a given minidrone is heard and --closest to only print the closest ones.
+
 Author: Amy McGovern
 """
+import argparse
+import time
 
 try:
-    from bluepy.btle import Scanner, DefaultDelegate
+    from pyparrot.networking.bleScanner import MinidroneScanner
     BLEAvailable = True
 except:
     BLEAvailable = False
 
-class ScanDelegate(DefaultDelegate):
-    def __init__(self):
-        DefaultDelegate.__init__(self)
-
-    def handleDiscovery(self, dev, isNewDev, isNewData):
-        if isNewDev:
-            print("Discovered device", dev.addr)
-        elif isNewData:
-            print("Received new data from", dev.addr)
 
 def main():
-    scanner = Scanner().withDelegate(ScanDelegate())
-    devices = scanner.scan(10.0)
-
-    for dev in devices:
-        #print "Device %s (%s), RSSI=%d dB" % (dev.addr, dev.addrType, dev.rssi)
-        for (adtype, desc, value) in dev.getScanData():
-            #print "  %s = %s" % (desc, value)
-            if (desc == "Complete Local Name"):
-                if ("Mambo" in value):
-                    print("FOUND A MAMBO!")
-                    print("Device %s (%s), RSSI=%d dB" % (dev.addr, dev.addrType, dev.rssi))
-                    print("  %s = %s" % (desc, value))
-
-                elif ("Swing" in value):
-                    print("FOUND A SWING!")
-                    print("Device %s (%s), RSSI=%d dB" % (dev.addr, dev.addrType, dev.rssi))
-                    print("  %s = %s" % (desc, value))
+    parser = argparse.ArgumentParser(description="Find the BLE address of the Parrot minidrones nearby")
+    parser.add_argument("--time", type=float, default=10.0, help="seconds to listen for (default 10)")
+    parser.add_argument("--name", help="stop as soon as the minidrone with this name (e.g. Mambo_123456) is heard")
+    parser.add_argument("--closest", type=int, default=None, help="only print this many of the closest minidrones")
+    parser.add_argument("--active", action="store_true", help="active scan (asks each device for its name)")
+    args = parser.parse_args()
+
+    if (not BLEAvailable):
+        print("bluepy is not installed so the minidrones can not be found")
+        return
+
+    scanner = MinidroneScanner(passive=not args.active)
+
+    if (args.name is not None):
+        minidrone = scanner.wait_for_minidrone(args.name, args.time)
+        scanner.stop()
+        if (minidrone is None):
+            print("Did not hear %s" % args.name)
+        else:
+            print("FOUND %s!" % minidrone.name)
+            print("Device %s" % minidrone)
+        return
+
+    scanner.start()
+    time.sleep(args.time)
+    scanner.stop()
+
+    if (args.closest is None):
+        minidrones = scanner.get_minidrones()
+    else:
+        minidrones = scanner.get_closest(args.closest)
+
+    if (len(minidrones) == 0):
+        print("Did not hear any minidrones")
+
+    for minidrone in minidrones:
+        if (minidrone.name is not None and "Mambo" in minidrone.name):
+            print("FOUND A MAMBO!")
+        elif (minidrone.name is not None and "Swing" in minidrone.name):
+            print("FOUND A SWING!")
+        else:
+            print("FOUND A MINIDRONE!")
+        print("Device %s" % minidrone)
 
 
 if __name__ == "__main__":